@@ -0,0 +1,152 @@
+"""Configuration for bibat's benchmarks.
+
+Each benchmark records the best wall-clock time of a few repeats and the peak
+memory allocated by Python and numpy while it runs, as measured by
+tracemalloc. The results can be saved to a json file and later runs compared
+against them, for example:
+
+```sh
+$ python -m pytest benchmarks --bench-save baseline.json
+$ python -m pytest benchmarks --bench-compare baseline.json
+```
+
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import time
+import tracemalloc
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+DEFAULT_MAX_N = 10_000
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 1.5
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    """Add command line options for benchmarks."""
+    group = parser.getgroup("bibat benchmarks")
+    group.addoption(
+        "--bench-max-n",
+        type=int,
+        default=DEFAULT_MAX_N,
+        help="Largest number of measurements to benchmark, up to 1000000.",
+    )
+    group.addoption(
+        "--bench-repeats",
+        type=int,
+        default=DEFAULT_REPEATS,
+        help="Number of times to time each benchmark.",
+    )
+    group.addoption(
+        "--bench-save",
+        type=Path,
+        default=None,
+        help="Save the results to this json file.",
+    )
+    group.addoption(
+        "--bench-compare",
+        type=Path,
+        default=None,
+        help="Fail benchmarks that regressed compared with this json file.",
+    )
+    group.addoption(
+        "--bench-tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Largest allowed ratio of new to saved time or memory.",
+    )
+
+
+class Benchmark:
+    """Measure functions and check them against saved results.
+
+    :param repeats: Number of times to time each function.
+
+    :param baseline: Previously saved results
+
+    :param tolerance: Largest allowed ratio of new to saved time or memory.
+
+    """
+
+    def __init__(
+        self,
+        repeats: int,
+        baseline: dict[str, dict[str, float]],
+        tolerance: float,
+    ) -> None:
+        """Start with no results."""
+        self.repeats = repeats
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.results: dict[str, dict[str, float]] = {}
+
+    def __call__(self, name: str, func: Callable[[], Any]) -> None:
+        """Measure a function, then check for regressions.
+
+        :param name: A unique name for the measurement, e.g. the id of the
+        current test.
+
+        :param func: The function to measure. It is called `repeats` times
+        for timing, and once more with memory tracing, which is slow.
+
+        """
+        times = []
+        for _ in range(self.repeats):
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result = {"time": min(times), "peak_memory": peak_memory}
+        self.results[name] = result
+        saved = self.baseline.get(name)
+        if saved is None:
+            return
+        regressions = [
+            f"{key} went from {saved[key]:.4g} to {result[key]:.4g}"
+            for key in result
+            if saved.get(key, 0) > 0
+            and result[key] > self.tolerance * saved[key]
+        ]
+        if len(regressions) > 0:
+            msg = f"Benchmark {name} regressed: {'; '.join(regressions)}."
+            raise ValueError(msg)
+
+
+@pytest.fixture(scope="session")
+def benchmark(request: pytest.FixtureRequest) -> Iterator[Benchmark]:
+    """Provide a Benchmark object, saving its results at the end."""
+    compare_path = request.config.getoption("--bench-compare")
+    save_path = request.config.getoption("--bench-save")
+    baseline = {}
+    if compare_path is not None:
+        baseline = json.loads(compare_path.read_text())
+    out = Benchmark(
+        repeats=request.config.getoption("--bench-repeats"),
+        baseline=baseline,
+        tolerance=request.config.getoption("--bench-tolerance"),
+    )
+    yield out
+    if save_path is not None:
+        save_path.write_text(json.dumps(out.results, indent=2, sort_keys=True))
+
+
+@pytest.fixture(scope="session")
+def max_n(request: pytest.FixtureRequest) -> int:
+    """Get the largest number of measurements to benchmark."""
+    return request.config.getoption("--bench-max-n")
@@ -0,0 +1,325 @@
+"""Benchmarks for the fitting pipeline at growing data sizes.
+
+The data are synthetic measurements like those in bibat's example analysis,
+with between 100 and 1000000 rows. Sizes bigger than the option
+`--bench-max-n` are skipped. Sampling is replaced by stubs that return draws
+of the right shape straight away, so that the benchmarks measure bibat's own
+overhead.
+
+"""
+
+from __future__ import annotations
+
+from functools import cache, partial
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Any
+
+import arviz as az
+import numpy as np
+import pandas as pd
+import pandera as pa
+import pytest
+import toml
+import xarray as xr
+from pandera.typing import Series  # noqa: TCH002
+from pydantic import field_validator
+
+from bibat import fitting_mode
+from bibat.fitting import run_inference, save_idata
+from bibat.fitting_mode import FittingMode, sample_hmc_kfold
+from bibat.inference_configuration import (
+    IdataCompressor,
+    IdataSaveFormat,
+    IdataSaveOptions,
+    load_inference_configuration,
+)
+from bibat.prepared_data import (
+    PreparedData,
+    PreparedDataFormat,
+    load_prepared_data,
+    save_prepared_data,
+)
+from bibat.stan_input import get_stan_input
+from bibat.util import (
+    CoordDict,
+    DfInPydanticModel,
+    StanInputDict,
+    returns_stan_input,
+)
+from bibat.validation import validate_table
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from conftest import Benchmark
+
+SIZES = [10**k for k in range(2, 7)]
+N_CHAINS = 1
+N_DRAWS = 10
+N_FOLDS = 10
+X_COLS = ["x1", "x2", "x1:x2"]
+
+
+class BenchmarkMeasurementsDF(pa.DataFrameModel):
+    """The measurements table of BenchmarkPreparedData."""
+
+    x1: Series[float]
+    x2: Series[float]
+    x1colonx2: Series[float] = pa.Field(alias="x1:x2")
+    y: Series[float]
+
+
+class BenchmarkPreparedData(PreparedData):
+    """Prepared data like in bibat's example analysis."""
+
+    name: str
+    coords: CoordDict
+    measurements: DfInPydanticModel
+
+    @field_validator("measurements")
+    @classmethod
+    def validate_measurements(
+        cls: type[BenchmarkPreparedData],
+        v: DfInPydanticModel,
+    ) -> pd.DataFrame:
+        """Validate the measurements table."""
+        return validate_table(BenchmarkMeasurementsDF, v)
+
+
+@cache
+def make_prepared_data(n: int) -> BenchmarkPreparedData:
+    """Make synthetic prepared data with n measurements."""
+    rng = np.random.default_rng(1234)
+    x1, x2 = rng.normal(size=(2, n))
+    measurements = pd.DataFrame(
+        {
+            "x1": x1,
+            "x2": x2,
+            "x1:x2": x1 * x2,
+            "y": 0.5 * x1 - x2 + rng.normal(size=n),
+        },
+    )
+    return BenchmarkPreparedData(
+        name=f"benchmark_{n}",
+        coords=CoordDict({"observation": [str(i) for i in range(n)]}),
+        measurements=measurements,
+    )
+
+
+@cache
+def make_idata(n: int) -> az.InferenceData:
+    """Make InferenceData like a posterior mode's, for n measurements."""
+    rng = np.random.default_rng(1234)
+    shape = (N_CHAINS, N_DRAWS, n)
+    dims = ("chain", "draw", "observation")
+    return az.InferenceData(
+        posterior=xr.Dataset(
+            {
+                "b": (
+                    ("chain", "draw", "b_dim_0"),
+                    rng.normal(size=(N_CHAINS, N_DRAWS, 3)),
+                ),
+            },
+        ),
+        posterior_predictive=xr.Dataset(
+            {"yrep": (dims, rng.normal(size=shape))},
+        ),
+        log_likelihood=xr.Dataset({"llik": (dims, rng.normal(size=shape))}),
+    )
+
+
+@returns_stan_input(numpy=True)
+def get_stan_input_benchmark(
+    prepared_data: BenchmarkPreparedData,
+) -> StanInputDict:
+    """Get a Stan input like in bibat's example analysis."""
+    measurements = prepared_data.measurements
+    ix = np.arange(1, len(measurements) + 1)
+    return {
+        "N": len(measurements),
+        "N_train": len(measurements),
+        "N_test": len(measurements),
+        "K": len(X_COLS),
+        "x": measurements[X_COLS].to_numpy(),
+        "y": measurements["y"].to_numpy(),
+        "ix_train": ix,
+        "ix_test": ix,
+    }
+
+
+class StubModel:
+    """Something that looks enough like a CmdStanModel to sample k-fold."""
+
+    def sample(
+        self,
+        data: dict[str, Any],
+        **kwargs: Any,  # noqa: ANN401, ARG002
+    ) -> SimpleNamespace:
+        """Return random log likelihood draws for the test observations."""
+        n_test = data["N_test"]
+        llik = np.random.default_rng(1234).normal(size=(N_DRAWS, n_test))
+        return SimpleNamespace(
+            chains=N_CHAINS,
+            num_draws_sampling=N_DRAWS,
+            metadata=SimpleNamespace(
+                stan_vars={"llik": SimpleNamespace(dimensions=(n_test,))},
+            ),
+            stan_variable=lambda *_, **__: llik,
+        )
+
+
+LOCAL_FUNCTIONS = {"get_stan_input_benchmark": get_stan_input_benchmark}
+
+
+@pytest.fixture(params=SIZES, ids=lambda n: f"n{n}")
+def n(request: pytest.FixtureRequest, max_n: int) -> int:
+    """Get a number of measurements, skipping ones that are too big."""
+    if request.param > max_n:
+        pytest.skip(f"{request.param} is bigger than --bench-max-n")
+    return request.param
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Make a project directory with a Stan file and an inference."""
+    stan_dir = tmp_path / "src" / "stan"
+    stan_dir.mkdir(parents=True)
+    (stan_dir / "model.stan").write_text("parameters { real mu; }")
+    inference_dir = tmp_path / "inferences" / "benchmark"
+    inference_dir.mkdir(parents=True)
+    config = {
+        "name": "benchmark",
+        "stan_file": "model.stan",
+        "prepared_data": "benchmark",
+        "stan_input_function": "get_stan_input_benchmark",
+        "modes": ["posterior", "kfold"],
+        "dims": {"llik": ["observation"], "yrep": ["observation"]},
+        "sample_kwargs": {"chains": N_CHAINS, "iter_sampling": N_DRAWS},
+        "mode_options": {"kfold": {"n_folds": N_FOLDS}},
+        "idata_save_options": {"compressor": "zstd", "chunks": {"draw": 5}},
+    }
+    with (inference_dir / "config.toml").open("w") as f:
+        toml.dump(config, f)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_load_inference_configuration(
+    benchmark: Benchmark,
+    project: Path,
+) -> None:
+    """Benchmark loading an inference configuration."""
+    benchmark(
+        "load_inference_configuration",
+        partial(
+            load_inference_configuration,
+            project / "inferences" / "benchmark",
+        ),
+    )
+
+
+@pytest.mark.parametrize("prepared_data_format", list(PreparedDataFormat))
+def test_load_prepared_data(
+    benchmark: Benchmark,
+    n: int,
+    prepared_data_format: PreparedDataFormat,
+    tmp_path: Path,
+) -> None:
+    """Benchmark loading and validating prepared data."""
+    path = save_prepared_data(
+        make_prepared_data(n),
+        tmp_path,
+        prepared_data_format,
+    )
+    benchmark(
+        f"load_prepared_data[{prepared_data_format.value}-{n}]",
+        partial(load_prepared_data, path, BenchmarkPreparedData),
+    )
+
+
+def test_get_stan_input(benchmark: Benchmark, n: int, project: Path) -> None:
+    """Benchmark making, encoding and writing a Stan input."""
+    ic = load_inference_configuration(project / "inferences" / "benchmark")
+    prepared_data = make_prepared_data(n)
+
+    def make_stan_input() -> None:
+        prepared_data._stan_inputs.clear()  # noqa: SLF001
+        stan_input = get_stan_input(ic, prepared_data, LOCAL_FUNCTIONS)
+        stan_input.write(project / "stan_input", {"likelihood": 1})
+
+    benchmark(f"get_stan_input[{n}]", make_stan_input)
+
+
+def test_run_inference(benchmark: Benchmark, n: int, project: Path) -> None:
+    """Benchmark run_inference with a stub posterior mode."""
+    ic = load_inference_configuration(project / "inferences" / "benchmark")
+    ic.fitting_modes = ["posterior"]
+    prepared_data = make_prepared_data(n)
+    stub_mode = FittingMode(
+        name="posterior",
+        idata_target="posterior",
+        fit=lambda *_: make_idata(n),
+    )
+
+    def run() -> None:
+        prepared_data._stan_inputs.clear()  # noqa: SLF001
+        run_inference(
+            ic,
+            prepared_data,
+            {"posterior": stub_mode},
+            LOCAL_FUNCTIONS,
+        )
+
+    make_idata(n)
+    benchmark(f"run_inference[{n}]", run)
+
+
+def test_kfold(
+    benchmark: Benchmark,
+    n: int,
+    project: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Benchmark k-fold cross-validation with a stub sampler."""
+    ic = load_inference_configuration(project / "inferences" / "benchmark")
+    # pass the Stan input to the stub as a dictionary rather than a file
+    ic.inference_dir = None
+    prepared_data = make_prepared_data(n)
+    monkeypatch.setattr(fitting_mode, "get_stan_model", lambda _: StubModel())
+    get_stan_input(ic, prepared_data, LOCAL_FUNCTIONS)
+    benchmark(
+        f"kfold[{n}]",
+        partial(sample_hmc_kfold, ic, prepared_data, LOCAL_FUNCTIONS),
+    )
+
+
+@pytest.mark.parametrize(
+    "idata_save_format",
+    [IdataSaveFormat.zarr, IdataSaveFormat.netcdf],
+)
+def test_save_idata(
+    benchmark: Benchmark,
+    n: int,
+    idata_save_format: IdataSaveFormat,
+    project: Path,
+) -> None:
+    """Benchmark saving an InferenceData object with compression."""
+    save_options = IdataSaveOptions(
+        save_format=idata_save_format,
+        compressor=(
+            IdataCompressor.zstd
+            if idata_save_format == IdataSaveFormat.zarr
+            else IdataCompressor.zlib
+        ),
+        chunks={"draw": 5},
+    )
+    idata = make_idata(n)
+    benchmark(
+        f"save_idata[{idata_save_format.value}-{n}]",
+        partial(
+            save_idata,
+            idata,
+            project / "inferences" / "benchmark",
+            idata_save_options=save_options,
+        ),
+    )
@@ -0,0 +1,246 @@
+"""Provides checkpoints so that interrupted inferences can be resumed.
+
+When `bibat.fitting.run_all_inferences` is called with `resume=True`, each
+inference saves its progress in a folder called `checkpoint` in its directory:
+
+- Each fitting mode's results are written to the temporary InferenceData
+  store as soon as the mode finishes (see `bibat.fitting.IdataWriter`), and
+  the mode is listed as completed in the file `checkpoint/checkpoint.json`,
+  along with the variables that it wrote. The temporary store is kept if the
+  inference fails.
+- Each fit that only produces log likelihood draws, e.g. a k-fold fold or a
+  PSIS-LOO refit, saves its draws to a file `checkpoint/<mode>/<fit>.npy`.
+
+Checkpoints are started with `start_checkpoint`, which holds the lock file
+`checkpoint.lock` in the inference directory so that several processes can
+start the same inference's checkpoint, e.g. workers running pieces of its
+fitting modes (see `bibat.work_queue`).
+
+If the inference is run again with `resume=True`, completed modes are not run
+again and saved fits are loaded instead of being sampled. Checkpoints for
+modes whose fingerprints (see `bibat.fingerprint`) have changed are ignored
+and removed, as are their variables in the temporary store. If the observed
+data has changed, the whole checkpoint and temporary store are removed. When
+the inference finishes, its checkpoint folder is removed.
+
+Mode checkpoints need the zarr or netcdf InferenceData formats, which write
+each mode's results straight away; with the json format, only fits are
+checkpointed.
+
+The current checkpoint folder is stored in a context variable, so that it is
+seen by fitting mode functions without being passed to them.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import shutil
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+from bibat.util import file_lock
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+CHECKPOINT_DIR = "checkpoint"
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_LOCK_FILE = "checkpoint.lock"
+
+_CHECKPOINT_DIR: ContextVar[Path | None] = ContextVar(
+    "bibat_checkpoint_dir",
+    default=None,
+)
+
+
+class Checkpoint(BaseModel):
+    """The progress of an inference.
+
+    :param fingerprints: The fingerprints of the inference's modes when the
+    checkpoint was started.
+
+    :param data_fingerprint: The fingerprint of the inference's observed data
+    when the checkpoint was started: see `bibat.fingerprint.data_fingerprint`.
+
+    :param completed_modes: Modes whose results have been saved.
+
+    :param written: For each completed mode, the variables that it wrote to
+    each InferenceData group.
+
+    """
+
+    fingerprints: dict[str, str] = Field(default_factory=dict)
+    data_fingerprint: str | None = None
+    completed_modes: list[str] = Field(default_factory=list)
+    written: dict[str, dict[str, list[str]]] = Field(default_factory=dict)
+
+    def complete_mode(self, mode: str, written: dict[str, list[str]]) -> None:
+        """Record that a mode has finished and what it wrote.
+
+        :param mode: Name of the mode
+
+        :param written: The variables that the mode wrote to each group
+
+        """
+        self.completed_modes.append(mode)
+        self.written[mode] = written
+
+    def get_kept_variables(self) -> dict[str, list[str]]:
+        """Get the variables written by completed modes, by group."""
+        kept: dict[str, list[str]] = {}
+        for mode in self.completed_modes:
+            for group, variables in self.written.get(mode, {}).items():
+                kept.setdefault(group, []).extend(variables)
+        return kept
+
+    def get_valid_modes(
+        self,
+        fingerprints: dict[str, str],
+        data_fingerprint: str | None = None,
+    ) -> list[str]:
+        """Get the completed modes whose saved results are still valid.
+
+        :param fingerprints: The current fingerprints of the inference's modes
+
+        :param data_fingerprint: The current fingerprint of the inference's
+        observed data
+
+        """
+        if self.data_fingerprint != data_fingerprint:
+            return []
+        return [
+            mode
+            for mode in self.completed_modes
+            if self.fingerprints.get(mode) == fingerprints.get(mode)
+            and mode in self.written
+        ]
+
+
+def get_checkpoint_dir(inference_dir: Path) -> Path:
+    """Get the folder where an inference's checkpoints are saved."""
+    return inference_dir / CHECKPOINT_DIR
+
+
+def load_checkpoint(inference_dir: Path) -> Checkpoint:
+    """Load an inference's checkpoint, or an empty one if there is none."""
+    path = get_checkpoint_dir(inference_dir) / CHECKPOINT_FILE
+    if not path.exists():
+        return Checkpoint()
+    return Checkpoint.model_validate_json(path.read_text())
+
+
+def save_checkpoint(inference_dir: Path, checkpoint: Checkpoint) -> None:
+    """Save an inference's checkpoint."""
+    path = get_checkpoint_dir(inference_dir) / CHECKPOINT_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(checkpoint.model_dump_json(indent=2))
+    tmp_path.replace(path)
+
+
+def start_checkpoint(
+    inference_dir: Path,
+    fingerprints: dict[str, str],
+    data_fingerprint: str | None = None,
+) -> Checkpoint:
+    """Start a checkpoint, keeping any saved progress that is still valid.
+
+    Saved progress for modes whose fingerprints have changed is removed. If
+    the observed data's fingerprint has changed, all saved progress is
+    removed.
+
+    :param inference_dir: An inference directory
+
+    :param fingerprints: The current fingerprints of the inference's modes
+
+    :param data_fingerprint: The current fingerprint of the inference's
+    observed data
+
+    """
+    with file_lock(inference_dir / CHECKPOINT_LOCK_FILE):
+        saved = load_checkpoint(inference_dir)
+        if saved.data_fingerprint != data_fingerprint:
+            saved = Checkpoint()
+            clear_checkpoint(inference_dir)
+        for mode, fingerprint in saved.fingerprints.items():
+            if fingerprints.get(mode) != fingerprint:
+                shutil.rmtree(
+                    get_checkpoint_dir(inference_dir) / mode,
+                    ignore_errors=True,
+                )
+        completed_modes = saved.get_valid_modes(fingerprints, data_fingerprint)
+        checkpoint = Checkpoint(
+            fingerprints=fingerprints,
+            data_fingerprint=data_fingerprint,
+            completed_modes=completed_modes,
+            written={mode: saved.written[mode] for mode in completed_modes},
+        )
+        save_checkpoint(inference_dir, checkpoint)
+    return checkpoint
+
+
+def clear_checkpoint(inference_dir: Path) -> None:
+    """Remove an inference's checkpoints."""
+    shutil.rmtree(get_checkpoint_dir(inference_dir), ignore_errors=True)
+
+
+@contextmanager
+def checkpointing(directory: Path | None) -> Iterator[None]:
+    """Save and load fit checkpoints in a folder in the current context.
+
+    :param directory: A checkpoint folder, or None not to use checkpoints.
+
+    """
+    token = _CHECKPOINT_DIR.set(directory)
+    try:
+        yield
+    finally:
+        _CHECKPOINT_DIR.reset(token)
+
+
+@contextmanager
+def checkpoint_scope(name: str) -> Iterator[None]:
+    """Use a subfolder of the current checkpoint folder, if there is one.
+
+    :param name: Name of the subfolder, e.g. the name of a fitting mode.
+
+    """
+    directory = _CHECKPOINT_DIR.get()
+    with checkpointing(None if directory is None else directory / name):
+        yield
+
+
+def load_fit_checkpoint(name: str) -> np.ndarray | None:
+    """Load a fit's saved draws, if checkpoints are on and there are any.
+
+    :param name: Name of the fit, e.g. "fold_3".
+
+    """
+    directory = _CHECKPOINT_DIR.get()
+    if directory is None or not (directory / f"{name}.npy").exists():
+        return None
+    logging.info("Loading checkpointed fit %s", name)
+    return np.load(directory / f"{name}.npy")
+
+
+def save_fit_checkpoint(name: str, draws: np.ndarray) -> None:
+    """Save a fit's draws, if checkpoints are on.
+
+    :param name: Name of the fit, e.g. "fold_3".
+
+    :param draws: The fit's draws
+
+    """
+    directory = _CHECKPOINT_DIR.get()
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / f"{name}.tmp.npy"
+    np.save(tmp_path, draws)
+    tmp_path.replace(directory / f"{name}.npy")
@@ -0,0 +1,133 @@
+"""Provides the `bibat` command.
+
+Subcommands:
+
+- `bibat compile [inferences_dir]`: compile the Stan models used by all the
+  inferences in parallel before fitting them, reporting how long each model
+  took: see `bibat.stan_model.compile_stan_models`. Run this from the
+  project's root directory.
+- `bibat worker <queue_dir>`: run tasks from a work queue made by
+  `bibat.fitting.run_all_inferences` with a `queue_dir`: see
+  `bibat.work_queue`. Start one of these on each host that should help.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+from functools import partial
+from pathlib import Path
+
+from bibat.fitting import run_queued_task
+from bibat.stan_model import compile_stan_models, find_compile_jobs
+from bibat.work_queue import (
+    DEFAULT_POLL_INTERVAL,
+    DEFAULT_STALE_AFTER,
+    run_worker,
+)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Make a parser for the `bibat` command's arguments."""
+    parser = argparse.ArgumentParser(prog="bibat")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser(
+        "compile",
+        help="Compile the Stan models used by some inferences.",
+    )
+    compile_parser.add_argument(
+        "inferences_dir",
+        type=Path,
+        nargs="?",
+        default=Path("inferences"),
+        help="Folder containing inference folders. Default: %(default)s.",
+    )
+    compile_parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="Number of models to compile at once. Default: one per core.",
+    )
+    worker = subparsers.add_parser(
+        "worker",
+        help="Run tasks from a work queue.",
+    )
+    worker.add_argument("queue_dir", type=Path, help="The queue folder.")
+    worker.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="Number of CPU cores that each task can use. Default: no limit.",
+    )
+    worker.add_argument(
+        "--stale-after",
+        type=float,
+        default=DEFAULT_STALE_AFTER,
+        help=(
+            "Seconds after which tasks claimed by workers that stopped "
+            "responding are run again. Default: %(default)s."
+        ),
+    )
+    worker.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds to wait between checks for new tasks.",
+    )
+    worker.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Stop as soon as there are no tasks that can be claimed.",
+    )
+    return parser
+
+
+def run_compile_command(args: argparse.Namespace) -> int:
+    """Run the `bibat compile` subcommand."""
+    inference_dirs = sorted(
+        d for d in args.inferences_dir.iterdir() if (d / "config.toml").exists()
+    )
+    jobs = find_compile_jobs(inference_dirs)
+    results = compile_stan_models(jobs, args.max_workers)
+    logging.info("Compile times, slowest first:")
+    for job, seconds in sorted(results, key=lambda r: -r[1]):
+        logging.info(
+            "%8.1fs  %s  (%s)",
+            seconds,
+            job.stan_file,
+            ", ".join(job.inferences),
+        )
+    return 0
+
+
+def run_worker_command(args: argparse.Namespace) -> int:
+    """Run the `bibat worker` subcommand."""
+    n_run = run_worker(
+        args.queue_dir,
+        partial(run_queued_task, cores=args.cores),
+        wait=not args.no_wait,
+        poll_interval=args.poll_interval,
+        stale_after=args.stale_after,
+    )
+    logging.info("Worker finished after running %s tasks", n_run)
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the `bibat` command.
+
+    :param argv: Command line arguments. Default: those of the current
+    process.
+
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    args = make_parser().parse_args(argv)
+    if args.command == "compile":
+        return run_compile_command(args)
+    if args.command == "worker":
+        return run_worker_command(args)
+    return 1
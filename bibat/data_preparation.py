@@ -0,0 +1,532 @@
+"""Provides a runner for an analysis's data preparation functions.
+
+Each way of preparing data is described by a DataPreparation object, which
+says which raw data files to read and which function turns the resulting
+tables into a PreparedData object. `run_data_preparations` then runs them all,
+optionally in a process pool, and saves the results.
+
+Parsing large raw files is often the slowest part of data preparation, so
+each raw table is cached in a fast binary form (a pickle file) in a cache
+directory, keyed by a hash of the raw file and of the function that reads it.
+Raw files that several preparations share are only parsed once, and are not
+parsed again until they change.
+
+Each preparation also has a fingerprint made from the hashes of its raw files,
+the source code of the modules defining its functions (see
+`bibat.fingerprint`) and any other files it is declared to depend on.
+Preparations whose fingerprints have not changed since their output was saved
+are skipped.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Literal
+
+import pandas as pd
+from pydantic import BaseModel, Field, model_validator
+
+from bibat.fingerprint import function_fingerprint, path_fingerprint
+from bibat.prepared_data import (
+    PreparedData,
+    PreparedDataFormat,
+    save_prepared_data,
+)
+
+CACHE_DIR = ".cache"
+RAW_CACHE_DIR = "raw"
+PREPARATION_FINGERPRINT_FILE = "preparation_fingerprints.json"
+
+Reader = Callable[[Path], pd.DataFrame]
+
+
+def filter_rows(
+    df: pd.DataFrame,
+    predicate: str | Callable[[pd.DataFrame], pd.Series] | None,
+) -> pd.DataFrame:
+    """Keep the rows of a dataframe that satisfy a predicate.
+
+    :param df: A dataframe
+
+    :param predicate: Either a query string for `pandas.DataFrame.query`, a
+    function that takes a dataframe and returns a boolean series, or None to
+    keep all rows.
+
+    """
+    if predicate is None:
+        return df
+    if isinstance(predicate, str):
+        return df.query(predicate)
+    return df.loc[predicate(df)]
+
+
+def read_raw_csv(  # noqa: PLR0913
+    path: Path,
+    usecols: list[str] | None = None,
+    dtype: dict[str, str] | None = None,
+    predicate: str | Callable[[pd.DataFrame], pd.Series] | None = None,
+    chunksize: int | None = None,
+    engine: Literal["c", "python", "pyarrow"] | None = None,
+) -> pd.DataFrame:
+    """Read a raw csv file, without an index column.
+
+    To read only part of a big file, use `functools.partial` to make a reader
+    with some of the optional arguments, for example:
+
+    ```python
+    reader = partial(
+        read_raw_csv,
+        usecols=["yearID", "AB"],
+        dtype={"yearID": "int16", "AB": "Int32"},
+        predicate="yearID >= 2017",
+        chunksize=1_000_000,
+    )
+    ```
+
+    :param path: A csv file
+
+    :param usecols: Columns to read. By default all columns are read.
+
+    :param dtype: Map from column names to dtypes.
+
+    :param predicate: A condition that rows must satisfy to be kept: see
+    `filter_rows`. To use a process pool, this should be a query string or a
+    function defined at the top level of a module.
+
+    :param chunksize: If not None, the file is read in chunks with this many
+    rows and each chunk is filtered before the next is read, so that rows
+    that are not kept are never all in memory at once.
+
+    :param engine: The parser engine for `pandas.read_csv`. The "pyarrow"
+    engine is often faster but cannot read in chunks.
+
+    """
+    kwargs = {"index_col": None, "usecols": usecols, "dtype": dtype}
+    if chunksize is None:
+        return filter_rows(
+            pd.read_csv(path, engine=engine, **kwargs),
+            predicate,
+        )
+    if engine == "pyarrow":
+        msg = "The pyarrow engine cannot read a csv file in chunks."
+        raise ValueError(msg)
+    with pd.read_csv(path, chunksize=chunksize, engine=engine, **kwargs) as r:
+        chunks = [filter_rows(chunk, predicate) for chunk in r]
+    if len(chunks) == 0:
+        return pd.read_csv(path, nrows=0, **kwargs)
+    return pd.concat(chunks)
+
+
+class DataPreparation(BaseModel):
+    """A way of preparing data from some raw data files.
+
+    :param name: A string identifying the preparation
+
+    :param func: A function that takes one dataframe per raw data file, in the
+    same order as `raw_files`, and returns a PreparedData object. To use a
+    process pool this must be defined at the top level of a module.
+
+    :param raw_files: Paths to the raw data files
+
+    :param reader: A function that reads a raw data file into a dataframe, or
+    a list of such functions, one per raw data file. The default reads a whole
+    csv file: see `read_raw_csv` for how to read only some rows and columns.
+
+    :param dependencies: Other files or directories that the preparation's
+    output depends on, e.g. modules with helper functions or schemas that are
+    used by `func` or `reader` but defined elsewhere. Only the source code of
+    the modules where `func` and `reader` are defined is included in the
+    preparation's fingerprint automatically.
+
+    """
+
+    name: str
+    func: Callable[..., PreparedData]
+    raw_files: list[Path]
+    reader: Reader | list[Reader] = read_raw_csv
+    dependencies: list[Path] = Field(default_factory=list)
+
+    @model_validator(mode="after")
+    def check_readers(self) -> DataPreparation:
+        """Check that there is a reader for every raw data file."""
+        if isinstance(self.reader, list) and len(self.reader) != len(
+            self.raw_files,
+        ):
+            msg = (
+                f"Preparation {self.name} has {len(self.raw_files)} raw files"
+                f" but {len(self.reader)} readers."
+            )
+            raise ValueError(msg)
+        return self
+
+    def get_readers(self) -> list[Reader]:
+        """Get the reader for each raw data file."""
+        if isinstance(self.reader, list):
+            return self.reader
+        return [self.reader] * len(self.raw_files)
+
+
+def file_hash(path: Path) -> str:
+    """Get the sha256 hash of a file's contents."""
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def get_raw_cache_path(
+    path: Path,
+    reader: Callable[[Path], pd.DataFrame],
+    cache_dir: Path,
+    raw_hash: str | None = None,
+) -> Path:
+    """Get the path where a parsed raw table is cached.
+
+    :param path: A raw data file
+
+    :param reader: The function that parses the file
+
+    :param cache_dir: A cache directory
+
+    :param raw_hash: The hash of the raw data file, if already known.
+
+    """
+    h = hashlib.sha256((raw_hash or file_hash(path)).encode())
+    h.update(function_fingerprint(reader).encode())
+    return (
+        cache_dir
+        / RAW_CACHE_DIR
+        / f"{get_raw_cache_prefix(path, reader)}{h.hexdigest()[:16]}.pkl"
+    )
+
+
+def get_raw_cache_prefix(
+    path: Path,
+    reader: Callable[[Path], pd.DataFrame],
+) -> str:
+    """Get the start of the names of a raw table's cached versions.
+
+    Tables read from the same file by different readers have different
+    prefixes, so that caching one never evicts the other.
+
+    :param path: A raw data file
+
+    :param reader: The function that parses the file
+
+    """
+    h = hashlib.sha256(str(path.resolve()).encode())
+    h.update(function_fingerprint(reader).encode())
+    return f"{path.stem}-{h.hexdigest()[:8]}-"
+
+
+def cache_raw_table(
+    path: Path,
+    reader: Callable[[Path], pd.DataFrame],
+    cache_dir: Path,
+    raw_hash: str | None = None,
+) -> Path:
+    """Make sure that a raw table is cached and return the cache path.
+
+    Out of date cached tables for the same file and reader are removed.
+
+    :param path: A raw data file
+
+    :param reader: The function that parses the file
+
+    :param cache_dir: A cache directory
+
+    :param raw_hash: The hash of the raw data file, if already known.
+
+    """
+    cache_path = get_raw_cache_path(path, reader, cache_dir, raw_hash)
+    if cache_path.exists():
+        return cache_path
+    logging.info("Parsing raw data file %s", path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    df = reader(path)
+    # write to a temporary file first so that other processes never see a
+    # partly written table
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    df.to_pickle(tmp_path)
+    tmp_path.replace(cache_path)
+    prefix = get_raw_cache_prefix(path, reader)
+    for stale in cache_path.parent.glob(f"{prefix}*.pkl"):
+        if stale != cache_path:
+            stale.unlink(missing_ok=True)
+    return cache_path
+
+
+def read_raw_table(
+    path: Path,
+    reader: Callable[[Path], pd.DataFrame],
+    cache_dir: Path,
+    raw_hash: str | None = None,
+) -> pd.DataFrame:
+    """Read a raw table, from the cache if possible.
+
+    If the cached table disappears before it can be read, e.g. because
+    another process found it out of date, the file is parsed again.
+
+    :param path: A raw data file
+
+    :param reader: The function that parses the file
+
+    :param cache_dir: A cache directory
+
+    :param raw_hash: The hash of the raw data file, if already known.
+
+    """
+    cache_path = cache_raw_table(path, reader, cache_dir, raw_hash)
+    try:
+        return pd.read_pickle(cache_path)  # noqa: S301
+    except FileNotFoundError:
+        logging.info("Cached table %s was removed, parsing again", cache_path)
+        return reader(path)
+
+
+def get_preparation_fingerprint(
+    preparation: DataPreparation,
+    raw_hashes: dict[Path, str],
+    prepared_data_format: PreparedDataFormat,
+) -> str:
+    """Get a hash of everything that a preparation's output depends on.
+
+    :param preparation: A DataPreparation object
+
+    :param raw_hashes: Map from raw data files to their hashes
+
+    :param prepared_data_format: Format in which the output is saved.
+
+    """
+    h = hashlib.sha256(preparation.name.encode())
+    for path in preparation.raw_files:
+        h.update(raw_hashes[path].encode())
+    h.update(function_fingerprint(preparation.func).encode())
+    for reader in preparation.get_readers():
+        h.update(function_fingerprint(reader).encode())
+    for path in preparation.dependencies:
+        h.update(path_fingerprint(path).encode())
+    h.update(prepared_data_format.value.encode())
+    return h.hexdigest()
+
+
+def run_data_preparation(
+    preparation: DataPreparation,
+    prepared_dir: Path,
+    cache_dir: Path,
+    prepared_data_format: PreparedDataFormat = PreparedDataFormat.json,
+    raw_hashes: dict[Path, str] | None = None,
+) -> Path:
+    """Run a data preparation, save the result and return where it was saved.
+
+    :param preparation: A DataPreparation object
+
+    :param prepared_dir: Directory for prepared data
+
+    :param cache_dir: Directory for cached raw tables
+
+    :param prepared_data_format: Format in which to save the prepared data.
+
+    :param raw_hashes: Map from raw data files to their hashes, if known.
+
+    """
+    raw_hashes = raw_hashes or {}
+    logging.info("Preparing data %s", preparation.name)
+    tables = [
+        read_raw_table(path, reader, cache_dir, raw_hashes.get(path))
+        for path, reader in zip(
+            preparation.raw_files,
+            preparation.get_readers(),
+            strict=True,
+        )
+    ]
+    prepared_data = preparation.func(*tables)
+    return save_prepared_data(prepared_data, prepared_dir, prepared_data_format)
+
+
+def load_preparation_fingerprints(cache_dir: Path) -> dict[str, dict[str, str]]:
+    """Load the fingerprints and output paths of previous preparations."""
+    path = cache_dir / PREPARATION_FINGERPRINT_FILE
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def is_up_to_date(saved: dict[str, str] | None, fingerprint: str) -> bool:
+    """Check if a preparation's saved output matches its fingerprint.
+
+    :param saved: The preparation's saved fingerprint and output path, if any.
+
+    :param fingerprint: The preparation's current fingerprint
+
+    """
+    return (
+        saved is not None
+        and saved["fingerprint"] == fingerprint
+        and Path(saved["path"]).exists()
+    )
+
+
+def run_serially(
+    preparations: list[DataPreparation],
+    *args: Any,  # noqa: ANN401
+) -> tuple[dict[str, Path], list[str]]:
+    """Run data preparations one after another in the current process.
+
+    :param preparations: DataPreparation objects to run
+
+    :param args: Other arguments to `run_data_preparation`.
+
+    Returns a map from names to output paths and a list of failures.
+
+    """
+    outputs, failures = {}, []
+    for prep in preparations:
+        try:
+            outputs[prep.name] = run_data_preparation(prep, *args)
+        except Exception:
+            logging.exception("Data preparation %s failed", prep.name)
+            failures.append(prep.name)
+    return outputs, failures
+
+
+def run_in_process_pool(
+    preparations: list[DataPreparation],
+    max_workers: int,
+    *args: Any,  # noqa: ANN401
+) -> tuple[dict[str, Path], list[str]]:
+    """Run data preparations in a process pool.
+
+    All the raw tables are parsed and cached first, so that tables that
+    several preparations share are only parsed once.
+
+    :param preparations: DataPreparation objects to run
+
+    :param max_workers: Number of worker processes
+
+    :param args: Other arguments to `run_data_preparation`.
+
+    Returns a map from names to output paths and a list of failures.
+
+    """
+    _, cache_dir, _, raw_hashes = args
+    raw_tables = {
+        (path, reader)
+        for prep in preparations
+        for path, reader in zip(prep.raw_files, prep.get_readers(), strict=True)
+    }
+    outputs, failures = {}, []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        cache_futures = [
+            executor.submit(
+                cache_raw_table,
+                path,
+                reader,
+                cache_dir,
+                raw_hashes[path],
+            )
+            for path, reader in raw_tables
+        ]
+        for future in as_completed(cache_futures):
+            # errors are raised again when a preparation reads the file
+            if future.exception() is not None:
+                logging.error("Parsing raw data failed: %s", future.exception())
+        futures = {
+            executor.submit(run_data_preparation, prep, *args): prep
+            for prep in preparations
+        }
+        for future in as_completed(futures):
+            prep = futures[future]
+            try:
+                outputs[prep.name] = future.result()
+            except Exception:
+                logging.exception("Data preparation %s failed", prep.name)
+                failures.append(prep.name)
+    return outputs, failures
+
+
+def run_data_preparations(  # noqa: PLR0913
+    preparations: list[DataPreparation],
+    prepared_dir: Path,
+    cache_dir: Path | None = None,
+    prepared_data_format: PreparedDataFormat = PreparedDataFormat.json,
+    max_workers: int | None = None,
+    *,
+    skip_up_to_date: bool = True,
+) -> None:
+    """Run some data preparations, skipping those that are up to date.
+
+    As in `bibat.fitting.run_all_inferences`, an error in one preparation is
+    logged and does not stop the others from running. If any preparations
+    fail, a RuntimeError listing them is raised at the end.
+
+    :param preparations: DataPreparation objects with different names
+
+    :param prepared_dir: Directory for prepared data
+
+    :param cache_dir: Directory for cached raw tables and fingerprints. By
+    default this is a folder called `.cache` in `prepared_dir`.
+
+    :param prepared_data_format: Format in which to save the prepared data.
+
+    :param max_workers: Number of worker processes to use. If this is None or
+    1, preparations run one after another in the current process. Otherwise
+    raw files are first parsed and cached in a process pool with this many
+    workers, then the preparations are run in the same pool.
+
+    :param skip_up_to_date: If True, preparations whose fingerprints have not
+    changed since their output was saved are not run again. A fingerprint
+    only covers the raw files, the modules where a preparation's function and
+    readers are defined and the preparation's `dependencies`, so changes to
+    code elsewhere, e.g. helpers or schemas imported from another module, go
+    unnoticed unless that code is listed in `dependencies`.
+
+    """
+    cache_dir = cache_dir or prepared_dir / CACHE_DIR
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    raw_hashes = {
+        path: file_hash(path)
+        for path in {p for prep in preparations for p in prep.raw_files}
+    }
+    saved = load_preparation_fingerprints(cache_dir)
+    fingerprints = {
+        prep.name: get_preparation_fingerprint(
+            prep,
+            raw_hashes,
+            prepared_data_format,
+        )
+        for prep in preparations
+    }
+    to_run = [
+        prep
+        for prep in preparations
+        if not (
+            skip_up_to_date
+            and is_up_to_date(saved.get(prep.name), fingerprints[prep.name])
+        )
+    ]
+    for prep in preparations:
+        if prep not in to_run:
+            logging.info("Prepared data %s is up to date", prep.name)
+    args = (prepared_dir, cache_dir, prepared_data_format, raw_hashes)
+    if max_workers is None or max_workers == 1:
+        outputs, failures = run_serially(to_run, *args)
+    else:
+        outputs, failures = run_in_process_pool(to_run, max_workers, *args)
+    saved.update(
+        {
+            name: {"fingerprint": fingerprints[name], "path": str(path)}
+            for name, path in outputs.items()
+        },
+    )
+    (cache_dir / PREPARATION_FINGERPRINT_FILE).write_text(
+        json.dumps(saved, indent=2, sort_keys=True),
+    )
+    if len(failures) > 0:
+        msg = f"The following data preparations failed: {sorted(failures)}."
+        raise RuntimeError(msg)
@@ -0,0 +1,181 @@
+"""Provides fingerprints for deciding whether an inference needs re-fitting.
+
+A fingerprint is a hash of everything that a fitting mode's results depend on:
+the inference configuration (apart from the options for saving the results),
+the prepared data file, the Stan program and its included files, the source
+code of the Stan input function and the fitting mode's own function.
+Fingerprints are stored per fitting mode in a json file inside the inference
+directory, so that adding a new mode to an inference's configuration only
+requires that mode to be run.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+from functools import partial
+from typing import TYPE_CHECKING
+
+from bibat.stan_model import STAN_DIR, stan_model_hash
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+    from bibat.fitting_mode import FittingMode
+    from bibat.inference_configuration import InferenceConfiguration
+
+FINGERPRINT_FILE = "fingerprints.json"
+
+
+def function_fingerprint(func: Callable) -> str:
+    """Get a hash identifying a function.
+
+    The hash depends on the function's name and the source code of the module
+    where it is defined, so that changes to helper functions in the same
+    module are also noticed. If the source code is not available, only the
+    name is used. For a `functools.partial` object, the hash also depends on
+    its arguments: the fingerprints of any functions, and the representations
+    of anything else.
+
+    :param func: A function
+
+    """
+    if isinstance(func, partial):
+        h = hashlib.sha256(function_fingerprint(func.func).encode())
+        arguments = [*enumerate(func.args), *sorted(func.keywords.items())]
+        for key, value in arguments:
+            v = function_fingerprint(value) if callable(value) else repr(value)
+            h.update(f"{key}={v}".encode())
+        return h.hexdigest()
+    func = inspect.unwrap(func)
+    h = hashlib.sha256()
+    h.update(f"{func.__module__}.{func.__qualname__}".encode())
+    try:
+        module = inspect.getmodule(func)
+        source = inspect.getsource(module if module is not None else func)
+    except (OSError, TypeError):
+        source = ""
+    h.update(source.encode())
+    return h.hexdigest()
+
+
+def path_fingerprint(path: Path) -> str:
+    """Get a hash of the contents of a file, or of all files in a directory.
+
+    :param path: A file or directory
+
+    """
+    h = hashlib.sha256()
+    files = sorted(p for p in path.rglob("*") if p.is_file())
+    for file in files if path.is_dir() else [path]:
+        h.update(file.relative_to(path).as_posix().encode())
+        h.update(file.read_bytes())
+    return h.hexdigest()
+
+
+def data_fingerprint(
+    ic: InferenceConfiguration,
+    prepared_data_path: Path,
+    local_functions: dict[str, Callable],
+) -> str:
+    """Get a hash of everything that an inference's Stan input depends on.
+
+    This covers the prepared data, the Stan input function and the dims used
+    to label the observed data, but not the Stan program or fitting modes.
+
+    :param ic: An InferenceConfiguration object
+
+    :param prepared_data_path: The file or directory containing the
+    inference's prepared data.
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    """
+    h = hashlib.sha256(path_fingerprint(prepared_data_path).encode())
+    sif = local_functions[ic.stan_input_function]
+    h.update(ic.stan_input_function.encode())
+    h.update(function_fingerprint(sif).encode())
+    h.update(json.dumps(ic.dims, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def get_fingerprints(
+    ic: InferenceConfiguration,
+    prepared_data_path: Path,
+    fitting_mode_options: dict[str, FittingMode],
+    local_functions: dict[str, Callable],
+) -> dict[str, str]:
+    """Get a fingerprint for each of an inference's fitting modes.
+
+    :param ic: An InferenceConfiguration object
+
+    :param prepared_data_path: The file or directory containing the
+    inference's prepared data.
+
+    :param fitting_mode_options: Dictionary mapping names to FittingMode
+    objects.
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    """
+    config = ic.model_dump(
+        exclude={"fitting_modes", "mode_options", "idata_save_options"},
+    )
+    common = hashlib.sha256()
+    common.update(json.dumps(config, sort_keys=True, default=str).encode())
+    common.update(path_fingerprint(prepared_data_path).encode())
+    common.update(
+        stan_model_hash(
+            STAN_DIR / ic.stan_file,
+            cpp_options=ic.cpp_options,
+            stanc_options=ic.stanc_options,
+        ).encode(),
+    )
+    sif = local_functions[ic.stan_input_function]
+    common.update(function_fingerprint(sif).encode())
+    out = {}
+    for mode_name in ic.fitting_modes:
+        h = common.copy()
+        mode = fitting_mode_options[mode_name]
+        mode_options = ic.mode_options.get(mode_name)
+        h.update(mode_name.encode())
+        h.update(
+            json.dumps(mode_options, sort_keys=True, default=str).encode(),
+        )
+        h.update(function_fingerprint(mode.fit).encode())
+        out[mode_name] = h.hexdigest()
+    return out
+
+
+def load_fingerprints(inference_dir: Path) -> dict[str, str]:
+    """Load the stored fingerprints for an inference, if there are any.
+
+    :param inference_dir: An inference directory
+
+    """
+    path = inference_dir / FINGERPRINT_FILE
+    if not path.exists():
+        return {}
+    with path.open("r") as f:
+        return json.load(f)
+
+
+def save_fingerprints(
+    inference_dir: Path,
+    fingerprints: dict[str, str],
+) -> None:
+    """Save an inference's fingerprints.
+
+    :param inference_dir: An inference directory
+
+    :param fingerprints: Dictionary mapping fitting mode names to fingerprints
+
+    """
+    path = inference_dir / FINGERPRINT_FILE
+    with path.open("w") as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
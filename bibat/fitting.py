@@ -1,25 +1,82 @@
 """Functions for running inferences."""
 
 import logging
-from collections.abc import Callable
-from enum import Enum
+import math
+import multiprocessing
+import queue
+import shutil
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing.queues import Queue
 from pathlib import Path
+from types import TracebackType
+from typing import Any, Self
 
 import arviz as az
+import numcodecs
+import xarray as xr
+import zarr
 
-from bibat.fitting_mode import FittingMode
+from bibat.checkpoint import (
+    Checkpoint,
+    checkpoint_scope,
+    checkpointing,
+    clear_checkpoint,
+    get_checkpoint_dir,
+    load_checkpoint,
+    save_checkpoint,
+    start_checkpoint,
+)
+from bibat.fingerprint import (
+    data_fingerprint,
+    get_fingerprints,
+    load_fingerprints,
+    save_fingerprints,
+)
+from bibat.fitting_mode import FittingMode, posterior_llik
 from bibat.inference_configuration import (
+    IdataCompressor,
+    IdataSaveFormat,
+    IdataSaveOptions,
     InferenceConfiguration,
     load_inference_configuration,
 )
-from bibat.prepared_data import PreparedData
-
-
-class IdataSaveFormat(str, Enum):
-    """An enum for choosing the format in which inferences are saved."""
+from bibat.prepared_data import PreparedData, get_prepared_data_path
+from bibat.profiling import (
+    PROFILE_FILE,
+    InferenceProfile,
+    get_resource_usage,
+    make_run_profile,
+    profile_stage,
+    profiling,
+    save_inference_profile,
+    save_run_profile,
+)
+from bibat.scheduling import (
+    allocate_cores,
+    core_budget,
+    get_core_budget,
+    set_core_budget,
+)
+from bibat.stan_input import get_stan_input
+from bibat.util import CoordDict
+from bibat.work_queue import (
+    DEFAULT_STALE_AFTER,
+    DONE,
+    FAILED,
+    Task,
+    TaskKind,
+    enqueue,
+    get_tasks,
+    new_run_id,
+    run_worker,
+    save_run,
+)
 
-    zarr = "prior"
-    json = "json"
+SHARE_TIMEOUT = 60.0
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3  # noqa: PLR2004
 
 
 def run_all_inferences(  # noqa: PLR0913
@@ -29,26 +86,993 @@ def run_all_inferences(  # noqa: PLR0913
     loader: Callable[[Path], PreparedData],
     local_functions: dict[str, Callable],
     idata_save_format: IdataSaveFormat = IdataSaveFormat.zarr,
+    max_workers: int | None = None,
+    *,
+    skip_up_to_date: bool = False,
+    idata_save_options: IdataSaveOptions | None = None,
+    profile: bool = False,
+    cores: int | None = None,
+    resume: bool = False,
+    queue_dir: Path | None = None,
+) -> None:
+    """Fit all inferences in all modes.
+
+    Inferences are isolated from each other, so that an error in one inference
+    is logged and does not stop the others from running. If any inferences
+    fail, a RuntimeError listing them is raised once all inferences have been
+    attempted.
+
+    :param max_workers: Number of worker processes to use. If this is None or
+    1, inferences are run one after another in the current process. Otherwise
+    each inference directory is dispatched to a process pool with this many
+    workers, in which case the loader and local functions must be picklable,
+    i.e. defined at the top level of a module.
+
+    :param skip_up_to_date: If True, fitting modes whose results are already
+    saved and whose fingerprints (see `bibat.fingerprint`) have not changed
+    are not run again.
+
+    :param idata_save_options: Default options for saving InferenceData
+    objects. If this is given, `idata_save_format` is ignored. Each inference
+    can override these defaults in an `idata_save_options` table in its
+    config.toml file.
+
+    :param profile: If True, each inference's stages are profiled and the
+    profiles are saved to files called `profile.json` in each inference
+    directory and in the inferences directory: see `bibat.profiling`.
+
+    :param cores: Total number of CPU cores to use. If this is given, the
+    cores are shared between the inferences that run at the same time, the
+    inferences that took longest last time start first, and each fit's
+    `parallel_chains` and `threads_per_chain` are chosen to fit its share:
+    see `schedule_inferences` and `bibat.scheduling`.
+
+    :param resume: If True, each inference saves checkpoints as it runs and
+    resumes from any checkpoints left by an earlier run that was interrupted:
+    see `bibat.checkpoint`.
+
+    :param queue_dir: If given, the inferences are split into tasks in a work
+    queue in this folder, which `max_workers` local worker processes then
+    run, each with an equal share of `cores`. Fitting modes that can be split
+    into pieces, like k-fold cross-validation, get a task for each piece, and
+    workers on other hosts that share the folder can help by running the
+    command `bibat worker <queue_dir>`. Queued inferences always save
+    checkpoints, as if `resume` were True: see `bibat.work_queue`.
+
+    """
+    start = get_resource_usage()
+    inference_dirs = sorted(d for d in inferences_dir.iterdir() if d.is_dir())
+    kwargs = {
+        "data_dir": data_dir,
+        "fitting_mode_options": fitting_mode_options,
+        "loader": loader,
+        "local_functions": local_functions,
+        "idata_save_format": idata_save_format,
+        "skip_up_to_date": skip_up_to_date,
+        "idata_save_options": idata_save_options,
+        "profile": profile,
+        "resume": resume,
+    }
+    ordered, shares = schedule_inferences(inference_dirs, cores, max_workers)
+    if queue_dir is not None:
+        del kwargs["resume"]
+        failures, profiles = run_queued_inferences(
+            queue_dir,
+            ordered,
+            kwargs,
+            max_workers,
+            cores,
+        )
+    else:
+        failures, profiles = run_scheduled_inferences(
+            ordered,
+            shares,
+            kwargs,
+            max_workers,
+        )
+    if profile:
+        save_run_profile(inferences_dir, make_run_profile(start, profiles))
+    if len(failures) > 0:
+        msg = f"The following inferences failed: {sorted(failures)}."
+        raise RuntimeError(msg)
+
+
+def run_scheduled_inferences(
+    inference_dirs: list[Path],
+    shares: list[int | None],
+    run_kwargs: dict[str, Any],
+    max_workers: int | None,
+) -> tuple[list[str], list[InferenceProfile | None]]:
+    """Run some inferences in the current process or a process pool.
+
+    Returns the names of the inferences that failed and the profiles of the
+    others, as returned by `run_and_save_inference`.
+
+    :param inference_dirs: The inferences' directories, in the order returned
+    by `schedule_inferences`.
+
+    :param shares: The cores for each worker slot, as returned by
+    `schedule_inferences`. Each worker process keeps one slot's share for its
+    whole life, so the inferences that run at the same time never use more
+    cores than the slots have between them.
+
+    :param run_kwargs: Keyword arguments for `run_and_save_inference`
+
+    :param max_workers: Number of worker processes, as for
+    `run_all_inferences`.
+
+    """
+    failures: list[str] = []
+    profiles: list[InferenceProfile | None] = []
+    if max_workers is None or max_workers == 1:
+        for inference_dir in inference_dirs:
+            try:
+                inference_profile = run_and_save_inference(
+                    inference_dir,
+                    **run_kwargs,
+                    cores=shares[0],
+                )
+            except Exception:
+                logging.exception("Inference %s failed", inference_dir.name)
+                failures.append(inference_dir.name)
+            else:
+                profiles.append(inference_profile)
+    else:
+        with make_worker_pool(shares) as executor:
+            futures = {
+                executor.submit(run_in_worker_slot, d, run_kwargs): d
+                for d in inference_dirs
+            }
+            for future in as_completed(futures):
+                inference_dir = futures[future]
+                try:
+                    inference_profile = future.result()
+                except Exception:
+                    logging.exception("Inference %s failed", inference_dir.name)
+                    failures.append(inference_dir.name)
+                else:
+                    profiles.append(inference_profile)
+    return failures, profiles
+
+
+def make_worker_pool(shares: list[int | None]) -> ProcessPoolExecutor:
+    """Make a process pool with one worker for each worker slot's share.
+
+    :param shares: The cores for each worker slot, as returned by
+    `schedule_inferences`.
+
+    """
+    share_queue: Queue = multiprocessing.Queue()
+    for share in shares:
+        share_queue.put(share)
+    return ProcessPoolExecutor(
+        max_workers=len(shares),
+        initializer=init_worker_slot,
+        initargs=(share_queue,),
+    )
+
+
+def init_worker_slot(shares: Queue, timeout: float = SHARE_TIMEOUT) -> None:
+    """Give a new worker process one worker slot's share of the cores.
+
+    The share becomes the process's core budget: see `bibat.scheduling`.
+
+    :param shares: A queue with one share for each worker process.
+
+    :param timeout: Number of seconds to wait for a share. The shares are put
+    in the queue before the pool starts, but may take a moment to arrive.
+
+    """
+    try:
+        share = shares.get(timeout=timeout)
+    except queue.Empty as e:
+        msg = f"No share of the cores arrived within {timeout} seconds."
+        raise RuntimeError(msg) from e
+    set_core_budget(share)
+
+
+def run_in_worker_slot(
+    inference_dir: Path,
+    run_kwargs: dict[str, Any],
+) -> InferenceProfile | None:
+    """Run an inference with the cores of the current worker process's slot."""
+    return run_and_save_inference(
+        inference_dir,
+        **run_kwargs,
+        cores=get_core_budget(),
+    )
+
+
+def run_and_save_inference(  # noqa: PLR0913
+    inference_dir: Path,
+    data_dir: Path,
+    fitting_mode_options: dict[str, FittingMode],
+    loader: Callable[[Path], PreparedData],
+    local_functions: dict[str, Callable],
+    idata_save_format: IdataSaveFormat = IdataSaveFormat.zarr,
+    *,
+    skip_up_to_date: bool = False,
+    idata_save_options: IdataSaveOptions | None = None,
+    profile: bool = False,
+    cores: int | None = None,
+    resume: bool = False,
+) -> InferenceProfile | None:
+    """Fit the inference in a directory and save the results there.
+
+    :param skip_up_to_date: If True, only run the fitting modes whose
+    fingerprints have changed since they were last saved, reusing the saved
+    results for the other modes. If all modes are up to date the inference is
+    skipped.
+
+    :param idata_save_options: Default options for saving the InferenceData
+    object, overriding `idata_save_format`.
+
+    :param profile: If True, the inference is profiled, its profile is saved
+    in the inference directory and returned. Otherwise nothing is recorded
+    and None is returned.
+
+    :param cores: Number of CPU cores that the inference can use, or None for
+    no limit: see `bibat.scheduling`.
+
+    :param resume: If True, save checkpoints and resume from any saved by an
+    earlier run: see `bibat.checkpoint`.
+
+    """
+    ic = load_inference_configuration(inference_dir)
+    save_options = get_idata_save_options(
+        ic,
+        idata_save_options or IdataSaveOptions(save_format=idata_save_format),
+    )
+    prepared_data_path = get_prepared_data_path(data_dir, ic.prepared_data)
+    fingerprints = get_fingerprints(
+        ic,
+        prepared_data_path,
+        fitting_mode_options,
+        local_functions,
+    )
+    previous_idata = None
+    modes_to_run = ic.fitting_modes
+    if skip_up_to_date:
+        modes_to_run, previous_idata = get_out_of_date_modes(
+            ic,
+            inference_dir,
+            save_options.save_format,
+            fingerprints,
+        )
+        if len(modes_to_run) == 0:
+            logging.info("Inference %s is up to date", ic.name)
+            return None
+    checkpoint = (
+        start_checkpoint(
+            inference_dir,
+            fingerprints,
+            data_fingerprint(ic, prepared_data_path, local_functions),
+        )
+        if resume
+        else None
+    )
+    with (
+        profiling(ic.name) if profile else nullcontext() as profiler,
+        core_budget(cores),
+        checkpointing(get_checkpoint_dir(inference_dir) if resume else None),
+    ):
+        with profile_stage("load_data"):
+            prepared_data = loader(prepared_data_path)
+        with IdataWriter(
+            inference_dir,
+            save_options,
+            resume=resume,
+            keep=(
+                None if checkpoint is None else checkpoint.get_kept_variables()
+            ),
+        ) as writer:
+            completed = get_completed_modes(checkpoint, writer)
+            for mode_name, mode_idata in iter_named_inference(
+                ic,
+                prepared_data,
+                fitting_mode_options,
+                local_functions,
+                modes=[m for m in modes_to_run if m not in completed],
+            ):
+                with profile_stage("save"):
+                    writer.write(mode_idata)
+                if checkpoint is not None and mode_name is not None:
+                    checkpoint.complete_mode(
+                        mode_name,
+                        {
+                            group: list(mode_idata[group].data_vars)
+                            for group in mode_idata.groups()
+                        },
+                    )
+                    save_checkpoint(inference_dir, checkpoint)
+            if previous_idata is not None:
+                with profile_stage("save"):
+                    for mode_name in ic.fitting_modes:
+                        if mode_name not in modes_to_run:
+                            mode = fitting_mode_options[mode_name]
+                            writer.write(get_mode_idata(previous_idata, mode))
+    save_fingerprints(inference_dir, fingerprints)
+    if resume:
+        clear_checkpoint(inference_dir)
+    if profiler is None:
+        return None
+    inference_profile = profiler.finish()
+    save_inference_profile(inference_dir, inference_profile)
+    return inference_profile
+
+
+def get_out_of_date_modes(
+    ic: InferenceConfiguration,
+    inference_dir: Path,
+    idata_save_format: IdataSaveFormat,
+    fingerprints: dict[str, str],
+) -> tuple[list[str], az.InferenceData | None]:
+    """Find the modes whose fingerprints have changed since they were saved.
+
+    Returns the names of these modes and the saved InferenceData, loaded
+    lazily. If there is no saved InferenceData, all modes are out of date.
+
+    """
+    previous_idata = load_idata(inference_dir, idata_save_format, lazy=True)
+    if previous_idata is None:
+        return ic.fitting_modes, None
+    saved_fingerprints = load_fingerprints(inference_dir)
+    modes = [
+        m
+        for m in ic.fitting_modes
+        if saved_fingerprints.get(m) != fingerprints[m]
+    ]
+    return modes, previous_idata
+
+
+def enqueue_inferences(
+    queue_dir: Path,
+    inference_dirs: list[Path],
+    run_kwargs: dict[str, Any],
+) -> str:
+    """Add tasks for some inferences to a work queue.
+
+    Each inference gets one task that runs it with checkpoints, as
+    `run_and_save_inference` does with `resume=True`. Fitting modes that can
+    be split into pieces (see `bibat.fitting_mode.FittingMode`) also get a
+    task for each piece, which the inference's task waits for. Returns the id
+    of the new run: see `bibat.work_queue`.
+
+    :param queue_dir: A queue folder
+
+    :param inference_dirs: The inferences' directories
+
+    :param run_kwargs: Keyword arguments for `run_and_save_inference`, which
+    are saved in the queue for the workers to use.
+
+    """
+    run_id = new_run_id()
+    save_run(queue_dir, run_id, run_kwargs)
+    tasks: list[Task] = []
+    for inference_dir in inference_dirs:
+        pieces = get_piece_tasks(inference_dir, run_id, len(tasks), run_kwargs)
+        if pieces is None:
+            continue
+        tasks += pieces
+        tasks.append(
+            Task(
+                id=f"{run_id}-{len(tasks):05d}",
+                run=run_id,
+                kind=TaskKind.inference,
+                inference_dir=inference_dir.resolve(),
+                depends_on=[t.id for t in pieces],
+            ),
+        )
+    enqueue(queue_dir, tasks)
+    return run_id
+
+
+def get_piece_tasks(
+    inference_dir: Path,
+    run_id: str,
+    start: int,
+    run_kwargs: dict[str, Any],
+) -> list[Task] | None:
+    """Get tasks for the pieces of an inference's fitting modes.
+
+    Returns None if the inference is up to date and `skip_up_to_date` is set.
+    Modes that are up to date or already checkpointed get no tasks. The
+    checkpoint is only read here: it is started when the tasks run.
+
+    :param start: Number of tasks in the run so far, used for task ids.
+
+    """
+    ic = load_inference_configuration(inference_dir)
+    fitting_mode_options = run_kwargs["fitting_mode_options"]
+    fingerprints, observed_fingerprint = get_queued_fingerprints(ic, run_kwargs)
+    modes_to_run = ic.fitting_modes
+    if run_kwargs.get("skip_up_to_date", False):
+        save_options = get_idata_save_options(
+            ic,
+            run_kwargs.get("idata_save_options")
+            or IdataSaveOptions(save_format=run_kwargs["idata_save_format"]),
+        )
+        modes_to_run, _ = get_out_of_date_modes(
+            ic,
+            inference_dir,
+            save_options.save_format,
+            fingerprints,
+        )
+        if len(modes_to_run) == 0:
+            logging.info("Inference %s is up to date", ic.name)
+            return None
+    completed = load_checkpoint(inference_dir).get_valid_modes(
+        fingerprints,
+        observed_fingerprint,
+    )
+    tasks = []
+    for mode_name in modes_to_run:
+        mode = fitting_mode_options[mode_name]
+        if mode.n_pieces is None or mode_name in completed:
+            continue
+        for piece in range(mode.n_pieces(ic)):
+            task = Task(
+                id=f"{run_id}-{start + len(tasks):05d}",
+                run=run_id,
+                kind=TaskKind.fit_piece,
+                inference_dir=inference_dir.resolve(),
+                mode=mode_name,
+                piece=piece,
+            )
+            tasks.append(task)
+    return tasks
+
+
+def get_queued_fingerprints(
+    ic: InferenceConfiguration,
+    run_kwargs: dict[str, Any],
+) -> tuple[dict[str, str], str]:
+    """Get an inference's mode and observed data fingerprints for a queue run.
+
+    :param ic: An InferenceConfiguration object
+
+    :param run_kwargs: The keyword arguments saved for the run
+
+    """
+    prepared_data_path = get_prepared_data_path(
+        run_kwargs["data_dir"],
+        ic.prepared_data,
+    )
+    fingerprints = get_fingerprints(
+        ic,
+        prepared_data_path,
+        run_kwargs["fitting_mode_options"],
+        run_kwargs["local_functions"],
+    )
+    observed_fingerprint = data_fingerprint(
+        ic,
+        prepared_data_path,
+        run_kwargs["local_functions"],
+    )
+    return fingerprints, observed_fingerprint
+
+
+def run_queued_task(
+    task: Task,
+    run_kwargs: dict[str, Any],
+    cores: int | None = None,
 ) -> None:
-    """Fit all inferences in all modes."""
-    inference_dirs = inferences_dir.iterdir()
-    for inference_dir in sorted(inference_dirs):
-        ic = load_inference_configuration(inference_dir)
-        prepared_data_json = (data_dir / ic.prepared_data).with_suffix(".json")
-        prepared_data = loader(prepared_data_json)
-        idata = run_inference(
+    """Run a task from a work queue made by `enqueue_inferences`.
+
+    Tasks for pieces of a fitting mode start the inference's checkpoint before
+    fitting, so that draws saved for an out of date mode are never loaded.
+
+    :param task: The task
+
+    :param run_kwargs: The keyword arguments saved for the task's run
+
+    :param cores: Number of CPU cores that the task can use, or None for no
+    limit: see `bibat.scheduling`.
+
+    """
+    if task.kind == TaskKind.inference:
+        run_and_save_inference(
+            task.inference_dir,
+            **run_kwargs,
+            cores=cores,
+            resume=True,
+        )
+        return
+    ic = load_inference_configuration(task.inference_dir)
+    mode = run_kwargs["fitting_mode_options"][task.mode]
+    if mode.fit_piece is None or task.piece is None:
+        msg = f"Fitting mode {task.mode} cannot be split into pieces."
+        raise ValueError(msg)
+    start_checkpoint(
+        task.inference_dir,
+        *get_queued_fingerprints(ic, run_kwargs),
+    )
+    prepared_data_path = get_prepared_data_path(
+        run_kwargs["data_dir"],
+        ic.prepared_data,
+    )
+    prepared_data = run_kwargs["loader"](prepared_data_path)
+    with (
+        core_budget(cores),
+        checkpointing(get_checkpoint_dir(task.inference_dir)),
+        checkpoint_scope(task.mode),
+    ):
+        mode.fit_piece(
             ic,
             prepared_data,
-            fitting_mode_options,
-            local_functions,
+            run_kwargs["local_functions"],
+            task.piece,
         )
-        if idata_save_format == IdataSaveFormat.zarr:
-            idata_dir = inference_dir / "idata"
-            idata.to_zarr(str(idata_dir))
-        else:
-            idata_file = inference_dir / "idata.json"
-            logging.info("Saving idata to %s", idata_file)
-            az.to_json(idata, idata_file)
+
+
+def run_queued_inferences(
+    queue_dir: Path,
+    inference_dirs: list[Path],
+    run_kwargs: dict[str, Any],
+    max_workers: int | None,
+    cores: int | None,
+) -> tuple[list[str], list[InferenceProfile | None]]:
+    """Run some inferences through a work queue, with local workers.
+
+    Workers started elsewhere with the same queue folder, e.g. with the
+    command `bibat worker`, can help. Returns the names of the inferences that
+    failed and, if profiling is on, the profiles of the inferences that ran.
+
+    Tasks whose workers stop responding, e.g. because they were killed, are
+    run again after `bibat.work_queue.DEFAULT_STALE_AFTER` seconds.
+
+    :param max_workers: Number of local worker processes. If this is None or
+    1 the current process is the only local worker.
+
+    :param cores: Total number of CPU cores for the local workers to share.
+
+    """
+    run_id = enqueue_inferences(queue_dir, inference_dirs, run_kwargs)
+    n_workers = max_workers or 1
+    shares = (
+        [None] * n_workers
+        if cores is None
+        else allocate_cores(cores, n_workers)
+    )
+    if n_workers == 1:
+        run_worker(
+            queue_dir,
+            partial(run_queued_task, cores=shares[0]),
+            run_id=run_id,
+            stale_after=DEFAULT_STALE_AFTER,
+        )
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    run_worker,
+                    queue_dir,
+                    partial(run_queued_task, cores=worker_cores),
+                    run_id=run_id,
+                    stale_after=DEFAULT_STALE_AFTER,
+                )
+                for worker_cores in shares
+            ]
+            for future in futures:
+                future.result()
+    failures = []
+    for task in get_tasks(queue_dir, FAILED, run_id):
+        logging.error("Task %s failed: %s", task.id, task.error)
+        if task.kind == TaskKind.inference:
+            failures.append(task.inference_dir.name)
+    profiles: list[InferenceProfile | None] = []
+    if run_kwargs.get("profile", False):
+        profiles = [
+            InferenceProfile.model_validate_json(
+                (task.inference_dir / PROFILE_FILE).read_text(),
+            )
+            for task in get_tasks(queue_dir, DONE, run_id)
+            if task.kind == TaskKind.inference
+            and (task.inference_dir / PROFILE_FILE).exists()
+        ]
+    return failures, profiles
+
+
+def estimate_inference_time(inference_dir: Path) -> float:
+    """Estimate how long an inference will take to run.
+
+    The estimate is the wall-clock time in the inference's saved profile, if
+    there is one (see `bibat.profiling`), and otherwise infinity, so that
+    inferences that have never been profiled are treated as the longest.
+
+    """
+    path = inference_dir / PROFILE_FILE
+    if not path.exists():
+        return math.inf
+    return InferenceProfile.model_validate_json(path.read_text()).wall_time
+
+
+def schedule_inferences(
+    inference_dirs: list[Path],
+    cores: int | None,
+    max_workers: int | None = None,
+) -> tuple[list[Path], list[int | None]]:
+    """Choose the order of some inferences and the cores for each worker slot.
+
+    Returns the ordered inferences and one share of the cores for each of the
+    slots in which inferences run at the same time. Any cores left over go to
+    the first slots. An inference uses the share of whichever slot runs it,
+    so the running inferences never use more than `cores` between them.
+
+    Without a number of cores the order is unchanged and the cores are not
+    limited. Otherwise the inferences are sorted from the longest to the
+    shortest, as estimated by `estimate_inference_time`, so that long
+    inferences do not start last and hold up the whole run.
+
+    :param inference_dirs: The inferences' directories
+
+    :param cores: Total number of cores
+
+    :param max_workers: Number of inferences that run at the same time, as
+    for `run_all_inferences`.
+
+    """
+    n_slots = max(1, min(max_workers or 1, len(inference_dirs)))
+    if cores is None:
+        return inference_dirs, [None] * n_slots
+    ordered = sorted(inference_dirs, key=estimate_inference_time, reverse=True)
+    return ordered, allocate_cores(cores, n_slots)
+
+
+def get_idata_save_options(
+    ic: InferenceConfiguration,
+    default: IdataSaveOptions,
+) -> IdataSaveOptions:
+    """Combine default options with those set in an inference configuration."""
+    if ic.idata_save_options is None:
+        return default
+    update = ic.idata_save_options.model_dump(exclude_unset=True)
+    return IdataSaveOptions(**(default.model_dump() | update))
+
+
+def get_idata_path(
+    inference_dir: Path,
+    idata_save_format: IdataSaveFormat = IdataSaveFormat.zarr,
+) -> Path:
+    """Get the path where an inference's InferenceData object is saved."""
+    if idata_save_format == IdataSaveFormat.zarr:
+        return inference_dir / "idata"
+    if idata_save_format == IdataSaveFormat.netcdf:
+        return inference_dir / "idata.nc"
+    return inference_dir / "idata.json"
+
+
+def find_idata_format(inference_dir: Path) -> IdataSaveFormat | None:
+    """Find the format of the InferenceData saved in an inference directory.
+
+    Returns None if there is no saved InferenceData. If there is more than one,
+    zarr is preferred to netcdf, and netcdf to json.
+
+    """
+    for idata_save_format in IdataSaveFormat:
+        if get_idata_path(inference_dir, idata_save_format).exists():
+            return idata_save_format
+    return None
+
+
+def get_compressor_encoding(
+    save_options: IdataSaveOptions,
+) -> dict[str, Any]:
+    """Get encoding entries for compressing a variable.
+
+    The form of the entries depends on the storage format and, for zarr, on
+    whether zarr version 3 is installed.
+
+    """
+    compressor = save_options.compressor
+    level = save_options.compression_level
+    if compressor is None:
+        return {}
+    if save_options.save_format == IdataSaveFormat.netcdf:
+        if compressor == IdataCompressor.none:
+            return {"zlib": False}
+        return {"zlib": True} | ({} if level is None else {"complevel": level})
+    if compressor == IdataCompressor.none:
+        return {"compressors": None} if ZARR_V3 else {"compressor": None}
+    if ZARR_V3:
+        codecs = {
+            IdataCompressor.zlib: zarr.codecs.GzipCodec,
+            IdataCompressor.zstd: zarr.codecs.ZstdCodec,
+            IdataCompressor.blosc: zarr.codecs.BloscCodec,
+        }
+    else:
+        codecs = {
+            IdataCompressor.zlib: numcodecs.Zlib,
+            IdataCompressor.zstd: numcodecs.Zstd,
+            IdataCompressor.blosc: numcodecs.Blosc,
+        }
+    level_kwarg = "clevel" if compressor == IdataCompressor.blosc else "level"
+    codec = codecs[compressor](
+        **({} if level is None else {level_kwarg: level}),
+    )
+    return {"compressors": [codec]} if ZARR_V3 else {"compressor": codec}
+
+
+def get_encoding(
+    ds: xr.Dataset,
+    save_options: IdataSaveOptions,
+) -> dict[str, dict[str, Any]]:
+    """Get an encoding for saving a dataset's numeric variables.
+
+    :param ds: An xarray Dataset, e.g. one InferenceData group
+
+    :param save_options: An IdataSaveOptions object
+
+    """
+    chunks_key = (
+        "chunks"
+        if save_options.save_format == IdataSaveFormat.zarr
+        else "chunksizes"
+    )
+    compressor_encoding = get_compressor_encoding(save_options)
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        if var.dtype.kind not in "biuf":
+            continue
+        var_encoding = dict(compressor_encoding)
+        if any(dim in save_options.chunks for dim in var.dims):
+            var_encoding[chunks_key] = tuple(
+                max(1, min(save_options.chunks.get(dim, size), size))
+                for dim, size in var.sizes.items()
+            )
+        if len(var_encoding) > 0:
+            encoding[name] = var_encoding
+    return encoding
+
+
+class IdataWriter:
+    """Save an InferenceData object one piece at a time.
+
+    Each group is written to a temporary zarr store as soon as it is passed to
+    `write`, so that an inference's groups never all need to be in memory at
+    the same time. If a group is written twice, its new variables are appended
+    to the stored group, which is only read and rewritten if a variable is
+    replaced or the coordinates differ, as in `merge_idata`. When the writer
+    is closed, the temporary store replaces any existing InferenceData, after
+    being converted one group at a time if the chosen format is netcdf. The
+    json format cannot be written incrementally, so in this case the pieces
+    are merged in memory and saved when the writer is closed.
+
+    Use as a context manager: if an exception is raised, the temporary store is
+    removed and any existing InferenceData is left alone.
+
+    :param inference_dir: Directory to save the InferenceData in.
+
+    :param save_options: Options for saving the InferenceData.
+
+    :param resume: If True, the temporary store is kept if an exception is
+    raised, so that it can be used as a checkpoint: see `bibat.checkpoint`.
+
+    :param keep: When resuming, the variables to keep from a temporary store
+    left by an earlier writer, by group, e.g. those written by modes that
+    completed. Everything else in the store is removed before writing starts,
+    so that new groups are never merged with stale ones. If this is None or
+    empty, the whole store is removed.
+
+    """
+
+    def __init__(
+        self,
+        inference_dir: Path,
+        save_options: IdataSaveOptions | None = None,
+        *,
+        resume: bool = False,
+        keep: dict[str, list[str]] | None = None,
+    ) -> None:
+        """Set up paths without writing anything."""
+        self.save_options = save_options or IdataSaveOptions()
+        self.path = get_idata_path(inference_dir, self.save_options.save_format)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.idata = az.InferenceData()
+        self.written_groups: list[str] = []
+        self.resume = resume
+        self.keep = keep or {}
+
+    def __enter__(self) -> Self:
+        """Start writing, removing or resuming any leftover temporary store."""
+        if self.resume and len(self.keep) > 0 and self.tmp_path.exists():
+            try:
+                self.written_groups = self.prune()
+            except Exception:  # noqa: BLE001
+                logging.warning("Cannot resume from %s", self.tmp_path)
+            else:
+                return self
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        return self
+
+    def prune(self) -> list[str]:
+        """Remove everything but the kept variables from the temporary store.
+
+        Returns the groups that are left.
+
+        """
+        root = zarr.open_group(str(self.tmp_path), mode="a")
+        kept_groups = []
+        for group in list(root.group_keys()):
+            with xr.open_zarr(self.tmp_path, group=group) as ds:
+                variables = [v for v in self.keep.get(group, []) if v in ds]
+                if set(variables) == set(ds.data_vars):
+                    kept_groups.append(group)
+                    continue
+                pruned = ds[variables].load().drop_encoding()
+            del root[group]
+            if len(variables) > 0:
+                pruned.to_zarr(self.tmp_path, group=group, mode="w")
+                kept_groups.append(group)
+        return kept_groups
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Finish writing, or clean up if there was an error."""
+        if exc_type is None:
+            with profile_stage("save"):
+                self.close()
+        elif not self.resume:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def write(self, idata: az.InferenceData) -> None:
+        """Write the groups of an InferenceData object."""
+        save_format = self.save_options.save_format
+        if save_format == IdataSaveFormat.json:
+            merge_idata(self.idata, idata)
+            return
+        for group in idata.groups():
+            ds = idata[group]
+            mode = "w"
+            if group in self.written_groups:
+                with xr.open_zarr(self.tmp_path, group=group) as existing:
+                    if can_append(existing, ds):
+                        ds = ds.drop_vars(
+                            [c for c in ds.coords if c in existing.coords],
+                        )
+                        mode = "a"
+                    else:
+                        merged = existing.load().drop_encoding()
+                        merged.update(ds)
+                        ds = merged
+            else:
+                self.written_groups.append(group)
+            if save_format == IdataSaveFormat.zarr:
+                ds.to_zarr(
+                    self.tmp_path,
+                    group=group,
+                    mode=mode,
+                    consolidated=self.save_options.consolidated,
+                    encoding=get_encoding(ds, self.save_options),
+                )
+            else:
+                ds.to_zarr(self.tmp_path, group=group, mode=mode)
+
+    def close(self) -> None:
+        """Replace any existing InferenceData with the newly written one."""
+        save_format = self.save_options.save_format
+        logging.info("Saving idata to %s", self.path)
+        if save_format == IdataSaveFormat.json:
+            az.to_json(self.idata, self.path)
+            return
+        if not self.tmp_path.exists():
+            return
+        if save_format == IdataSaveFormat.zarr:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.tmp_path.rename(self.path)
+            return
+        part_path = self.path.with_name(self.path.name + ".part")
+        part_path.unlink(missing_ok=True)
+        for group in self.written_groups:
+            with xr.open_zarr(self.tmp_path, group=group) as ds:
+                ds.drop_encoding().to_netcdf(
+                    part_path,
+                    group=group,
+                    mode="a" if part_path.exists() else "w",
+                    encoding=get_encoding(ds, self.save_options),
+                )
+        part_path.replace(self.path)
+        shutil.rmtree(self.tmp_path)
+
+
+def can_append(existing: xr.Dataset, ds: xr.Dataset) -> bool:
+    """Check if a dataset's variables can be appended to a stored dataset.
+
+    This is the case if no variables would be replaced and any shared
+    coordinates are the same.
+
+    :param existing: A dataset opened from a zarr store
+
+    :param ds: A dataset with variables to add
+
+    """
+    if any(v in existing.data_vars for v in ds.data_vars):
+        return False
+    if any(existing.sizes.get(dim, n) != n for dim, n in ds.sizes.items()):
+        return False
+    return all(
+        ds[c].equals(existing[c]) for c in ds.coords if c in existing.coords
+    )
+
+
+def get_completed_modes(
+    checkpoint: Checkpoint | None,
+    writer: IdataWriter,
+) -> list[str]:
+    """Get the modes whose checkpointed results a resumed writer already has.
+
+    The json format has no temporary store, so its modes are never completed.
+
+    """
+    if (
+        checkpoint is None
+        or writer.save_options.save_format == IdataSaveFormat.json
+        or not writer.tmp_path.exists()
+    ):
+        return []
+    for mode_name in checkpoint.completed_modes:
+        logging.info("Mode %s was completed before, skipping it", mode_name)
+    return checkpoint.completed_modes
+
+
+def save_idata(
+    idata: az.InferenceData,
+    inference_dir: Path,
+    idata_save_format: IdataSaveFormat = IdataSaveFormat.zarr,
+    *,
+    idata_save_options: IdataSaveOptions | None = None,
+) -> None:
+    """Save an InferenceData object in an inference directory.
+
+    :param idata_save_options: Options for saving the InferenceData. If this
+    is given, `idata_save_format` is ignored.
+
+    """
+    save_options = idata_save_options or IdataSaveOptions(
+        save_format=idata_save_format,
+    )
+    with IdataWriter(inference_dir, save_options) as writer:
+        writer.write(idata)
+
+
+def load_idata(
+    inference_dir: Path,
+    idata_save_format: IdataSaveFormat = IdataSaveFormat.zarr,
+    *,
+    lazy: bool = False,
+) -> az.InferenceData | None:
+    """Load the InferenceData object saved in an inference directory.
+
+    Returns None if there is no saved InferenceData.
+
+    :param lazy: If False, all groups are loaded into memory, so that the saved
+    files can safely be overwritten afterwards. If True, groups saved in zarr
+    or netcdf format are only read from disk when their values are needed.
+
+    """
+    path = get_idata_path(inference_dir, idata_save_format)
+    if not path.exists():
+        return None
+    if idata_save_format == IdataSaveFormat.json:
+        return az.from_json(path)
+    if idata_save_format == IdataSaveFormat.netcdf:
+        groups = {
+            name.strip("/"): ds
+            for name, ds in xr.open_groups(path).items()
+            if name != "/"
+        }
+    else:
+        groups = {
+            group: xr.open_zarr(path, group=group)
+            for group in zarr.open_group(str(path), mode="r").group_keys()
+        }
+    if not lazy:
+        groups = {group: ds.load() for group, ds in groups.items()}
+    return az.InferenceData(**groups)
 
 
 def run_inference(
@@ -56,27 +1080,174 @@ def run_inference(
     prepared_data: PreparedData,
     fitting_mode_options: dict[str, FittingMode],
     local_functions: dict[str, Callable],
+    modes: list[str] | None = None,
 ) -> az.InferenceData:
-    """Run an inference."""
-    idata_kwargs = {
-        "log_likelihood": "llik",
-        "coords": prepared_data.coords,
-        "dims": ic.dims,
-    }
+    """Run an inference.
+
+    :param modes: Names of the fitting modes to run. By default all the modes
+    in the inference configuration are run.
+
+    """
+    idata = az.InferenceData()
+    for mode_idata in iter_inference(
+        ic,
+        prepared_data,
+        fitting_mode_options,
+        local_functions,
+        modes=modes,
+    ):
+        merge_idata(idata, mode_idata)
+    return idata
+
+
+def iter_inference(
+    ic: InferenceConfiguration,
+    prepared_data: PreparedData,
+    fitting_mode_options: dict[str, FittingMode],
+    local_functions: dict[str, Callable],
+    modes: list[str] | None = None,
+) -> Iterator[az.InferenceData]:
+    """Run an inference, yielding an InferenceData object for each piece.
+
+    The first piece contains the observed data, if the inference has a Stan
+    input function. Each fitting mode then yields its own piece as soon as it
+    finishes, after which its raw output is no longer referenced and can be
+    garbage collected.
+
+    :param modes: Names of the fitting modes to run. By default all the modes
+    in the inference configuration are run.
+
+    """
+    for _, idata in iter_named_inference(
+        ic,
+        prepared_data,
+        fitting_mode_options,
+        local_functions,
+        modes=modes,
+    ):
+        yield idata
+
+
+def iter_named_inference(
+    ic: InferenceConfiguration,
+    prepared_data: PreparedData,
+    fitting_mode_options: dict[str, FittingMode],
+    local_functions: dict[str, Callable],
+    modes: list[str] | None = None,
+) -> Iterator[tuple[str | None, az.InferenceData]]:
+    """Run an inference like `iter_inference`, also yielding mode names.
+
+    The observed data piece is yielded with the name None. Each mode runs in
+    its own checkpoint scope: see `bibat.checkpoint`. Once a posterior mode has
+    run, later modes that use them can reuse its draws of 'llik': see
+    `bibat.fitting_mode.posterior_llik`.
+
+    """
+    coords = prepared_data.coords
+    mode_names = modes if modes is not None else ic.fitting_modes
+    llik = None
     if ic.stan_input_function is not None:
-        idata_kwargs["observed_data"] = local_functions[ic.stan_input_function](
-            prepared_data,
+        stan_input = get_stan_input(ic, prepared_data, local_functions)
+        observed_idata = az.from_cmdstanpy(
+            observed_data=stan_input.input_dict,
+            coords=coords,
+            dims=ic.dims,
         )
-    llik_outputs: dict = {}
-    for mode_name in ic.fitting_modes:
+        yield None, observed_idata
+    for i, mode_name in enumerate(mode_names):
         mode = fitting_mode_options[mode_name]
-        output = mode.fit(ic, prepared_data, local_functions)
-        if mode.idata_target in ["prior", "posterior"]:
-            idata_kwargs[mode.idata_target] = output
-            idata_kwargs[f"{mode.idata_target.value}_predictive"] = "yrep"
-        elif mode.idata_target == "log_likelihood":
-            llik_outputs[f"llik_{mode.name}"] = output
-    idata = az.from_cmdstanpy(**idata_kwargs)
-    for varname, output in llik_outputs.items():
-        idata.log_likelihood[varname] = output
-    return idata
+        with (
+            profile_stage(f"fit:{mode_name}"),
+            checkpoint_scope(mode_name),
+            posterior_llik(llik if mode.uses_posterior_llik else None),
+        ):
+            output = mode.fit(ic, prepared_data, local_functions)
+        with profile_stage(f"idata:{mode_name}"):
+            mode_idata = get_output_idata(mode, output, coords, ic.dims)
+        del output
+        if not any(
+            fitting_mode_options[later].uses_posterior_llik
+            for later in mode_names[i + 1 :]
+        ):
+            llik = None
+        elif (
+            mode.idata_target == "posterior"
+            and "log_likelihood" in mode_idata.groups()
+            and "llik" in mode_idata.log_likelihood
+        ):
+            llik = mode_idata.log_likelihood["llik"].to_numpy()
+        yield mode_name, mode_idata
+
+
+def get_output_idata(
+    mode: FittingMode,
+    output: Any,  # noqa: ANN401
+    coords: CoordDict,
+    dims: dict[str, list[str]],
+) -> az.InferenceData:
+    """Convert the output of a fitting mode to an InferenceData object."""
+    if mode.idata_target == "log_likelihood":
+        return az.InferenceData(
+            log_likelihood=output.to_dataset(name=f"llik_{mode.name}"),
+        )
+    if mode.idata_target == "loo":
+        return az.InferenceData(loo=output)
+    if isinstance(output, az.InferenceData):
+        return output
+    idata_kwargs = {
+        mode.idata_target.value: output,
+        f"{mode.idata_target.value}_predictive": "yrep",
+        "coords": coords,
+        "dims": dims,
+    }
+    if mode.idata_target == "posterior":
+        idata_kwargs["log_likelihood"] = "llik"
+    return az.from_cmdstanpy(**idata_kwargs)
+
+
+def get_mode_idata(
+    idata: az.InferenceData,
+    mode: FittingMode,
+) -> az.InferenceData:
+    """Get the part of an InferenceData object that a fitting mode produced.
+
+    Prior and posterior modes produce whole groups, plus in the case of
+    posterior modes the log likelihood variable 'llik'. Log likelihood modes
+    produce the log likelihood variable 'llik_<mode name>', and loo modes
+    produce the group 'loo'.
+
+    """
+    groups = {}
+    if mode.idata_target == "loo" and "loo" in idata.groups():
+        groups["loo"] = idata.loo
+    if mode.idata_target in ["prior", "posterior"]:
+        target = mode.idata_target.value
+        sample_stats = "sample_stats" + ("_prior" if target == "prior" else "")
+        for group in [target, f"{target}_predictive", sample_stats]:
+            if group in idata.groups():
+                groups[group] = idata[group]
+    llik_var = (
+        "llik" if mode.idata_target == "posterior" else f"llik_{mode.name}"
+    )
+    if (
+        mode.idata_target in ["posterior", "log_likelihood"]
+        and "log_likelihood" in idata.groups()
+        and llik_var in idata.log_likelihood
+    ):
+        groups["log_likelihood"] = idata.log_likelihood[[llik_var]]
+    return az.InferenceData(**groups)
+
+
+def merge_idata(idata: az.InferenceData, other: az.InferenceData) -> None:
+    """Add the groups and variables of one InferenceData object to another.
+
+    Groups that are not already present are added, and variables in groups
+    that are already present are added to the existing group, replacing any
+    variables with the same name.
+
+    """
+    for group in other.groups():
+        if group in idata.groups():
+            idata[group].update(other[group])
+        else:
+            idata.add_groups({group: other[group]})
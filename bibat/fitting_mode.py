@@ -2,18 +2,57 @@
 
 from __future__ import annotations
 
-from collections.abc import Callable  # noqa: TCH003
+from collections.abc import Callable, Iterator  # noqa: TCH003
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
+from functools import partial
 from pathlib import Path
+from typing import Any
 
+import arviz as az
 import numpy as np
 import xarray as xr
-from cmdstanpy import CmdStanMCMC, CmdStanModel
+from cmdstanpy import CmdStanMCMC  # noqa: TCH002
 from pydantic import BaseModel
+from scipy.special import logsumexp
 from sklearn.model_selection import KFold
 
-from bibat.inference_configuration import InferenceConfiguration  # noqa: TCH001
+from bibat.checkpoint import load_fit_checkpoint, save_fit_checkpoint
+from bibat.inference_configuration import (
+    InferenceConfiguration,
+    is_true_option,
+)
 from bibat.prepared_data import PreparedData  # noqa: TCH001
+from bibat.profiling import in_current_context, profile_stage, record_fit
+from bibat.scheduling import (
+    add_parallel_kwargs,
+    get_max_workers,
+    share_core_budget,
+)
+from bibat.stan_input import get_stan_input, get_stan_input_data
+from bibat.stan_model import get_stan_model
+from bibat.warm_start import (
+    DEFAULT_CHAINS,
+    WARM_START_OPTION,
+    add_warm_start,
+    save_warm_start,
+)
+
+KFOLD_OPTIONS = ["n_folds", "max_workers", WARM_START_OPTION]
+LOO_OPTIONS = [
+    "k_threshold",
+    "max_workers",
+    "reuse_posterior",
+    WARM_START_OPTION,
+]
+DEFAULT_K_THRESHOLD = 0.7
+
+_POSTERIOR_LLIK: ContextVar[np.ndarray | None] = ContextVar(
+    "bibat_posterior_llik",
+    default=None,
+)
 
 
 class IdataTarget(str, Enum):
@@ -22,6 +61,7 @@ class IdataTarget(str, Enum):
     prior = "prior"
     posterior = "posterior"
     log_likelihood = "log_likelihood"
+    loo = "loo"
 
 
 class FittingMode(BaseModel):
@@ -40,22 +80,53 @@ class FittingMode(BaseModel):
 
     :param idata_target: A string identifying the
     [`InferenceData`](https://python.arviz.org/en/stable/api/inference_data.html)
-    group that the mode writes to. Must be one of "prior", "posterior" or
-    "log_likelihood".
+    group that the mode writes to. Must be one of "prior", "posterior",
+    "log_likelihood" or "loo".
 
     :param fit: A function that takes in an `InferenceConfiguration` object, a
     `PreparedData` object and a dictionary of local functions, and returns
-    either a CmdStanMCMC object (if the `idata_target` is "prior" or
-    "posterior") or an xarray DataArray object (if the `idata_target` is
-    "log_likelihood")
+    either a CmdStanMCMC or InferenceData object (if the `idata_target` is
+    "prior" or "posterior"), an xarray DataArray object (if the `idata_target`
+    is "log_likelihood") or an xarray Dataset (if the `idata_target` is "loo")
+
+    :param n_pieces: Optionally, a function that takes in an
+    `InferenceConfiguration` object and returns a number of independent pieces
+    of work, like k-fold folds, that can be done separately before `fit` is
+    called, e.g. by the workers of a `bibat.work_queue`. Zero means that the
+    mode cannot currently be split.
+
+    :param fit_piece: A function that does one piece of work, given the same
+    arguments as `fit` plus the index of the piece. It should save its result
+    as a checkpoint (see `bibat.checkpoint`) for `fit` to use.
+
+    :param uses_posterior_llik: Whether `fit` can reuse the draws of 'llik'
+    from an earlier posterior mode: see `posterior_llik`. These draws are only
+    kept in memory while a later mode has this flag.
+
+    Besides the HMC-based modes, this module provides the cheap approximate
+    modes `pathfinder_mode`, `pathfinder_prior_mode`, `laplace_mode` and
+    `optimize_mode`, which are useful for quickly screening many inference
+    configurations. Their results go in the same groups as those of
+    `posterior_mode` or `prior_mode`, so an inference should not use both an
+    approximate mode and the HMC mode with the same target. Their keyword
+    arguments come from the table `mode_options.<mode name>`.
     """
 
     name: str
     idata_target: IdataTarget
     fit: Callable[
         [InferenceConfiguration, PreparedData, dict[str, Callable]],
-        CmdStanMCMC | xr.DataArray,
+        CmdStanMCMC | az.InferenceData | xr.DataArray | xr.Dataset,
     ]
+    n_pieces: Callable[[InferenceConfiguration], int] | None = None
+    fit_piece: (
+        Callable[
+            [InferenceConfiguration, PreparedData, dict[str, Callable], int],
+            Any,
+        ]
+        | None
+    ) = None
+    uses_posterior_llik: bool = False
 
 
 def sample_hmc_prior(
@@ -64,14 +135,21 @@ def sample_hmc_prior(
     local_functions: dict[str, Callable],
 ) -> CmdStanMCMC:
     """Run hmc in prior mode."""
-    sif = local_functions[ic.stan_input_function]
-    input_dict = sif(data) | {"likelihood": 0}
-    stan_file = Path("src") / "stan" / ic.stan_file
-    model = CmdStanModel(stan_file=stan_file)
+    stan_input = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": 0},
+    )
+    model = get_stan_model(ic)
     sample_kwargs = ic.sample_kwargs
     if ic.mode_options is not None and "prior" in ic.mode_options:
-        sample_kwargs |= ic.mode_options["prior"]
-    return model.sample(input_dict, **sample_kwargs)
+        sample_kwargs = sample_kwargs | ic.mode_options["prior"]
+    sample_kwargs = add_parallel_kwargs(ic, sample_kwargs)
+    with profile_stage("sample:prior"):
+        mcmc = model.sample(stan_input, **sample_kwargs)
+    record_fit("prior", mcmc)
+    return mcmc
 
 
 def sample_hmc_posterior(
@@ -79,67 +157,591 @@ def sample_hmc_posterior(
     data: PreparedData,
     local_functions: dict[str, Callable],
 ) -> CmdStanMCMC:
-    """Run hmc in posterior mode."""
-    sif = local_functions[ic.stan_input_function]
-    input_dict = sif(data) | {"likelihood": 1}
-    stan_file = Path("src") / "stan" / ic.stan_file
-    model = CmdStanModel(stan_file=stan_file)
-    sample_kwargs = ic.sample_kwargs
-    if ic.mode_options is not None and "posterior" in ic.mode_options:
-        sample_kwargs |= ic.mode_options["posterior"]
-    return model.sample(input_dict, **sample_kwargs)
+    """Run hmc in posterior mode.
 
+    The sampler's adaptation is saved as a warm start for later runs: see
+    `bibat.warm_start`. If the table `mode_options.posterior` has the entry
+    'warm_start = true', the previous posterior run's warm start is used.
 
-def sample_hmc_kfold(
+    """
+    stan_input = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": 1},
+    )
+    model = get_stan_model(ic)
+    posterior_options = ic.mode_options.get("posterior", {})
+    sample_kwargs = ic.sample_kwargs | {
+        key: v
+        for key, v in posterior_options.items()
+        if key != WARM_START_OPTION
+    }
+    sample_kwargs = add_warm_start(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        posterior_options,
+    )
+    sample_kwargs = add_parallel_kwargs(ic, sample_kwargs)
+    with profile_stage("sample:posterior"):
+        mcmc = model.sample(stan_input, **sample_kwargs)
+    record_fit("posterior", mcmc)
+    save_warm_start(ic, data, local_functions, model, mcmc)
+    return mcmc
+
+
+def get_llik_draws(mcmc: CmdStanMCMC) -> np.ndarray:
+    """Get the draws of the variable 'llik' with shape (chain, draw, llik)."""
+    n_llik = int(np.prod(mcmc.metadata.stan_vars["llik"].dimensions))
+    # the draws of all chains are concatenated, so split them up again
+    return (
+        mcmc.stan_variable("llik", inc_warmup=False)
+        .reshape(mcmc.num_draws_sampling, mcmc.chains, n_llik, order="F")
+        .transpose(1, 0, 2)
+    )
+
+
+def sample_held_out_llik(  # noqa: PLR0913
     ic: InferenceConfiguration,
     data: PreparedData,
     local_functions: dict[str, Callable],
-) -> xr.DataArray:
-    """Do k-fold cross validation, given a CmdStanModel, some data and config.
+    sample_kwargs: dict,
+    full_ix: np.ndarray,
+    ix_train: np.ndarray,
+    ix_test: np.ndarray,
+    name: str,
+) -> np.ndarray:
+    """Sample the log likelihood of some held out observations.
 
-    :param model: a CmdStanModel. It must have a data variables called
-    'likelihood', 'N_train', 'N_test', 'ix_train' and 'ix_test'.
+    The model is fit to the training observations only, and the draws of
+    'llik' for the test observations are returned with shape (chain, draw,
+    test observation).
 
-    :param input_dict: a Stan input dictionary. It doesn't need to have any of
-    the required variables set (they will be overwritten if they are set).
+    :param sample_kwargs: Keyword arguments for CmdStanModel.sample. If there
+    is an 'output_dir', the output is written to a subdirectory called `name`.
 
-    :param kwargs: dictionary with an entry for 'n_folds' that specifies the
-    value of k for k-fold cross-validation, plus keyword arguments for
-    CmdStanModel.sample
+    :param full_ix: Stan indexes of all the observations
+
+    :param ix_train: Positions in `full_ix` of the training observations
+
+    :param ix_test: Positions in `full_ix` of the test observations
+
+    :param name: A name for this fit, e.g. "fold_1". If checkpoints are on
+    (see `bibat.checkpoint`), the draws are saved under this name, and draws
+    that were already saved are returned without sampling.
 
     """
-    k = ic.mode_options["kfold"]["n_folds"]
-    kf = KFold(k, shuffle=True, random_state=1234)
-    sif = local_functions[ic.stan_input_function]
-    input_dict = sif(data) | {"likelihood": 1}
-    stan_file = Path("src") / "stan" / ic.stan_file
-    model = CmdStanModel(stan_file=stan_file)
-    sample_kwargs = ic.sample_kwargs | {
-        k: v for k, v in ic.mode_options["kfold"].items() if k != "n_folds"
-    }
-    lliks_by_fold = []
-    full_ix = np.array(input_dict["ix_train"])
-    for fold, (ix_train, ix_test) in enumerate(kf.split(full_ix)):
-        input_dict_fold = input_dict | {
+    llik = load_fit_checkpoint(name)
+    if llik is not None:
+        return llik
+    stan_input = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={
             "likelihood": 1,
             "N_train": len(ix_train),
             "N_test": len(ix_test),
             "ix_train": full_ix[ix_train].tolist(),
             "ix_test": full_ix[ix_test].tolist(),
-        }
-        mcmc = model.sample(data=input_dict_fold, **sample_kwargs)
-        llik_fold = mcmc.draws_xr(vars=["llik"])
-        # remember the fold
-        llik_fold["fold"] = fold
-        llik_fold = llik_fold.set_coords("fold")
-        # set value of index "chain" to zero to match arviz convention
-        llik_fold = llik_fold.assign_coords(
-            {"new_chain": ("chain", [0])},
-        ).set_index(
-            chain="new_chain",
+        },
+    )
+    if "output_dir" in sample_kwargs:
+        output_dir = Path(sample_kwargs["output_dir"]) / name
+        sample_kwargs = sample_kwargs | {"output_dir": output_dir}
+    sample_kwargs = add_parallel_kwargs(ic, sample_kwargs)
+    model = get_stan_model(ic)
+    with profile_stage(f"sample:{name}"):
+        mcmc = model.sample(data=stan_input, **sample_kwargs)
+    record_fit(name, mcmc)
+    llik = get_llik_draws(mcmc)
+    save_fit_checkpoint(name, llik)
+    return llik
+
+
+def get_observation_dim(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    n_obs: int,
+) -> tuple[str, Any]:
+    """Get the name and coordinates of the observation dimension of 'llik'.
+
+    The dimension is named as in the inference's dims for 'llik', if there is
+    exactly one, and otherwise 'llik_dim_0'. Its coordinates come from the
+    prepared data if these have the right length.
+
+    """
+    llik_dims = ic.dims.get("llik", [])
+    obs_dim = llik_dims[0] if len(llik_dims) == 1 else "llik_dim_0"
+    obs_coord = data.coords.get(obs_dim, [])
+    return obs_dim, obs_coord if len(obs_coord) == n_obs else np.arange(n_obs)
+
+
+def sample_hmc_kfold(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> xr.DataArray:
+    """Do k-fold cross validation, given a CmdStanModel, some data and config.
+
+    The Stan model must have data variables called 'likelihood', 'N_train',
+    'N_test', 'ix_train' and 'ix_test'. These are overwritten for each fold.
+
+    The table `mode_options.kfold` must have an entry 'n_folds' that specifies
+    the value of k for k-fold cross-validation. It can optionally have an entry
+    'max_workers' setting how many folds to sample at the same time. By default
+    folds are sampled one after another or, if there is a core budget, as many
+    at once as the budget allows: see `bibat.scheduling`. Any other entries
+    are treated as keyword arguments for CmdStanModel.sample, so for example
+    each fold can have any number of chains. If an 'output_dir' is given, each
+    fold writes its output to its own subdirectory. If there is an entry
+    'warm_start = true', each fold starts from the warm start saved by the
+    posterior mode (see `bibat.warm_start`), so that e.g. 'iter_warmup' can be
+    much smaller.
+
+    Each fold's log likelihood draws are written straight into one array with
+    dimensions (chain, draw, observation), in the order of the observations,
+    with an integer coordinate 'fold' recording each observation's fold: see
+    `make_kfold_llik`.
+
+    """
+    kfold_options = ic.mode_options["kfold"]
+    k = int(kfold_options["n_folds"])
+    sample_kwargs, full_ix, splits = get_kfold_setup(ic, data, local_functions)
+    max_workers = get_max_workers(
+        kfold_options.get("max_workers"),
+        k,
+        sample_kwargs.get("chains") or DEFAULT_CHAINS,
+    )
+    llik_values = None
+    fold_ix = np.empty(len(full_ix), dtype=np.min_scalar_type(k))
+    with share_core_budget(max_workers):
+        sample_fold = in_current_context(sample_held_out_llik)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fold_results = executor.map(
+            partial(
+                sample_fold,
+                ic,
+                data,
+                local_functions,
+                sample_kwargs,
+                full_ix,
+            ),
+            *zip(*splits, strict=True),
+            [f"fold_{fold}" for fold in range(k)],
+        )
+        for (fold, (_, ix_test)), llik_fold in zip(
+            enumerate(splits),
+            fold_results,
+            strict=True,
+        ):
+            if llik_values is None:
+                n_chains, n_draws, _ = llik_fold.shape
+                llik_values = np.empty((n_chains, n_draws, len(full_ix)))
+            llik_values[:, :, ix_test] = llik_fold
+            fold_ix[ix_test] = fold
+    return make_kfold_llik(ic, data, llik_values, fold_ix)
+
+
+def get_kfold_setup(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> tuple[dict[str, Any], np.ndarray, list[tuple[np.ndarray, np.ndarray]]]:
+    """Get the sampler arguments, observation indexes and folds for k-fold.
+
+    The folds are chosen with a fixed random state, so they are the same every
+    time.
+
+    """
+    kfold_options = ic.mode_options["kfold"]
+    kf = KFold(int(kfold_options["n_folds"]), shuffle=True, random_state=1234)
+    stan_input = get_stan_input(ic, data, local_functions)
+    sample_kwargs = ic.sample_kwargs | {
+        key: v for key, v in kfold_options.items() if key not in KFOLD_OPTIONS
+    }
+    sample_kwargs = add_warm_start(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        kfold_options,
+    )
+    full_ix = np.array(stan_input.input_dict["ix_train"])
+    return sample_kwargs, full_ix, list(kf.split(full_ix))
+
+
+def get_kfold_n_pieces(ic: InferenceConfiguration) -> int:
+    """Get the number of k-fold folds that can be sampled as separate pieces.
+
+    Folds that start from a warm start need the posterior mode to have run
+    first, so in this case the folds are not split into pieces.
+
+    """
+    kfold_options = ic.mode_options["kfold"]
+    if kfold_options.get(WARM_START_OPTION, False):
+        return 0
+    return int(kfold_options["n_folds"])
+
+
+def sample_hmc_kfold_fold(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    fold: int,
+) -> np.ndarray:
+    """Sample one k-fold fold, as `sample_hmc_kfold` would.
+
+    The result is checkpointed under the same name as in `sample_hmc_kfold`,
+    so that running the whole mode later reuses it: see `bibat.checkpoint`.
+
+    :param fold: Index of the fold
+
+    """
+    sample_kwargs, full_ix, splits = get_kfold_setup(ic, data, local_functions)
+    ix_train, ix_test = splits[fold]
+    return sample_held_out_llik(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        full_ix,
+        ix_train,
+        ix_test,
+        f"fold_{fold}",
+    )
+
+
+def make_kfold_llik(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    llik_values: np.ndarray,
+    fold_ix: np.ndarray,
+) -> xr.DataArray:
+    """Wrap k-fold log likelihood values in a DataArray.
+
+    The observation dimension is found with `get_observation_dim`.
+
+    :param llik_values: Array with shape (chain, draw, observation)
+
+    :param fold_ix: The fold that each observation was in.
+
+    """
+    n_chains, n_draws, n_obs = llik_values.shape
+    obs_dim, obs_coord = get_observation_dim(ic, data, n_obs)
+    return xr.DataArray(
+        llik_values,
+        dims=["chain", "draw", obs_dim],
+        coords={
+            "chain": np.arange(n_chains),
+            "draw": np.arange(n_draws),
+            obs_dim: obs_coord,
+            "fold": (obs_dim, fold_ix),
+        },
+        name="llik",
+    )
+
+
+def psis_loo_pointwise(llik: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Get pointwise PSIS-LOO elpd estimates and Pareto k diagnostics.
+
+    :param llik: Log likelihood draws with shape (chain, draw, observation)
+
+    """
+    llik_by_obs = llik.reshape(-1, llik.shape[-1]).T
+    log_weights, pareto_k = az.psislw(-llik_by_obs)
+    elpd = logsumexp(llik_by_obs + log_weights, axis=1)
+    return elpd, np.asarray(pareto_k)
+
+
+def get_posterior_llik() -> np.ndarray | None:
+    """Get the current inference's posterior draws of 'llik', if any."""
+    return _POSTERIOR_LLIK.get()
+
+
+@contextmanager
+def posterior_llik(llik: np.ndarray | None) -> Iterator[None]:
+    """Share a posterior fit's draws of 'llik' with the fits in this context.
+
+    :param llik: Draws of 'llik' with shape (chain, draw, observation), or
+    None if there is no posterior fit to share.
+
+    """
+    token = _POSTERIOR_LLIK.set(llik)
+    try:
+        yield
+    finally:
+        _POSTERIOR_LLIK.reset(token)
+
+
+def get_full_llik(  # noqa: PLR0913
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    sample_kwargs: dict,
+    full_ix: np.ndarray,
+    *,
+    reuse_posterior: bool,
+) -> np.ndarray:
+    """Get draws of 'llik' for all observations from a fit to all of them.
+
+    If allowed, the shared posterior draws are used when they cover the same
+    observations (see `posterior_llik`). Otherwise the model is fit here.
+
+    """
+    llik = get_posterior_llik() if reuse_posterior else None
+    stan_input = get_stan_input(ic, data, local_functions)
+    ix_test = np.asarray(stan_input.input_dict.get("ix_test", []))
+    if (
+        llik is not None
+        and llik.ndim == 3  # noqa: PLR2004
+        and np.array_equal(ix_test, full_ix)
+        and llik.shape[-1] == len(full_ix)
+    ):
+        return llik
+    all_obs = np.arange(len(full_ix))
+    return sample_held_out_llik(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        full_ix,
+        all_obs,
+        all_obs,
+        "full",
+    )
+
+
+def sample_hmc_loo(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> xr.Dataset:
+    """Do leave-one-out cross validation with PSIS, refitting only if needed.
+
+    The pointwise expected log predictive density is estimated with Pareto
+    smoothed importance sampling from draws of 'llik' given all the
+    observations. The model is then refit without each observation whose
+    Pareto k diagnostic exceeds a threshold, and that observation's elpd is
+    computed exactly from the refit.
+
+    If a posterior mode ran earlier in the same inference with the same test
+    observations, its draws of 'llik' are reused. Otherwise, e.g. if 'loo'
+    comes before 'posterior' in the inference's modes or the posterior was not
+    refit, this mode does its own full fit first, which costs as much as
+    another posterior run.
+
+    The Stan model must have the same data variables as for `sample_hmc_kfold`.
+
+    The optional table `mode_options.loo` can have an entry 'k_threshold'
+    (default 0.7), an entry 'max_workers' setting how many refits to sample at
+    the same time, an entry 'reuse_posterior' (default true) which can be set
+    to false to always do the full fit with this mode's sampler settings and an
+    entry 'warm_start' as for k-fold mode. Any other entries are treated as
+    keyword arguments for CmdStanModel.sample.
+
+    The result is written to a group called 'loo' with variables 'elpd_loo',
+    'pareto_k' and 'refit', each with one value per observation.
+
+    """
+    loo_options = ic.mode_options.get("loo", {})
+    k_threshold = float(loo_options.get("k_threshold", DEFAULT_K_THRESHOLD))
+    stan_input = get_stan_input(ic, data, local_functions)
+    sample_kwargs = ic.sample_kwargs | {
+        key: v for key, v in loo_options.items() if key not in LOO_OPTIONS
+    }
+    sample_kwargs = add_warm_start(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        loo_options,
+    )
+    full_ix = np.array(stan_input.input_dict["ix_train"])
+    all_obs = np.arange(len(full_ix))
+    llik = get_full_llik(
+        ic,
+        data,
+        local_functions,
+        sample_kwargs,
+        full_ix,
+        reuse_posterior=is_true_option(
+            loo_options.get("reuse_posterior", True),
+        ),
+    )
+    elpd, pareto_k = psis_loo_pointwise(llik)
+    del llik
+    refit = pareto_k > k_threshold
+    to_refit = np.flatnonzero(refit)
+    max_workers = get_max_workers(
+        loo_options.get("max_workers"),
+        len(to_refit),
+        sample_kwargs.get("chains") or DEFAULT_CHAINS,
+    )
+    with share_core_budget(max_workers):
+        sample_refit = in_current_context(sample_held_out_llik)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        refit_results = executor.map(
+            partial(
+                sample_refit,
+                ic,
+                data,
+                local_functions,
+                sample_kwargs,
+                full_ix,
+            ),
+            [np.delete(all_obs, i) for i in to_refit],
+            [np.array([i]) for i in to_refit],
+            [f"loo_{i}" for i in to_refit],
         )
-        lliks_by_fold.append(llik_fold["llik"])
-    return xr.concat(lliks_by_fold, dim="llik_dim_0").sortby("llik_dim_0")
+        for i, llik_i in zip(to_refit, refit_results, strict=True):
+            elpd[i] = logsumexp(llik_i) - np.log(llik_i.size)
+    obs_dim, obs_coord = get_observation_dim(ic, data, len(full_ix))
+    return xr.Dataset(
+        {
+            "elpd_loo": (obs_dim, elpd),
+            "pareto_k": (obs_dim, pareto_k),
+            "refit": (obs_dim, refit),
+        },
+        coords={obs_dim: obs_coord},
+        attrs={"k_threshold": k_threshold},
+    )
+
+
+def make_approximate_idata(
+    draws: dict[str, np.ndarray],
+    idata_target: IdataTarget,
+    ic: InferenceConfiguration,
+    data: PreparedData,
+) -> az.InferenceData:
+    """Make an InferenceData object from approximate draws of each variable.
+
+    The draws are treated as a single chain. The variable 'yrep' goes to the
+    predictive group and, for the posterior target, 'llik' goes to the
+    log_likelihood group, as for HMC modes.
+
+    :param draws: Map from variable names to arrays whose first axis is the
+    draw.
+
+    :param idata_target: Either "prior" or "posterior".
+
+    """
+    target = idata_target.value
+    variables = {k: np.asarray(v)[np.newaxis] for k, v in draws.items()}
+    groups = {}
+    if "yrep" in variables:
+        groups[f"{target}_predictive"] = {"yrep": variables.pop("yrep")}
+    if idata_target == IdataTarget.posterior and "llik" in variables:
+        groups["log_likelihood"] = {"llik": variables.pop("llik")}
+    groups[target] = variables
+    return az.from_dict(**groups, coords=data.coords, dims=ic.dims)
+
+
+def run_approximate(  # noqa: PLR0913
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    method: str,
+    mode_name: str,
+    idata_target: IdataTarget,
+) -> az.InferenceData:
+    """Fit a model with one of CmdStan's approximate methods.
+
+    The sampler options `sample_kwargs` do not apply to these methods, so the
+    only keyword arguments are the entries of the table
+    `mode_options.<mode_name>`, if there is one.
+
+    :param method: Name of a CmdStanModel method: "pathfinder",
+    "laplace_sample" or "optimize". The draws of "optimize" are the single
+    optimum.
+
+    :param mode_name: Name of the fitting mode, for finding its options.
+
+    :param idata_target: Either "prior" or "posterior". This determines the
+    value of the data variable 'likelihood'.
+
+    """
+    stan_input = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": int(idata_target == IdataTarget.posterior)},
+    )
+    model = get_stan_model(ic)
+    kwargs = ic.mode_options.get(mode_name, {})
+    with profile_stage(f"sample:{mode_name}"):
+        fit = getattr(model, method)(stan_input, **kwargs)
+    record_fit(mode_name, fit)
+    draws = fit.stan_variables()
+    if method == "optimize":
+        draws = {k: np.asarray(v)[np.newaxis] for k, v in draws.items()}
+    return make_approximate_idata(draws, idata_target, ic, data)
+
+
+def pathfinder_posterior(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> az.InferenceData:
+    """Approximate the posterior with pathfinder."""
+    return run_approximate(
+        ic,
+        data,
+        local_functions,
+        "pathfinder",
+        "pathfinder",
+        IdataTarget.posterior,
+    )
+
+
+def pathfinder_prior(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> az.InferenceData:
+    """Approximate the prior with pathfinder."""
+    return run_approximate(
+        ic,
+        data,
+        local_functions,
+        "pathfinder",
+        "pathfinder_prior",
+        IdataTarget.prior,
+    )
+
+
+def laplace_posterior(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> az.InferenceData:
+    """Approximate the posterior with a Laplace approximation at its mode."""
+    return run_approximate(
+        ic,
+        data,
+        local_functions,
+        "laplace_sample",
+        "laplace",
+        IdataTarget.posterior,
+    )
+
+
+def optimize_posterior(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> az.InferenceData:
+    """Find the posterior mode, as a posterior with one draw."""
+    return run_approximate(
+        ic,
+        data,
+        local_functions,
+        "optimize",
+        "optimize",
+        IdataTarget.posterior,
+    )
 
 
 prior_mode = FittingMode(
@@ -156,4 +758,32 @@ kfold_mode = FittingMode(
     name="kfold",
     idata_target=IdataTarget.log_likelihood,
     fit=sample_hmc_kfold,
+    n_pieces=get_kfold_n_pieces,
+    fit_piece=sample_hmc_kfold_fold,
+)
+loo_mode = FittingMode(
+    name="loo",
+    idata_target=IdataTarget.loo,
+    fit=sample_hmc_loo,
+    uses_posterior_llik=True,
+)
+pathfinder_mode = FittingMode(
+    name="pathfinder",
+    idata_target=IdataTarget.posterior,
+    fit=pathfinder_posterior,
+)
+pathfinder_prior_mode = FittingMode(
+    name="pathfinder_prior",
+    idata_target=IdataTarget.prior,
+    fit=pathfinder_prior,
+)
+laplace_mode = FittingMode(
+    name="laplace",
+    idata_target=IdataTarget.posterior,
+    fit=laplace_posterior,
+)
+optimize_mode = FittingMode(
+    name="optimize",
+    idata_target=IdataTarget.posterior,
+    fit=optimize_posterior,
 )
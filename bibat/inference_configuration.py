@@ -1,12 +1,14 @@
 """The inference_configuration module.
 
 This module provides the class InferenceConfiguration and the function
-`load_inference_configuration`.
+`load_inference_configuration`, as well as the class IdataSaveOptions for
+configuring how an inference's results are saved.
 
 """
 
 from __future__ import annotations
 
+from enum import Enum
 from pathlib import Path
 
 import toml
@@ -14,6 +16,76 @@ from pydantic import BaseModel, Field, field_validator, model_validator
 
 DEFAULT_DIMS = {"llik": ["observation"], "yrep": ["observation"]}
 DEFAULT_SAMPLE_KWARGS = {"show_progress": False}
+NETCDF_COMPRESSORS = ["none", "zlib"]
+STAN_THREADS = "STAN_THREADS"
+
+
+def is_true_option(value: object) -> bool:
+    """Check if a compiler option like STAN_THREADS is switched on."""
+    if isinstance(value, str):
+        return value.lower() in ["true", "1"]
+    return bool(value)
+
+
+class IdataSaveFormat(str, Enum):
+    """An enum for choosing the format in which inferences are saved."""
+
+    zarr = "zarr"
+    netcdf = "netcdf"
+    json = "json"
+
+
+class IdataCompressor(str, Enum):
+    """An enum for choosing how saved InferenceData arrays are compressed."""
+
+    none = "none"
+    zlib = "zlib"
+    zstd = "zstd"
+    blosc = "blosc"
+
+
+class IdataSaveOptions(BaseModel):
+    """Options for saving an inference's InferenceData object.
+
+    Compression and chunking options only apply to numeric variables, and are
+    ignored when saving in json format.
+
+    :param save_format: Format in which to save the InferenceData.
+
+    :param compressor: Compression codec. The netcdf format only supports
+    'zlib' and 'none'. If this is None, the storage backend's default is used.
+
+    :param compression_level: Compression level for the chosen codec. If this
+    is None, the codec's default level is used.
+
+    :param chunks: Map from dimension names, such as 'draw' or 'observation',
+    to chunk sizes. Dimensions that are not mentioned are not chunked.
+
+    :param consolidated: Whether to write consolidated metadata for zarr
+    stores, which makes opening them faster.
+
+    """
+
+    save_format: IdataSaveFormat = IdataSaveFormat.zarr
+    compressor: IdataCompressor | None = None
+    compression_level: int | None = None
+    chunks: dict[str, int] = Field(default_factory=dict)
+    consolidated: bool = True
+
+    @model_validator(mode="after")
+    def check_compressor(self: IdataSaveOptions) -> IdataSaveOptions:
+        """Check that the compressor is available for the chosen format."""
+        if (
+            self.save_format == IdataSaveFormat.netcdf
+            and self.compressor is not None
+            and self.compressor not in NETCDF_COMPRESSORS
+        ):
+            msg = (
+                f"Compressor {self.compressor.value} is not available for "
+                f"netcdf: choose one of {NETCDF_COMPRESSORS}."
+            )
+            raise ValueError(msg)
+        return self
 
 
 class InferenceConfiguration(BaseModel):
@@ -37,10 +109,22 @@ class InferenceConfiguration(BaseModel):
     :param dims: map from parameter names to lists of coordinate names.
 
     :param cpp_options: valid choices for the `cpp_options` argument to
-    CmdStanModel
-
-    :param stanc_options: valid choices for the `cpp_options` argument to
-    CmdStanModel
+    CmdStanModel. These are passed to the compiler when the model is compiled.
+    If `sample_kwargs` or any table in `mode_options` sets `threads_per_chain`
+    to more than 1, the option `STAN_THREADS` is switched on automatically, so
+    that Stan programs using `reduce_sum` or `map_rect` can use several threads
+    per chain.
+
+    :param stanc_options: valid choices for the `stanc_options` argument to
+    CmdStanModel. These are passed to the compiler when the model is compiled.
+
+    :param idata_save_options: options for saving this inference's
+    InferenceData object. Options that are set here override the defaults
+    passed to `bibat.fitting.run_all_inferences`.
+
+    :param inference_dir: the directory that the configuration was loaded
+    from, if any. This is where files such as Stan inputs are written. It is
+    set by `load_inference_configuration` and is not part of the config file.
     """
 
     name: str
@@ -53,6 +137,8 @@ class InferenceConfiguration(BaseModel):
     mode_options: dict[str, dict] = Field(default_factory=dict)
     cpp_options: dict | None = None
     stanc_options: dict | None = None
+    idata_save_options: IdataSaveOptions | None = None
+    inference_dir: Path | None = Field(default=None, exclude=True)
 
     @model_validator(mode="after")
     def check_folds(self: InferenceConfiguration) -> InferenceConfiguration:
@@ -80,6 +166,29 @@ class InferenceConfiguration(BaseModel):
                 raise ValueError(msg)
         return self
 
+    @model_validator(mode="after")
+    def check_stan_threads(
+        self: InferenceConfiguration,
+    ) -> InferenceConfiguration:
+        """Compile with STAN_THREADS if a fit uses several threads per chain."""
+        requested = [
+            int(options["threads_per_chain"])
+            for options in [self.sample_kwargs, *self.mode_options.values()]
+            if options.get("threads_per_chain") is not None
+        ]
+        if all(threads <= 1 for threads in requested):
+            return self
+        cpp_options = self.cpp_options or {}
+        if STAN_THREADS not in cpp_options:
+            self.cpp_options = cpp_options | {STAN_THREADS: True}
+        elif not is_true_option(cpp_options[STAN_THREADS]):
+            msg = (
+                f"threads_per_chain is {max(requested)} but cpp option "
+                f"{STAN_THREADS} is switched off."
+            )
+            raise ValueError(msg)
+        return self
+
     @field_validator("stan_file")
     @classmethod
     def check_stan_file_exists(
@@ -109,4 +218,4 @@ def load_inference_configuration(path: Path) -> InferenceConfiguration:
     ):
         if k in kwargs:
             kwargs[k] = default | kwargs[k]
-    return InferenceConfiguration(**kwargs)
+    return InferenceConfiguration(**kwargs, inference_dir=path)
@@ -1,13 +1,317 @@
-"""Provides the base class PreparedData."""
+"""Provides the base class PreparedData, plus functions for saving and loading.
 
-from pydantic import BaseModel, ConfigDict
+Prepared data can be stored in one of two formats:
 
-from bibat.util import CoordDict
+- json: the whole PreparedData object is serialised to a single json file
+  called `<name>.json`.
+
+- parquet: the PreparedData object is saved to a directory called `<name>`.
+  Each dataframe field is stored in a columnar file `<field>.parquet`, and the
+  other fields are stored in a small json file `manifest.json`. This format is
+  much faster and smaller for large tables and preserves dtypes and indexes. It
+  requires the optional dependency pyarrow.
+
+In both formats, a validation record is saved next to the prepared data so
+that unchanged tables are not validated again when they are loaded: see
+`bibat.validation`.
+
+"""
+
+from __future__ import annotations
+
+import json
+from enum import Enum
+from functools import partial
+from io import StringIO
+from typing import TYPE_CHECKING, Any, TypeVar
+
+import pandas as pd
+from pydantic import BaseModel, ConfigDict, PrivateAttr
+
+from bibat.util import CoordDict, validate_df_or_string
+from bibat.validation import (
+    json_table_hash,
+    load_validation_record,
+    restore_column_types,
+    save_validation_record,
+    table_hash,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+MANIFEST_FILE = "manifest.json"
 
 
 class PreparedData(BaseModel):
-    """What prepared data looks like in a bibat analysis."""
+    """What prepared data looks like in a bibat analysis.
+
+    PreparedData objects created by `load_prepared_data` with `lazy=True` have
+    some fields that are only read from disk and validated when they are first
+    accessed. These pending fields are stored in the private attribute
+    `_lazy_fields`, which maps each field name to a function that loads the
+    field's value, plus either a flag saying whether the value should be
+    validated, the content hash of a previously validated value or None if
+    the value is already known to have been validated. Fields that
+    were set without being validated are listed in `_unvalidated_fields`. The
+    private attribute `_stan_inputs` memoises Stan inputs made from the object:
+    see `bibat.stan_input`.
+    """
 
     name: str
     coords: CoordDict
     model_config = ConfigDict(arbitrary_types_allowed=True)
+    _lazy_fields: dict[str, tuple[Callable[[], Any], bool | str]] = PrivateAttr(
+        default_factory=dict,
+    )
+    _unvalidated_fields: set[str] = PrivateAttr(default_factory=set)
+    _stan_inputs: dict[Callable, Any] = PrivateAttr(default_factory=dict)
+
+    def __getattr__(self, name: str) -> Any:  # noqa: ANN401
+        """Load a lazy field if necessary."""
+        if not name.startswith("_") and name in self._lazy_fields:
+            loader, validate = self._lazy_fields.pop(name)
+            set_field(self, name, loader(), validate=validate)
+            return self.__dict__[name]
+        return super().__getattr__(name)
+
+    def load_lazy_fields(self) -> None:
+        """Make sure that all lazy fields are loaded."""
+        for name in list(self._lazy_fields):
+            getattr(self, name)
+
+
+PreparedDataT = TypeVar("PreparedDataT", bound=PreparedData)
+
+
+class PreparedDataFormat(str, Enum):
+    """An enum for choosing the format in which prepared data are saved."""
+
+    json = "json"
+    parquet = "parquet"
+
+
+def set_field(
+    prepared_data: PreparedData,
+    name: str,
+    value: Any,  # noqa: ANN401
+    *,
+    validate: bool | str | None = True,
+) -> None:
+    """Set a field of a PreparedData object, optionally validating it.
+
+    If `validate` is a string, the value is only validated if its content hash
+    is different. If it is None, the value is trusted without being checked.
+
+    """
+    trusted = validate is None or (
+        isinstance(validate, str) and table_hash(value) == validate
+    )
+    if validate and not trusted:
+        prepared_data.__pydantic_validator__.validate_assignment(
+            prepared_data,
+            name,
+            value,
+        )
+        prepared_data._unvalidated_fields.discard(name)  # noqa: SLF001
+    else:
+        prepared_data.__dict__[name] = validate_df_or_string(value)
+        if not trusted:
+            prepared_data._unvalidated_fields.add(name)  # noqa: SLF001
+
+
+def get_dataframe_fields(prepared_data: PreparedData) -> list[str]:
+    """Get the names of a PreparedData object's dataframe fields."""
+    return [
+        field
+        for field in type(prepared_data).model_fields
+        if isinstance(getattr(prepared_data, field), pd.DataFrame)
+    ]
+
+
+def save_prepared_data(
+    prepared_data: PreparedData,
+    data_dir: Path,
+    prepared_data_format: PreparedDataFormat = PreparedDataFormat.json,
+) -> Path:
+    """Save a PreparedData object and return the path where it was saved.
+
+    :param prepared_data: A PreparedData object
+
+    :param data_dir: Directory for prepared data. The object is saved to a file
+    or directory in here that is named after the prepared data's name.
+
+    :param prepared_data_format: Format in which to save the prepared data.
+
+    """
+    data_dir.mkdir(parents=True, exist_ok=True)
+    if prepared_data_format == PreparedDataFormat.json:
+        path = data_dir / f"{prepared_data.name}.json"
+        path.write_text(prepared_data.model_dump_json())
+        save_prepared_data_validation_record(prepared_data, path)
+        return path
+    path = data_dir / prepared_data.name
+    path.mkdir(exist_ok=True)
+    dataframe_fields = get_dataframe_fields(prepared_data)
+    for field in dataframe_fields:
+        df = getattr(prepared_data, field)
+        df.to_parquet(path / f"{field}.parquet")
+    manifest = {
+        "format": prepared_data_format.value,
+        "dataframes": dataframe_fields,
+        "fields": prepared_data.model_dump(
+            mode="json",
+            exclude=set(dataframe_fields),
+        ),
+    }
+    with (path / MANIFEST_FILE).open("w") as f:
+        json.dump(manifest, f)
+    save_prepared_data_validation_record(prepared_data, path)
+    return path
+
+
+def save_prepared_data_validation_record(
+    prepared_data: PreparedData,
+    path: Path,
+) -> None:
+    """Record which of a PreparedData object's tables have been validated."""
+    validated = {
+        field: getattr(prepared_data, field)
+        for field in get_dataframe_fields(prepared_data)
+        if field not in prepared_data._unvalidated_fields  # noqa: SLF001
+    }
+    save_validation_record(
+        path,
+        type(prepared_data),
+        validated,
+        json_tables=not path.is_dir(),
+    )
+
+
+def get_prepared_data_path(data_dir: Path, name: str) -> Path:
+    """Find where some prepared data are saved.
+
+    :param data_dir: Directory for prepared data
+
+    :param name: Name of the prepared data
+
+    """
+    directory = data_dir / name
+    if (directory / MANIFEST_FILE).exists():
+        return directory
+    return (data_dir / name).with_suffix(".json")
+
+
+def load_prepared_data(
+    path: Path,
+    prepared_data_class: type[PreparedDataT],
+    *,
+    lazy: bool = False,
+    columns: dict[str, list[str]] | None = None,
+    revalidate: bool = False,
+) -> PreparedDataT:
+    """Load a PreparedData object saved by `save_prepared_data`.
+
+    :param path: Path to a json file or a directory with a manifest file
+
+    :param prepared_data_class: The subclass of PreparedData to load.
+
+    :param lazy: If True, fields that are not dataframes are loaded and
+    validated straight away, but each dataframe field is only read and
+    validated the first time it is accessed. This is fastest with the parquet
+    format, as json files must be parsed as a whole.
+
+    :param columns: Map from dataframe field names to lists of columns to read.
+    Only these columns are read for these fields. As the schema of a projected
+    dataframe may require columns that were not read, projected dataframes are
+    not validated again: they should have been validated when the prepared data
+    were created.
+
+    :param revalidate: If True, all dataframes are validated, even if the
+    validation record says that they have already been validated.
+
+    """
+    columns = columns or {}
+    record = (
+        {}
+        if revalidate
+        else load_validation_record(
+            path,
+            prepared_data_class,
+        )
+    )
+    validated: dict[str, str | None] = record.get("tables", {})
+    if path.is_dir():
+        with (path / MANIFEST_FILE).open("r") as f:
+            manifest = json.load(f)
+        fields = manifest["fields"]
+        loaders = {
+            field: partial(
+                pd.read_parquet,
+                path / f"{field}.parquet",
+                columns=columns.get(field),
+            )
+            for field in manifest["dataframes"]
+        }
+    else:
+        with path.open("r") as f:
+            raw = json.load(f)
+        dataframe_fields = [
+            field
+            for field, info in prepared_data_class.model_fields.items()
+            if info.annotation is pd.DataFrame and field in raw
+        ]
+        fields = {k: v for k, v in raw.items() if k not in dataframe_fields}
+        json_tables = record.get("json_tables", {})
+        trusted = {
+            field: json_tables[field]["types"]
+            for field in dataframe_fields
+            if field in json_tables
+            and json_table_hash(raw[field]) == json_tables[field]["hash"]
+        }
+        validated = dict.fromkeys(trusted)
+        loaders = {
+            field: partial(
+                read_json_dataframe,
+                raw[field],
+                columns.get(field),
+                trusted.get(field),
+            )
+            for field in dataframe_fields
+        }
+    if not lazy and len(columns) == 0 and len(validated) == 0:
+        dataframes = {field: loader() for field, loader in loaders.items()}
+        return prepared_data_class(**fields, **dataframes)
+    out = prepared_data_class.model_construct(**fields)
+    for name, value in fields.items():
+        set_field(out, name, value)
+    for name, loader in loaders.items():
+        out.__dict__.pop(name, None)
+        validate = name not in columns and validated.get(name, True)
+        out._lazy_fields[name] = (loader, validate)  # noqa: SLF001
+    if not lazy:
+        out.load_lazy_fields()
+    return out
+
+
+def read_json_dataframe(
+    json_str: str,
+    columns: list[str] | None = None,
+    column_types: list[str] | None = None,
+) -> pd.DataFrame:
+    """Read a dataframe from a json string, optionally selecting columns.
+
+    :param column_types: If given, the table is read without guessing dtypes
+    and these column types are restored: see
+    `bibat.validation.restore_column_types`.
+
+    """
+    if column_types is None:
+        df = validate_df_or_string(json_str)
+    else:
+        df = restore_column_types(
+            pd.read_json(StringIO(json_str), dtype=False, convert_dates=False),
+            column_types,
+        )
+    return df if columns is None else df[columns]
@@ -0,0 +1,440 @@
+"""Provides timing and resource profiles of inferences.
+
+When `bibat.fitting.run_all_inferences` is called with `profile=True`, each
+inference records how long its stages took and writes the results to the file
+`profile.json` in its directory. The stages are:
+
+- `compile`: compiling a Stan program, if it was not already compiled.
+- `stan_input`: calling the Stan input function and encoding its output.
+- `stan_input_write`: writing a data file for CmdStan.
+- `fit:<mode>`: running a fitting mode, including any of the above.
+- `sample:<fit>`: one call to CmdStan, e.g. `sample:posterior` or
+  `sample:fold_3`.
+- `idata:<mode>`: converting a fitting mode's output to InferenceData.
+- `save`: writing the InferenceData object to disk.
+
+Each stage records its wall-clock time, the CPU time used in the meantime by
+the Python process and by finished child processes such as CmdStan, and the
+peak resident set size of each of these so far. CPU times and peak memory are
+process-wide, so stages that run at the same time, e.g. k-fold folds with
+`max_workers > 1`, share them, and stages can be nested, so their times do not
+add up to the total.
+
+Each call to CmdStan also records per-chain timings, the number of gradient
+evaluations after warmup and their rate, the time that CmdStan reported for
+one gradient evaluation and, if the fit was run with `save_profile = true`,
+the rows of the output of the Stan program's `profile` blocks.
+
+A summary of the whole run, listing the inferences from slowest to fastest, is
+written to the file `profile.json` in the inferences directory.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import wraps
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, ParamSpec, TypeVar
+
+import pandas as pd
+from pydantic import BaseModel, Field
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+
+PROFILE_FILE = "profile.json"
+GRADIENT_PATTERN = re.compile(
+    r"Gradient evaluation took ([0-9.eE+-]+) seconds",
+)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_CURRENT_PROFILER: ContextVar[Profiler | None] = ContextVar(
+    "bibat_profiler",
+    default=None,
+)
+
+
+class ResourceUsage(BaseModel):
+    """A snapshot of the resources used so far.
+
+    :param wall_time: Wall-clock time in seconds since an arbitrary point.
+
+    :param cpu_time: CPU time in seconds used by this process.
+
+    :param child_cpu_time: CPU time in seconds used by finished child
+    processes, or None if this is not available on this platform.
+
+    :param peak_rss: Peak resident set size of this process in bytes, or None
+    if this is not available on this platform.
+
+    :param peak_child_rss: Peak resident set size in bytes of the largest
+    finished child process, or None.
+
+    """
+
+    wall_time: float
+    cpu_time: float
+    child_cpu_time: float | None = None
+    peak_rss: int | None = None
+    peak_child_rss: int | None = None
+
+
+class StageProfile(BaseModel):
+    """The resources used by one stage of an inference.
+
+    :param name: Name of the stage, e.g. "fit:posterior"
+
+    :param wall_time: Wall-clock time in seconds
+
+    :param cpu_time: CPU time in seconds used by this process
+
+    :param child_cpu_time: CPU time in seconds used by child processes that
+    finished during the stage.
+
+    :param peak_rss: Peak resident set size of this process in bytes at the
+    end of the stage.
+
+    :param peak_child_rss: Peak resident set size in bytes of the largest
+    child process at the end of the stage.
+
+    """
+
+    name: str
+    wall_time: float
+    cpu_time: float
+    child_cpu_time: float | None = None
+    peak_rss: int | None = None
+    peak_child_rss: int | None = None
+
+
+class FitProfile(BaseModel):
+    """What CmdStan reported about one of its runs.
+
+    :param name: Name of the fit, e.g. "posterior" or "fold_3"
+
+    :param method: The CmdStan method, e.g. "sample" or "pathfinder"
+
+    :param chain_time: Per-chain timings in seconds, with keys 'warmup',
+    'sampling' and 'total'. Only available for the "sample" method.
+
+    :param gradient_evaluations: Per-chain number of gradient evaluations
+    after warmup, i.e. the sum of 'n_leapfrog__'.
+
+    :param gradient_evaluations_per_second: Per-chain rate of gradient
+    evaluations after warmup.
+
+    :param gradient_time: Per-chain time in seconds of one gradient evaluation,
+    as reported by CmdStan before sampling.
+
+    :param stan_profile: Rows of the output of the Stan program's `profile`
+    blocks, one per block and chain, with a column 'chain'.
+
+    """
+
+    name: str
+    method: str
+    chain_time: list[dict[str, float]] = Field(default_factory=list)
+    gradient_evaluations: list[int] = Field(default_factory=list)
+    gradient_evaluations_per_second: list[float] = Field(default_factory=list)
+    gradient_time: list[float] = Field(default_factory=list)
+    stan_profile: list[dict[str, Any]] = Field(default_factory=list)
+
+
+class InferenceProfile(BaseModel):
+    """A profile of an inference.
+
+    :param name: Name of the inference
+
+    :param wall_time: Total wall-clock time in seconds
+
+    :param cpu_time: Total CPU time in seconds used by this process
+
+    :param child_cpu_time: Total CPU time in seconds used by child processes
+
+    :param peak_rss: Peak resident set size of this process in bytes
+
+    :param stages: The inference's stages, in the order in which they finished.
+
+    :param fits: The inference's calls to CmdStan.
+
+    """
+
+    name: str
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    child_cpu_time: float | None = None
+    peak_rss: int | None = None
+    stages: list[StageProfile] = Field(default_factory=list)
+    fits: list[FitProfile] = Field(default_factory=list)
+
+
+class RunProfile(BaseModel):
+    """A profile of a run of several inferences.
+
+    :param wall_time: Total wall-clock time in seconds
+
+    :param cpu_time: Total CPU time in seconds used by this process
+
+    :param child_cpu_time: Total CPU time in seconds used by child processes,
+    including any worker processes.
+
+    :param peak_rss: Peak resident set size of this process in bytes
+
+    :param inferences: Profiles of the inferences that ran, from the slowest to
+    the fastest.
+
+    """
+
+    wall_time: float
+    cpu_time: float
+    child_cpu_time: float | None = None
+    peak_rss: int | None = None
+    inferences: list[InferenceProfile] = Field(default_factory=list)
+
+
+def rusage_bytes(maxrss: int) -> int:
+    """Convert a value of ru_maxrss to bytes.
+
+    This is in kilobytes on Linux, but in bytes on macOS.
+
+    """
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def get_resource_usage() -> ResourceUsage:
+    """Get a snapshot of the resources used so far."""
+    usage = ResourceUsage(
+        wall_time=time.perf_counter(),
+        cpu_time=time.process_time(),
+    )
+    if resource is not None:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage.child_cpu_time = children.ru_utime + children.ru_stime
+        usage.peak_rss = rusage_bytes(own.ru_maxrss)
+        usage.peak_child_rss = rusage_bytes(children.ru_maxrss)
+    return usage
+
+
+def get_usage_difference(
+    start: ResourceUsage,
+    end: ResourceUsage,
+) -> dict[str, Any]:
+    """Get the resources used between two snapshots.
+
+    Times are differences and peak memory usage is as at the end.
+
+    """
+    child_cpu_time = (
+        None
+        if start.child_cpu_time is None or end.child_cpu_time is None
+        else end.child_cpu_time - start.child_cpu_time
+    )
+    return {
+        "wall_time": end.wall_time - start.wall_time,
+        "cpu_time": end.cpu_time - start.cpu_time,
+        "child_cpu_time": child_cpu_time,
+        "peak_rss": end.peak_rss,
+        "peak_child_rss": end.peak_child_rss,
+    }
+
+
+def make_run_profile(
+    start: ResourceUsage,
+    profiles: list[InferenceProfile | None],
+) -> RunProfile:
+    """Make a profile of a run of several inferences.
+
+    :param start: The resources used when the run started
+
+    :param profiles: The profiles of the inferences that ran. Inferences that
+    were not profiled, e.g. because they were up to date, are None.
+
+    """
+    usage = get_usage_difference(start, get_resource_usage())
+    del usage["peak_child_rss"]
+    return RunProfile(
+        **usage,
+        inferences=sorted(
+            (p for p in profiles if p is not None),
+            key=lambda p: -p.wall_time,
+        ),
+    )
+
+
+class Profiler:
+    """Collect the profile of an inference.
+
+    Stages and fits can be recorded from several threads at once.
+
+    :param name: Name of the inference
+
+    """
+
+    def __init__(self, name: str) -> None:
+        """Start profiling."""
+        self.profile = InferenceProfile(name=name)
+        self.start = get_resource_usage()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Record the resources used by a stage."""
+        start = get_resource_usage()
+        try:
+            yield
+        finally:
+            stage = StageProfile(
+                name=name,
+                **get_usage_difference(start, get_resource_usage()),
+            )
+            with self._lock:
+                self.profile.stages.append(stage)
+
+    def record_fit(self, name: str, fit: Any) -> None:  # noqa: ANN401
+        """Record what CmdStan reported about a fit."""
+        fit_profile = get_fit_profile(name, fit)
+        with self._lock:
+            self.profile.fits.append(fit_profile)
+
+    def finish(self) -> InferenceProfile:
+        """Stop profiling and return the profile."""
+        usage = get_usage_difference(self.start, get_resource_usage())
+        del usage["peak_child_rss"]
+        return self.profile.model_copy(update=usage)
+
+
+@contextmanager
+def profiling(name: str) -> Iterator[Profiler]:
+    """Profile an inference in the current context.
+
+    While the context manager is active, `profile_stage` and `record_fit`
+    record to the yielded Profiler.
+
+    :param name: Name of the inference
+
+    """
+    profiler = Profiler(name)
+    token = _CURRENT_PROFILER.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _CURRENT_PROFILER.reset(token)
+
+
+@contextmanager
+def profile_stage(name: str) -> Iterator[None]:
+    """Record a stage, if an inference is being profiled.
+
+    :param name: Name of the stage
+
+    """
+    profiler = _CURRENT_PROFILER.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+def record_fit(name: str, fit: Any) -> None:  # noqa: ANN401
+    """Record what CmdStan reported, if an inference is being profiled.
+
+    :param name: Name of the fit, e.g. "posterior" or "fold_3"
+
+    :param fit: The object returned by a CmdStanModel method, e.g. a
+    CmdStanMCMC object.
+
+    """
+    profiler = _CURRENT_PROFILER.get()
+    if profiler is not None:
+        profiler.record_fit(name, fit)
+
+
+def in_current_context(func: Callable[P, R]) -> Callable[P, R]:
+    """Make a function run in the current context, e.g. in another thread.
+
+    Threads do not inherit the context of the code that starts them, so
+    functions that should be profiled when run by a ThreadPoolExecutor need to
+    be wrapped with this.
+
+    """
+    context = copy_context()
+
+    @wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def get_fit_profile(name: str, fit: Any) -> FitProfile:  # noqa: ANN401
+    """Get what CmdStan reported about a fit.
+
+    :param name: Name of the fit
+
+    :param fit: The object returned by a CmdStanModel method.
+
+    """
+    # pathfinder and laplace results only have a private runset attribute
+    runset = getattr(fit, "runset", None) or getattr(fit, "_runset", None)
+    method = "unknown" if runset is None else str(runset.method.name).lower()
+    out = FitProfile(name=name, method=method)
+    if runset is None:
+        return out
+    chain_time = getattr(fit, "time", None)
+    if isinstance(chain_time, list):
+        out.chain_time = chain_time
+    method_variables = (
+        fit.method_variables() if hasattr(fit, "method_variables") else {}
+    )
+    if "n_leapfrog__" in method_variables:
+        n_leapfrog = method_variables["n_leapfrog__"].sum(axis=0)
+        out.gradient_evaluations = [int(n) for n in n_leapfrog]
+        if len(out.chain_time) == len(n_leapfrog):
+            out.gradient_evaluations_per_second = [
+                float(n) / t["sampling"] if t.get("sampling") else 0.0
+                for n, t in zip(n_leapfrog, out.chain_time, strict=True)
+            ]
+    for stdout_file in runset.stdout_files:
+        path = Path(stdout_file)
+        if path.exists():
+            match = GRADIENT_PATTERN.search(path.read_text(errors="replace"))
+            if match is not None:
+                out.gradient_time.append(float(match.group(1)))
+    for chain, profile_file in enumerate(runset.profile_files, start=1):
+        if profile_file and Path(profile_file).exists():
+            rows = pd.read_csv(profile_file).assign(chain=chain)
+            out.stan_profile += rows.to_dict(orient="records")
+    return out
+
+
+def save_inference_profile(
+    inference_dir: Path,
+    profile: InferenceProfile,
+) -> None:
+    """Save an inference's profile in its directory."""
+    path = inference_dir / PROFILE_FILE
+    logging.info("Saving profile to %s", path)
+    path.write_text(profile.model_dump_json(indent=2))
+
+
+def save_run_profile(inferences_dir: Path, profile: RunProfile) -> None:
+    """Save a run's profile in the inferences directory."""
+    path = inferences_dir / PROFILE_FILE
+    logging.info("Saving profile to %s", path)
+    path.write_text(profile.model_dump_json(indent=2))
@@ -0,0 +1,135 @@
+"""Provides lazy access to the results of all the inferences in an analysis.
+
+A ResultsCatalog scans an analysis's `inferences` directory for saved
+InferenceData objects. Results saved in zarr or netcdf format are opened
+lazily: only their metadata and coordinates are read when they are opened, and
+the values of a variable are only read from disk when they are used. If dask
+is installed, lazily opened zarr variables are dask arrays.
+
+Results saved in json format cannot be read partially, so they are read in
+full the first time they are needed.
+
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+from bibat.fitting import find_idata_format, load_idata
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import arviz as az
+    import xarray as xr
+
+    from bibat.inference_configuration import IdataSaveFormat
+
+INDEX_COLUMNS = ["inference", "group", "variable", "dims", "shape", "dtype"]
+
+
+class ResultsCatalog:
+    """A catalog of the saved results in an inferences directory.
+
+    :param inferences_dir: Directory containing one subdirectory per inference.
+
+    """
+
+    def __init__(self, inferences_dir: Path) -> None:
+        """Find the saved results, without opening any of them."""
+        self.inferences_dir = inferences_dir
+        self.formats: dict[str, IdataSaveFormat] = {}
+        for inference_dir in sorted(inferences_dir.iterdir()):
+            if inference_dir.is_dir():
+                idata_format = find_idata_format(inference_dir)
+                if idata_format is not None:
+                    self.formats[inference_dir.name] = idata_format
+        self._idatas: dict[str, az.InferenceData] = {}
+
+    @property
+    def names(self) -> list[str]:
+        """The names of the inferences with saved results."""
+        return list(self.formats)
+
+    def __contains__(self, name: str) -> bool:
+        """Check whether an inference has saved results."""
+        return name in self.formats
+
+    def __getitem__(self, name: str) -> az.InferenceData:
+        """Open an inference's results: see `open`."""
+        return self.open(name)
+
+    def open(self, name: str) -> az.InferenceData:
+        """Open an inference's results lazily, or get them if already open.
+
+        :param name: Name of an inference, i.e. of its directory.
+
+        """
+        if name not in self.formats:
+            msg = f"No saved results for inference {name}: see {self.names}."
+            raise KeyError(msg)
+        if name not in self._idatas:
+            idata = load_idata(
+                self.inferences_dir / name,
+                self.formats[name],
+                lazy=True,
+            )
+            if idata is None:
+                msg = f"Results for inference {name} have been removed."
+                raise KeyError(msg)
+            self._idatas[name] = idata
+        return self._idatas[name]
+
+    def open_group(self, name: str, group: str) -> xr.Dataset:
+        """Open one group of an inference's results lazily.
+
+        :param name: Name of an inference
+
+        :param group: Name of an InferenceData group, e.g. "posterior".
+
+        """
+        idata = self.open(name)
+        if group not in idata.groups():
+            msg = (
+                f"Inference {name} has no group {group}: see {idata.groups()}."
+            )
+            raise KeyError(msg)
+        return idata[group]
+
+    def index(self, names: list[str] | None = None) -> pd.DataFrame:
+        """Get a table describing each saved variable.
+
+        The table has one row per variable, with columns 'inference', 'group',
+        'variable', 'dims', 'shape' and 'dtype'. Building it opens the results
+        lazily, so only metadata and coordinates are read from disk, except
+        for results saved in json format.
+
+        :param names: Names of inferences to describe. By default all
+        inferences with saved results are described.
+
+        """
+        rows = []
+        for name in names if names is not None else self.names:
+            idata = self.open(name)
+            for group in idata.groups():
+                for variable, da in idata[group].data_vars.items():
+                    rows.append(
+                        {
+                            "inference": name,
+                            "group": group,
+                            "variable": variable,
+                            "dims": da.dims,
+                            "shape": da.shape,
+                            "dtype": str(da.dtype),
+                        },
+                    )
+        return pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+    def close(self) -> None:
+        """Close any open files and forget the opened results."""
+        for idata in self._idatas.values():
+            for group in idata.groups():
+                idata[group].close()
+        self._idatas.clear()
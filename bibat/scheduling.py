@@ -0,0 +1,155 @@
+"""Provides a budget of CPU cores that is shared between concurrent fits.
+
+When `bibat.fitting.run_all_inferences` is given a total number of cores, each
+slot in which an inference can run gets a share of them, and each inference
+uses the share of the slot that runs it: see
+`bibat.fitting.schedule_inferences`. The
+inference's fitting modes run one after another, so each mode can use the
+inference's whole share. Modes that run several fits at once, like `kfold`
+and `loo`, split their share between the fits: unless their options set
+'max_workers', they run as many fits at once as there are cores for all of
+each fit's chains, and each fit gets an equal part of the share.
+
+Finally, each call to CmdStan gets values of `parallel_chains` and, if the
+model was compiled with `STAN_THREADS`, `threads_per_chain` that fit its
+cores. Values that are set explicitly in `sample_kwargs` or mode options are
+never changed.
+
+The current budget is stored in a context variable, so that it is seen by
+fitting mode functions without being passed to them. Functions that run in
+other threads should be wrapped with `bibat.profiling.in_current_context`.
+
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any
+
+from bibat.inference_configuration import STAN_THREADS, is_true_option
+from bibat.warm_start import DEFAULT_CHAINS
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from bibat.inference_configuration import InferenceConfiguration
+
+_CORE_BUDGET: ContextVar[int | None] = ContextVar(
+    "bibat_core_budget",
+    default=None,
+)
+
+
+def get_core_budget() -> int | None:
+    """Get the number of cores available to the current fit, if limited."""
+    return _CORE_BUDGET.get()
+
+
+def set_core_budget(cores: int | None) -> None:
+    """Set the number of cores available from now on in the current context.
+
+    This is for worker processes whose budget never changes: elsewhere, use
+    `core_budget`.
+
+    :param cores: Number of cores, or None for no limit.
+
+    """
+    _CORE_BUDGET.set(None if cores is None else max(1, cores))
+
+
+@contextmanager
+def core_budget(cores: int | None) -> Iterator[None]:
+    """Set the number of cores available in the current context.
+
+    :param cores: Number of cores, or None for no limit.
+
+    """
+    token = _CORE_BUDGET.set(None if cores is None else max(1, cores))
+    try:
+        yield
+    finally:
+        _CORE_BUDGET.reset(token)
+
+
+@contextmanager
+def share_core_budget(n_jobs: int) -> Iterator[None]:
+    """Split the current budget equally between some concurrent jobs.
+
+    :param n_jobs: Number of jobs that will run at the same time.
+
+    """
+    budget = get_core_budget()
+    with core_budget(None if budget is None else budget // max(1, n_jobs)):
+        yield
+
+
+def allocate_cores(cores: int, n_jobs: int) -> list[int]:
+    """Split some cores as equally as possible between some jobs.
+
+    Any cores left over go to the first jobs. Each job gets at least one core,
+    even if there are more jobs than cores.
+
+    :param cores: Total number of cores
+
+    :param n_jobs: Number of jobs
+
+    """
+    base, extra = divmod(cores, n_jobs)
+    return [max(1, base + int(i < extra)) for i in range(n_jobs)]
+
+
+def get_max_workers(
+    max_workers: int | None,
+    n_jobs: int,
+    cores_per_job: int,
+) -> int:
+    """Choose how many of some jobs to run at the same time.
+
+    :param max_workers: A number chosen by the user, which is always used if
+    it is not None.
+
+    :param n_jobs: Number of jobs
+
+    :param cores_per_job: Number of cores that each job can use, e.g. its
+    number of chains.
+
+    """
+    if max_workers is not None:
+        return max_workers
+    budget = get_core_budget()
+    if budget is None:
+        return 1
+    return max(1, min(n_jobs, budget // max(1, cores_per_job)))
+
+
+def uses_stan_threads(ic: InferenceConfiguration) -> bool:
+    """Check if an inference's model is compiled with STAN_THREADS."""
+    return is_true_option((ic.cpp_options or {}).get(STAN_THREADS))
+
+
+def add_parallel_kwargs(
+    ic: InferenceConfiguration,
+    sample_kwargs: dict[str, Any],
+) -> dict[str, Any]:
+    """Add parallelism arguments that fit the current core budget.
+
+    If there is no budget, the arguments are returned unchanged.
+
+    :param ic: An InferenceConfiguration object
+
+    :param sample_kwargs: Keyword arguments for CmdStanModel.sample
+
+    """
+    budget = get_core_budget()
+    if budget is None:
+        return sample_kwargs
+    chains = sample_kwargs.get("chains") or DEFAULT_CHAINS
+    parallel_chains = sample_kwargs.get("parallel_chains") or min(
+        chains,
+        budget,
+    )
+    out = {"parallel_chains": parallel_chains}
+    if uses_stan_threads(ic):
+        out["threads_per_chain"] = max(1, budget // parallel_chains)
+    return out | sample_kwargs
@@ -0,0 +1,159 @@
+"""Provides memoised Stan inputs that are serialised to json only once.
+
+Getting a Stan input from prepared data, converting it to json and writing it
+to a file can be slow when the input is large. Since every fitting mode of an
+inference uses the same input, apart from a few small variables like
+'likelihood' or 'ix_train', this module makes sure that the Stan input function
+is called only once per prepared data object and function, and that each of the
+input's variables is encoded as json only once. Each mode's data file is then
+assembled from the pre-encoded variables plus its own overrides and written to
+the folder `stan_input` inside the inference directory, where it can be reused
+by any other mode that asks for the same overrides.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from typing import TYPE_CHECKING, Any
+
+from stanio.json import process_value
+
+from bibat.profiling import profile_stage
+from bibat.util import encode_stan_json_value
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Mapping
+    from pathlib import Path
+
+    from bibat.inference_configuration import InferenceConfiguration
+    from bibat.prepared_data import PreparedData
+
+STAN_INPUT_DIR = "stan_input"
+
+_STAN_INPUT_LOCK = threading.Lock()
+
+
+class StanInput:
+    """A Stan input dictionary whose variables are encoded as json once.
+
+    The attribute `fingerprint` is a hash of the encoded variables.
+
+    :param input_dict: A Stan input dictionary
+
+    """
+
+    def __init__(self, input_dict: Mapping[str, Any]) -> None:
+        """Encode each variable of the input dictionary."""
+        self.input_dict = input_dict
+        self.encoded = {
+            k: encode_stan_json_value(v) for k, v in input_dict.items()
+        }
+        h = hashlib.sha256()
+        for k, v in sorted(self.encoded.items()):
+            h.update(f"{json.dumps(k)}: {v}\n".encode())
+        self.fingerprint = h.hexdigest()
+        self.written: set[Path] = set()
+
+    def to_json(self, overrides: Mapping[str, Any] | None = None) -> str:
+        """Get the json string for this input, with some overridden variables.
+
+        :param overrides: Variables to add or replace.
+
+        """
+        encoded = self.encoded | {
+            k: encode_stan_json_value(v) for k, v in (overrides or {}).items()
+        }
+        items = (f"{json.dumps(k)}: {v}" for k, v in encoded.items())
+        return "{" + ", ".join(items) + "}"
+
+    def write(
+        self,
+        directory: Path,
+        overrides: Mapping[str, Any] | None = None,
+    ) -> Path:
+        """Write a data file for CmdStan and return its path.
+
+        The file name depends on the overrides, and each file is only written
+        once by a given StanInput object.
+
+        :param directory: Directory to write the file in.
+
+        :param overrides: Variables to add or replace.
+
+        """
+        name = "stan_input"
+        if overrides:
+            overrides_json = json.dumps(
+                {k: process_value(v) for k, v in overrides.items()},
+                sort_keys=True,
+            )
+            name += (
+                "-" + hashlib.sha256(overrides_json.encode()).hexdigest()[:12]
+            )
+        path = directory / f"{name}.json"
+        if path not in self.written:
+            directory.mkdir(parents=True, exist_ok=True)
+            with profile_stage("stan_input_write"):
+                path.write_text(self.to_json(overrides))
+            self.written.add(path)
+        return path
+
+
+def get_stan_input(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> StanInput:
+    """Get the Stan input for an inference, calling its function only once.
+
+    The result is memoised on the prepared data object, keyed by the Stan
+    input function object itself, so that e.g. two lambdas or two partials of
+    the same function with different arguments get their own inputs.
+
+    :param ic: An InferenceConfiguration object
+
+    :param data: A PreparedData object
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    """
+    sif = local_functions[ic.stan_input_function]
+    with _STAN_INPUT_LOCK:
+        cache = data._stan_inputs  # noqa: SLF001
+        if sif not in cache:
+            with profile_stage("stan_input"):
+                cache[sif] = StanInput(sif(data))
+        return cache[sif]
+
+
+def get_stan_input_data(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    overrides: Mapping[str, Any] | None = None,
+) -> str | Mapping[str, Any]:
+    """Get a value for the `data` argument of CmdStanModel.sample.
+
+    If the inference configuration knows its directory, this is the path of a
+    data file in the inference's `stan_input` folder. Otherwise it is a Stan
+    input dictionary.
+
+    :param ic: An InferenceConfiguration object
+
+    :param data: A PreparedData object
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    :param overrides: Variables to add or replace, e.g. {"likelihood": 0}
+
+    """
+    stan_input = get_stan_input(ic, data, local_functions)
+    if ic.inference_dir is None:
+        return {**stan_input.input_dict, **(overrides or {})}
+    directory = ic.inference_dir / STAN_INPUT_DIR
+    return str(stan_input.write(directory, overrides))
@@ -0,0 +1,298 @@
+"""Provides a cache of compiled Stan models.
+
+Compiling a Stan program is slow, and many inferences often share the same
+program. This module makes sure that each distinct combination of Stan source
+code (including any `#include`d files) and compiler options is compiled at most
+once, and that the resulting CmdStanModel object is reused. Each combination
+has its own executable in the folder `build` next to the Stan program, and
+compilation is guarded by a lock file, so that parallel processes never
+compile the same executable at the same time.
+
+Models can also be compiled ahead of time, in parallel, with
+`compile_stan_models` or the command `bibat compile`, so that fits do not wait
+for compilation.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from cmdstanpy import CmdStanModel
+from pydantic import BaseModel, Field
+
+from bibat.inference_configuration import (
+    InferenceConfiguration,
+    load_inference_configuration,
+)
+from bibat.profiling import profile_stage
+from bibat.util import file_lock
+
+STAN_DIR = Path("src") / "stan"
+BUILD_DIR = "build"
+HASH_LENGTH = 12
+LOCK_SUFFIX = ".lock"
+INCLUDE_PATTERN = re.compile(
+    r"^\s*#include\s+[<\"']?([^>\"'\s]+)[>\"']?",
+    re.MULTILINE,
+)
+
+_MODEL_CACHE: dict[str, CmdStanModel] = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def get_include_paths(
+    stan_file: Path,
+    stanc_options: dict | None = None,
+) -> list[Path]:
+    """Get the directories that stanc searches for included files.
+
+    :param stan_file: Path to a Stan program
+
+    :param stanc_options: stanc options, possibly including an entry
+    'include-paths' with a list or comma-separated string of directories.
+
+    """
+    include_paths = [stan_file.parent]
+    if stanc_options is not None and "include-paths" in stanc_options:
+        extra = stanc_options["include-paths"]
+        if isinstance(extra, str):
+            extra = extra.split(",")
+        include_paths += [Path(p) for p in extra]
+    return include_paths
+
+
+def find_included_files(
+    stan_file: Path,
+    stanc_options: dict | None = None,
+) -> list[Path]:
+    """Find the files that a Stan program includes, recursively.
+
+    :param stan_file: Path to a Stan program
+
+    :param stanc_options: stanc options, used to find the include paths.
+
+    """
+    include_paths = get_include_paths(stan_file, stanc_options)
+    found: list[Path] = []
+    to_search = [stan_file]
+    while len(to_search) > 0:
+        code = to_search.pop().read_text()
+        for name in INCLUDE_PATTERN.findall(code):
+            candidates = [
+                d / name for d in include_paths if (d / name).exists()
+            ]
+            if len(candidates) == 0:
+                msg = f"Could not find included file {name} in {include_paths}."
+                raise ValueError(msg)
+            if candidates[0] not in found:
+                found.append(candidates[0])
+                to_search.append(candidates[0])
+    return found
+
+
+def stan_model_hash(
+    stan_file: Path,
+    cpp_options: dict | None = None,
+    stanc_options: dict | None = None,
+) -> str:
+    """Get a hash identifying a Stan program and its compiler options.
+
+    The hash depends on the contents, not the modification times, of the Stan
+    file and any files that it includes.
+
+    :param stan_file: Path to a Stan program
+
+    :param cpp_options: C++ compiler options, as for CmdStanModel
+
+    :param stanc_options: stanc compiler options, as for CmdStanModel
+
+    """
+    h = hashlib.sha256()
+    for file in [stan_file, *find_included_files(stan_file, stanc_options)]:
+        h.update(file.name.encode())
+        h.update(file.read_bytes())
+    options = {"cpp_options": cpp_options, "stanc_options": stanc_options}
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def get_build_stan_file(stan_file: Path, key: str) -> Path:
+    """Get where a copy of a Stan program is compiled for some options.
+
+    Each combination of source code and options gets its own copy, and so its
+    own executable, in the folder `build` next to the Stan program.
+
+    :param stan_file: Path to a Stan program
+
+    :param key: The program's `stan_model_hash` with its options
+
+    """
+    name = f"{stan_file.stem}-{key[:HASH_LENGTH]}.stan"
+    return stan_file.parent / BUILD_DIR / name
+
+
+def load_stan_model(
+    stan_file: Path,
+    cpp_options: dict | None = None,
+    stanc_options: dict | None = None,
+) -> CmdStanModel:
+    """Get a compiled CmdStanModel, compiling it only if necessary.
+
+    Models are cached by `stan_model_hash`, so asking twice for the same
+    program and options returns the same object. Each hash is compiled from
+    its own copy of the program (see `get_build_stan_file`), so models that
+    share a Stan file but not options never overwrite each other's
+    executables. Compilation holds a lock file next to the copy, so that
+    other processes, including ones on other hosts sharing the folder, wait
+    for it and then reuse the executable instead of compiling it again.
+
+    :param stan_file: Path to a Stan program
+
+    :param cpp_options: C++ compiler options, as for CmdStanModel
+
+    :param stanc_options: stanc compiler options, as for CmdStanModel
+
+    """
+    key = stan_model_hash(stan_file, cpp_options, stanc_options)
+    with _MODEL_CACHE_LOCK:
+        if key not in _MODEL_CACHE:
+            build_file = get_build_stan_file(stan_file, key)
+            include_paths = get_include_paths(stan_file, stanc_options)
+            build_stanc_options = (stanc_options or {}) | {
+                "include-paths": [str(p.resolve()) for p in include_paths],
+            }
+            with (
+                file_lock(build_file.with_suffix(LOCK_SUFFIX)),
+                profile_stage("compile"),
+            ):
+                if not build_file.exists():
+                    build_file.write_text(stan_file.read_text())
+                _MODEL_CACHE[key] = CmdStanModel(
+                    stan_file=build_file,
+                    cpp_options=cpp_options,
+                    stanc_options=build_stanc_options,
+                )
+        return _MODEL_CACHE[key]
+
+
+def get_stan_model(ic: InferenceConfiguration) -> CmdStanModel:
+    """Get the compiled Stan model for an inference.
+
+    :param ic: An InferenceConfiguration object. Its `cpp_options` and
+    `stanc_options` are passed on to the compiler.
+
+    """
+    return load_stan_model(
+        STAN_DIR / ic.stan_file,
+        cpp_options=ic.cpp_options,
+        stanc_options=ic.stanc_options,
+    )
+
+
+def clear_stan_model_cache() -> None:
+    """Forget all cached Stan models."""
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE.clear()
+
+
+class CompileJob(BaseModel):
+    """A Stan program to compile, with its compiler options.
+
+    :param stan_file: Path to the Stan program
+
+    :param cpp_options: C++ compiler options, as for CmdStanModel
+
+    :param stanc_options: stanc compiler options, as for CmdStanModel
+
+    :param inferences: Names of the inferences that use this model.
+
+    """
+
+    stan_file: Path
+    cpp_options: dict | None = None
+    stanc_options: dict | None = None
+    inferences: list[str] = Field(default_factory=list)
+
+
+def find_compile_jobs(inference_dirs: list[Path]) -> list[CompileJob]:
+    """Find the distinct Stan models that some inferences use.
+
+    Models are distinct if their `stan_model_hash` values differ.
+
+    :param inference_dirs: Directories containing config.toml files
+
+    """
+    jobs: dict[str, CompileJob] = {}
+    for inference_dir in inference_dirs:
+        ic = load_inference_configuration(inference_dir)
+        stan_file = STAN_DIR / ic.stan_file
+        key = stan_model_hash(stan_file, ic.cpp_options, ic.stanc_options)
+        if key not in jobs:
+            jobs[key] = CompileJob(
+                stan_file=stan_file,
+                cpp_options=ic.cpp_options,
+                stanc_options=ic.stanc_options,
+            )
+        jobs[key].inferences.append(ic.name)
+    return list(jobs.values())
+
+
+def compile_job(job: CompileJob) -> float:
+    """Compile a Stan model if necessary and return the time taken in seconds.
+
+    :param job: A CompileJob object
+
+    """
+    start = time.perf_counter()
+    load_stan_model(job.stan_file, job.cpp_options, job.stanc_options)
+    return time.perf_counter() - start
+
+
+def compile_stan_models(
+    jobs: list[CompileJob],
+    max_workers: int | None = None,
+) -> list[tuple[CompileJob, float]]:
+    """Compile some Stan models in parallel.
+
+    Returns each job with the number of seconds it took, in the order that
+    they finished. Models that are already compiled with the same source code
+    and options (see `load_stan_model`) are not compiled again. If any models
+    fail to compile, a RuntimeError listing them is raised once all the models
+    have been attempted.
+
+    :param jobs: The models to compile, e.g. from `find_compile_jobs`.
+
+    :param max_workers: Number of models to compile at the same time. By
+    default, one per CPU core.
+
+    """
+    if len(jobs) == 0:
+        return []
+    n_workers = max_workers or os.cpu_count() or 1
+    results: list[tuple[CompileJob, float]] = []
+    failures: list[str] = []
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs))) as executor:
+        futures = {executor.submit(compile_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                seconds = future.result()
+            except Exception:
+                logging.exception("Compiling %s failed", job.stan_file)
+                failures.append(str(job.stan_file))
+            else:
+                logging.info("Compiled %s in %.1fs", job.stan_file, seconds)
+                results.append((job, seconds))
+    if len(failures) > 0:
+        msg = f"The following Stan programs failed to compile: {failures}."
+        raise RuntimeError(msg)
+    return results
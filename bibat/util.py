@@ -2,17 +2,32 @@
 
 from __future__ import annotations
 
+import json
+import sys
 from collections.abc import Mapping
+from contextlib import contextmanager
 from functools import wraps
 from io import StringIO
 from typing import TYPE_CHECKING, Annotated, Any, NewType, ParamSpec
 
+import numpy as np
 import pandas as pd
 from pydantic import PlainSerializer, PlainValidator
-from stanio.json import process_dictionary
+from stanio.json import process_dictionary, process_value
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if sys.platform == "win32":  # pragma: no cover
+    import msvcrt
+else:
+    import fcntl
 
 if TYPE_CHECKING:
-    from collections.abc import Callable
+    from collections.abc import Callable, Iterator
+    from pathlib import Path
 
 CoordDict = NewType("CoordDict", dict[str, list[str]])
 StanInputDict = Mapping[str, Any]
@@ -37,15 +52,97 @@ DfInPydanticModel = Annotated[
 
 
 def returns_stan_input(
-    func: Callable[P, Mapping[str, Any]],
-) -> Callable[P, Mapping[str, Any]]:
-    """Decorate a function so it returns a json-serialisable dictionary."""
+    func: Callable[P, Mapping[str, Any]] | None = None,
+    *,
+    numpy: bool = False,
+) -> Any:  # noqa: ANN401
+    """Decorate a function so it returns a json-serialisable dictionary.
+
+    Use either as `@returns_stan_input` or as `@returns_stan_input(numpy=True)`.
+
+    :param numpy: If True, the decorated function returns a dictionary whose
+    array-like values (e.g. pandas Series and DataFrames, lists and numpy
+    arrays) are contiguous numpy arrays rather than lists. This avoids creating
+    a Python object for every number, which is much faster for large inputs.
+    The resulting dictionary can be written with `write_stan_json` or encoded
+    value by value with `encode_stan_json_value`, but not with the json module.
+
+    """
+
+    def decorator(
+        f: Callable[P, Mapping[str, Any]],
+    ) -> Callable[P, Mapping[str, Any]]:
+        @wraps(f)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> Mapping[str, Any]:
+            out = f(*args, **kwargs)
+            if numpy:
+                return {k: to_numpy_stan_value(v) for k, v in out.items()}
+            return process_dictionary(out)
+
+        return wrapper
+
+    return decorator if func is None else decorator(func)
+
+
+def to_numpy_stan_value(v: Any) -> Any:  # noqa: ANN401
+    """Convert an array-like Stan input value to a contiguous numpy array.
+
+    Booleans are converted to integers, as Stan has no boolean type. Values
+    that are not array-like, such as numbers and dictionaries, are returned
+    unchanged.
+
+    """
+    if isinstance(v, bool | np.bool_):
+        return int(v)
+    if isinstance(v, pd.Series | pd.DataFrame | pd.Index):
+        v = v.to_numpy()
+    if isinstance(v, list | np.ndarray):
+        arr = np.ascontiguousarray(v)
+        if arr.dtype.kind in "iuf":
+            return arr
+        if arr.dtype.kind == "b":
+            return arr.astype(np.int64)
+    return v
 
-    @wraps(func)
-    def wrapper(*args: P.args, **kwargs: P.kwargs) -> Mapping[str, Any]:
-        return process_dictionary(func(*args, **kwargs))
 
-    return wrapper
+def encode_stan_json_value(v: Any) -> str:  # noqa: ANN401
+    """Encode a single Stan input value as json.
+
+    If the optional dependency orjson is installed, numeric numpy arrays with
+    no infinite or nan values are encoded directly from their buffers, which is
+    much faster than converting them to lists. Other values are processed with
+    `stanio.json.process_value` and encoded with the json module.
+
+    """
+    if (
+        orjson is not None
+        and isinstance(v, np.ndarray)
+        and v.dtype.kind in "iuf"
+        and (v.dtype.kind != "f" or np.isfinite(v).all())
+    ):
+        return orjson.dumps(
+            np.ascontiguousarray(v),
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        ).decode()
+    return json.dumps(process_value(v))
+
+
+def write_stan_json(path: Path, stan_input: Mapping[str, Any]) -> None:
+    """Write a Stan input dictionary to a json file, one value at a time.
+
+    :param path: Path of the file to write
+
+    :param stan_input: A Stan input dictionary, possibly with numpy array
+    values as returned by functions decorated with
+    `@returns_stan_input(numpy=True)`.
+
+    """
+    with path.open("w") as f:
+        f.write("{")
+        for i, (k, v) in enumerate(stan_input.items()):
+            f.write(("" if i == 0 else ", ") + f"{json.dumps(k)}: ")
+            f.write(encode_stan_json_value(v))
+        f.write("}")
 
 
 def one_encode(s: pd.Series) -> pd.Series:
@@ -73,3 +170,34 @@ def make_columns_lower_case(df: pd.DataFrame) -> pd.DataFrame:
     else:
         new.columns = pd.Index([c.lower() for c in new.columns])
     return new
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """Hold an exclusive lock on a file, waiting until no other process does.
+
+    The lock is released when the block ends or the process dies. It only
+    excludes other processes: threads in the same process need their own lock.
+
+    :param path: Path to a lock file, which is created if necessary.
+
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a+") as f:
+        if sys.platform == "win32":  # pragma: no cover
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if sys.platform == "win32":  # pragma: no cover
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.lockf(f, fcntl.LOCK_UN)
@@ -0,0 +1,241 @@
+"""Provides tools for validating prepared data tables less often.
+
+Validating large tables with pandera can take a noticeable share of the time
+it takes to load prepared data. To avoid repeating work, when
+`bibat.prepared_data.save_prepared_data` saves a PreparedData object it also
+saves a validation record with a content hash of each dataframe field and a
+fingerprint of the PreparedData class, which depends on the source code of
+the module where the class, and usually its schemas, are defined. When
+`bibat.prepared_data.load_prepared_data` loads a table whose content hash
+matches the record, and the class has not changed, the table is not validated
+again. Objects that are saved are assumed to have been validated when they
+were created.
+
+Tables saved in the json format come back from `pd.read_json` with guessed
+dtypes, e.g. a column of strings like "2017" that a schema coerced to `str`
+is read as integers, so their content hashes never match. For these tables
+the record also stores a hash of the serialised json, which is compared with
+the text in the file before parsing it, and the column types after
+validation, which are restored when the table is trusted. Tables with column
+types that cannot be restored exactly, like dates, are always validated.
+
+For huge tables, validation can also be limited to a random sample of rows by
+validating with `validate_table` inside a `sampled_validation` block. Columns
+are still coerced as the schema requires, but checks only see the sample.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from importlib.metadata import version
+from typing import TYPE_CHECKING, Any
+
+import pandas as pd
+
+from bibat.fingerprint import function_fingerprint
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+    import pandera as pa
+    from pandera.typing.common import DataFrameBase
+
+VALIDATION_FILE = "validation.json"
+VALIDATION_SUFFIX = ".validation.json"
+SAMPLE_RANDOM_STATE = 1234
+STR_TYPE = "str"
+
+_VALIDATION_SAMPLE: ContextVar[int | None] = ContextVar(
+    "bibat_validation_sample",
+    default=None,
+)
+
+
+@contextmanager
+def sampled_validation(n: int | None) -> Iterator[None]:
+    """Validate only a random sample of rows with `validate_table`.
+
+    :param n: Number of rows to check, or None to check all rows.
+
+    """
+    token = _VALIDATION_SAMPLE.set(n)
+    try:
+        yield
+    finally:
+        _VALIDATION_SAMPLE.reset(token)
+
+
+def validate_table(
+    schema: type[pa.DataFrameModel],
+    df: pd.DataFrame,
+) -> DataFrameBase:
+    """Validate a dataframe, using a sample of rows if this is enabled.
+
+    Use this in a PreparedData field validator instead of calling the schema's
+    `validate` method directly.
+
+    :param schema: A pandera DataFrameModel
+
+    :param df: The dataframe to validate
+
+    """
+    n = _VALIDATION_SAMPLE.get()
+    if n is None or len(df) <= n:
+        return schema.validate(df)
+    return schema.validate(df, sample=n, random_state=SAMPLE_RANDOM_STATE)
+
+
+def table_hash(df: pd.DataFrame) -> str | None:
+    """Get a hash of a dataframe's values, index, column names and dtypes.
+
+    Returns None if the dataframe has values that cannot be hashed.
+
+    :param df: A dataframe
+
+    """
+    try:
+        values = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    except TypeError:
+        return None
+    h = hashlib.sha256(repr(list(df.columns)).encode())
+    h.update(repr([str(dtype) for dtype in df.dtypes]).encode())
+    h.update(str(df.index.dtype).encode())
+    h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def json_table_hash(json_str: str) -> str:
+    """Get a hash of a dataframe serialised as json, which ignores dtypes.
+
+    :param json_str: A dataframe serialised with `DataFrame.to_json`
+
+    """
+    return hashlib.sha256(json_str.encode()).hexdigest()
+
+
+def get_column_types(df: pd.DataFrame) -> list[str] | None:
+    """Get column types that can be restored after reading a json table.
+
+    Columns of strings have the type "str" and numeric or boolean columns have
+    their dtype. Returns None if any other column type is present.
+
+    :param df: A dataframe
+
+    """
+    types = []
+    for _, col in df.items():  # noqa: PERF102
+        if (
+            pd.api.types.is_string_dtype(col.dtype)
+            and pd.api.types.infer_dtype(col) == "string"
+        ):
+            types.append(STR_TYPE)
+        elif pd.api.types.is_numeric_dtype(col.dtype) and not isinstance(
+            col.dtype,
+            pd.CategoricalDtype,
+        ):
+            types.append(str(col.dtype))
+        else:
+            return None
+    return types
+
+
+def restore_column_types(df: pd.DataFrame, types: list[str]) -> pd.DataFrame:
+    """Give a dataframe read from json the column types it was saved with.
+
+    :param df: A dataframe read with `pd.read_json` without dtype inference
+
+    :param types: Column types returned by `get_column_types`
+
+    """
+    return pd.DataFrame(
+        {
+            name: col.astype(str) if t == STR_TYPE else col.astype(t)
+            for (name, col), t in zip(df.items(), types, strict=True)
+        },
+        index=df.index,
+    )
+
+
+def schema_fingerprint(cls: type) -> str:
+    """Get a hash that changes when a class's validation might change.
+
+    :param cls: A PreparedData subclass
+
+    """
+    h = hashlib.sha256(function_fingerprint(cls).encode())
+    h.update(version("pandera").encode())
+    return h.hexdigest()
+
+
+def get_validation_record_path(path: Path) -> Path:
+    """Get where the validation record for some saved prepared data goes.
+
+    :param path: Path to a prepared data json file or directory
+
+    """
+    if path.is_dir():
+        return path / VALIDATION_FILE
+    return path.with_name(path.stem + VALIDATION_SUFFIX)
+
+
+def save_validation_record(
+    path: Path,
+    cls: type,
+    tables: dict[str, pd.DataFrame],
+    *,
+    json_tables: bool = False,
+) -> None:
+    """Record that some saved tables have been validated.
+
+    :param path: Path to a prepared data json file or directory
+
+    :param cls: The class of the saved PreparedData object
+
+    :param tables: Map from field names to validated dataframes
+
+    :param json_tables: If True, the tables were saved in json form, so the
+    hashes of their json text and their column types are also recorded.
+
+    """
+    hashes = {field: table_hash(df) for field, df in tables.items()}
+    record: dict[str, Any] = {
+        "schema": schema_fingerprint(cls),
+        "tables": {k: v for k, v in hashes.items() if v is not None},
+    }
+    if json_tables:
+        column_types = {
+            field: get_column_types(df) for field, df in tables.items()
+        }
+        record["json_tables"] = {
+            field: {"hash": json_table_hash(df.to_json()), "types": types}
+            for field, df in tables.items()
+            if (types := column_types[field]) is not None
+        }
+    get_validation_record_path(path).write_text(json.dumps(record))
+
+
+def load_validation_record(path: Path, cls: type) -> dict[str, Any]:
+    """Get the record of tables that were validated with the current schema.
+
+    The record has an entry 'tables' with each table's content hash and, for
+    tables saved as json, an entry 'json_tables' with the hash of each table's
+    json text and its column types. Returns an empty dictionary if there is no
+    record or the schema changed.
+
+    :param path: Path to a prepared data json file or directory
+
+    :param cls: The class that will be used to load the prepared data
+
+    """
+    record_path = get_validation_record_path(path)
+    if not record_path.exists():
+        return {}
+    record = json.loads(record_path.read_text())
+    if record.get("schema") != schema_fingerprint(cls):
+        return {}
+    return record
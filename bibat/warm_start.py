@@ -0,0 +1,238 @@
+"""Provides warm starts for sampling a model again with similar data.
+
+Whenever an inference's posterior mode runs, the sampler's adapted step sizes
+and inverse metrics, plus initial values drawn from the posterior, are saved
+in the file `warm_start.json` in the inference directory. Fitting modes whose
+options include `warm_start = true`, i.e. `kfold` and `posterior`, then start
+their chains from these values, so they can use a much shorter warmup, or
+none at all: with `iter_warmup = 0` adaptation is turned off and the saved
+step sizes and metrics are used as they are. For example:
+
+```toml
+[mode_options.kfold]
+n_folds = 10
+warm_start = true
+iter_warmup = 50
+```
+
+A warm start is only used if the Stan program, compiler options, Stan input
+function and Stan input have not changed since it was saved, so that e.g. new
+prepared data do not start from a posterior that no longer fits them.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from pydantic import BaseModel
+from stanio.json import process_dictionary
+
+from bibat.fingerprint import function_fingerprint
+from bibat.stan_input import get_stan_input
+from bibat.stan_model import STAN_DIR, stan_model_hash
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from cmdstanpy import CmdStanMCMC, CmdStanModel
+
+    from bibat.inference_configuration import InferenceConfiguration
+    from bibat.prepared_data import PreparedData
+
+WARM_START_FILE = "warm_start.json"
+WARM_START_OPTION = "warm_start"
+DEFAULT_CHAINS = 4
+
+
+class WarmStart(BaseModel):
+    """What a previous run of the sampler learned, per chain.
+
+    :param model_hash: `bibat.stan_model.stan_model_hash` of the model that
+    was sampled.
+
+    :param input_hash: `get_input_hash` of the Stan input that the model was
+    sampled with. Warm starts saved without one are never used.
+
+    :param metric_type: The type of metric, e.g. "diag_e" or "dense_e"
+
+    :param step_size: Adapted step size for each chain
+
+    :param inv_metric: Adapted inverse metric for each chain, as a list of
+    vectors or of matrices depending on the metric type.
+
+    :param inits: Initial values for each chain, drawn from the previous run's
+    draws.
+
+    """
+
+    model_hash: str
+    input_hash: str | None = None
+    metric_type: str
+    step_size: list[float]
+    inv_metric: list[Any]
+    inits: list[dict[str, Any]]
+
+
+def get_model_hash(ic: InferenceConfiguration) -> str:
+    """Get the hash of an inference's Stan program and compiler options."""
+    return stan_model_hash(
+        STAN_DIR / ic.stan_file,
+        cpp_options=ic.cpp_options,
+        stanc_options=ic.stanc_options,
+    )
+
+
+def get_input_hash(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> str:
+    """Get a hash of an inference's Stan input function and Stan input.
+
+    The Stan input covers everything from the prepared data that the model
+    sees, so it is hashed instead of the prepared data file.
+
+    """
+    sif = local_functions[ic.stan_input_function]
+    h = hashlib.sha256(function_fingerprint(sif).encode())
+    h.update(get_stan_input(ic, data, local_functions).fingerprint.encode())
+    return h.hexdigest()
+
+
+def save_warm_start(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    model: CmdStanModel,
+    mcmc: CmdStanMCMC,
+) -> None:
+    """Save a warm start for an inference from the results of sampling.
+
+    Nothing is saved if the inference has no directory or if the sampler did
+    not adapt, e.g. because it ran with `fixed_param=True`.
+
+    :param ic: An InferenceConfiguration object
+
+    :param data: The PreparedData object that the model was sampled with
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    :param model: The inference's model. Only its parameters are saved as
+    initial values.
+
+    :param mcmc: The results of sampling the inference's model.
+
+    """
+    if ic.inference_dir is None or mcmc.step_size is None:
+        return
+    parameters = model.src_info().get("parameters", {})
+    inits = mcmc.create_inits(seed=1234, chains=mcmc.chains)
+    warm_start = WarmStart(
+        model_hash=get_model_hash(ic),
+        input_hash=get_input_hash(ic, data, local_functions),
+        metric_type=mcmc.metric_type,
+        step_size=mcmc.step_size.tolist(),
+        inv_metric=mcmc.inv_metric.tolist(),
+        inits=[
+            process_dictionary(
+                {k: v for k, v in chain_inits.items() if k in parameters},
+            )
+            for chain_inits in (inits if isinstance(inits, list) else [inits])
+        ],
+    )
+    path = ic.inference_dir / WARM_START_FILE
+    path.write_text(warm_start.model_dump_json())
+
+
+def load_warm_start(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+) -> WarmStart | None:
+    """Load an inference's warm start, if there is a usable one.
+
+    :param ic: An InferenceConfiguration object
+
+    :param data: A PreparedData object
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    """
+    if ic.inference_dir is None:
+        return None
+    path = ic.inference_dir / WARM_START_FILE
+    if not path.exists():
+        logging.info("No warm start found for inference %s", ic.name)
+        return None
+    warm_start = WarmStart.model_validate_json(path.read_text())
+    if warm_start.model_hash != get_model_hash(ic) or (
+        warm_start.input_hash != get_input_hash(ic, data, local_functions)
+    ):
+        logging.info("Ignoring out of date warm start for %s", ic.name)
+        return None
+    return warm_start
+
+
+def get_warm_start_kwargs(
+    warm_start: WarmStart,
+    sample_kwargs: dict[str, Any],
+) -> dict[str, Any]:
+    """Get keyword arguments for CmdStanModel.sample that use a warm start.
+
+    If the new run has more chains than the warm start, the warm start's
+    chains are reused in turn.
+
+    :param warm_start: A WarmStart object
+
+    :param sample_kwargs: The keyword arguments that the new run would use
+    without a warm start.
+
+    """
+    chains = sample_kwargs.get("chains") or DEFAULT_CHAINS
+    ix = [i % len(warm_start.step_size) for i in range(chains)]
+    out = {
+        "step_size": [warm_start.step_size[i] for i in ix],
+        "metric": warm_start.metric_type,
+        "inv_metric": [np.array(warm_start.inv_metric[i]) for i in ix],
+        "inits": [warm_start.inits[i % len(warm_start.inits)] for i in ix],
+    }
+    if sample_kwargs.get("iter_warmup") == 0:
+        out["adapt_engaged"] = False
+    return out
+
+
+def add_warm_start(
+    ic: InferenceConfiguration,
+    data: PreparedData,
+    local_functions: dict[str, Callable],
+    sample_kwargs: dict[str, Any],
+    mode_options: dict[str, Any],
+) -> dict[str, Any]:
+    """Add a warm start to some sampler arguments, if one is wanted.
+
+    :param ic: An InferenceConfiguration object
+
+    :param data: A PreparedData object
+
+    :param local_functions: Dictionary of local functions, including the
+    inference's Stan input function.
+
+    :param sample_kwargs: Keyword arguments for CmdStanModel.sample
+
+    :param mode_options: A fitting mode's options. A warm start is used if
+    these have the entry `warm_start = true` and a usable warm start has been
+    saved.
+
+    """
+    if not mode_options.get(WARM_START_OPTION, False):
+        return sample_kwargs
+    warm_start = load_warm_start(ic, data, local_functions)
+    if warm_start is None:
+        return sample_kwargs
+    return sample_kwargs | get_warm_start_kwargs(warm_start, sample_kwargs)
@@ -0,0 +1,353 @@
+"""Provides a queue of fitting tasks that any number of workers can share.
+
+The queue is a folder of small json files, one per task, so it works for
+workers on different hosts as long as they share a filesystem, e.g. over NFS,
+and need no database or external scheduler. Each task moves between four
+subfolders:
+
+- `pending`: waiting to be claimed. A worker claims a task by renaming its
+  file into `claimed`, which only one worker can do.
+- `claimed`: being run. While a task runs, its worker touches the file
+  regularly. Tasks whose files have not been touched for a while, e.g.
+  because their worker died, can be put back in `pending`: see
+  `requeue_stale_tasks`.
+- `done`: finished successfully.
+- `failed`: raised an error. The error is saved in the task file, and tasks
+  that depend on a failed task fail too.
+
+Tasks are only claimed once all the tasks they depend on are done. Workers
+claim tasks in the order they were added.
+
+The objects needed to run a batch of tasks, such as fitting modes and local
+functions, are pickled once per batch in the subfolder `runs`, along with the
+working directory and import path of the process that added them. These are
+restored before the objects are unpickled, so the objects should be defined
+in modules that every worker can import, e.g. an installed analysis package.
+
+This module only handles the queue: running tasks is up to the function
+passed to `run_worker`, e.g. `bibat.fitting.run_queued_task`.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+import uuid
+from enum import Enum
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from pydantic import BaseModel, Field
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+RUNS = "runs"
+HEARTBEAT_INTERVAL = 30.0
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_STALE_AFTER = 600.0
+
+
+class TaskKind(str, Enum):
+    """An enum for the kinds of task in a work queue."""
+
+    fit_piece = "fit_piece"
+    inference = "inference"
+
+
+class Task(BaseModel):
+    """A piece of work in a queue.
+
+    :param id: A unique identifier. Tasks are claimed in order of their ids.
+
+    :param run: Identifier of the batch of tasks that this task belongs to.
+
+    :param kind: What kind of task this is.
+
+    :param inference_dir: The directory of the inference to work on.
+
+    :param mode: For pieces of a fitting mode, the mode's name.
+
+    :param piece: For pieces of a fitting mode, the index of the piece.
+
+    :param depends_on: Ids of tasks that must be done before this one.
+
+    :param error: For failed tasks, a description of the error.
+
+    """
+
+    id: str
+    run: str
+    kind: TaskKind
+    inference_dir: Path
+    mode: str | None = None
+    piece: int | None = None
+    depends_on: list[str] = Field(default_factory=list)
+    error: str | None = None
+
+
+class RunContext(BaseModel):
+    """Where and how to run the tasks in a batch.
+
+    :param cwd: Working directory of the process that added the tasks.
+
+    :param sys_path: Import path of the process that added the tasks.
+
+    """
+
+    cwd: Path
+    sys_path: list[str]
+
+
+def new_run_id() -> str:
+    """Get an identifier for a batch of tasks that sorts by creation time."""
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def get_worker_id() -> str:
+    """Get an identifier for the current process."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def make_queue_dirs(queue_dir: Path) -> None:
+    """Make the subfolders of a queue folder."""
+    for name in [PENDING, CLAIMED, DONE, FAILED, RUNS]:
+        (queue_dir / name).mkdir(parents=True, exist_ok=True)
+
+
+def write_atomically(path: Path, text: str) -> None:
+    """Write a file so that other processes never see it half-written."""
+    tmp_path = path.with_name(f".{path.name}.{get_worker_id()}.tmp")
+    tmp_path.write_text(text)
+    tmp_path.replace(path)
+
+
+def save_run(queue_dir: Path, run_id: str, objects: dict[str, Any]) -> None:
+    """Save the objects that are needed to run a batch of tasks.
+
+    :param queue_dir: A queue folder
+
+    :param run_id: Identifier of the batch
+
+    :param objects: Picklable objects, e.g. fitting modes and local functions.
+
+    """
+    make_queue_dirs(queue_dir)
+    context = RunContext(cwd=Path.cwd(), sys_path=sys.path)
+    run_dir = queue_dir / RUNS
+    (run_dir / f"{run_id}.pkl").write_bytes(pickle.dumps(objects))
+    write_atomically(run_dir / f"{run_id}.json", context.model_dump_json())
+
+
+def load_run(queue_dir: Path, run_id: str) -> dict[str, Any]:
+    """Load the objects needed to run a batch of tasks.
+
+    The batch's working directory becomes the current working directory, and
+    its import path is added to the current one before unpickling.
+
+    """
+    run_dir = queue_dir / RUNS
+    context = RunContext.model_validate_json(
+        (run_dir / f"{run_id}.json").read_text(),
+    )
+    os.chdir(context.cwd)
+    sys.path.extend(p for p in context.sys_path if p not in sys.path)
+    return pickle.loads((run_dir / f"{run_id}.pkl").read_bytes())  # noqa: S301
+
+
+def enqueue(queue_dir: Path, tasks: list[Task]) -> None:
+    """Add some tasks to a queue."""
+    make_queue_dirs(queue_dir)
+    for task in tasks:
+        path = queue_dir / PENDING / f"{task.id}.json"
+        write_atomically(path, task.model_dump_json())
+
+
+def get_task_ids(queue_dir: Path, status: str) -> set[str]:
+    """Get the ids of the tasks with a status, e.g. "done"."""
+    return {p.stem for p in (queue_dir / status).glob("*.json")}
+
+
+def claim_task(queue_dir: Path) -> Task | None:
+    """Claim the first pending task whose dependencies are done, if any.
+
+    Pending tasks that depend on a failed task are marked as failed.
+
+    """
+    done = get_task_ids(queue_dir, DONE)
+    failed = get_task_ids(queue_dir, FAILED)
+    for path in sorted((queue_dir / PENDING).glob("*.json")):
+        try:
+            task = Task.model_validate_json(path.read_text())
+        except FileNotFoundError:
+            continue
+        if not (set(task.depends_on) <= done | failed):
+            continue
+        claimed_path = queue_dir / CLAIMED / path.name
+        try:
+            path.rename(claimed_path)
+        except FileNotFoundError:
+            continue
+        failed_deps = sorted(set(task.depends_on) & failed)
+        if len(failed_deps) > 0:
+            finish_task(queue_dir, task, f"Dependencies failed: {failed_deps}")
+            failed.add(task.id)
+            continue
+        return task
+    return None
+
+
+def finish_task(queue_dir: Path, task: Task, error: str | None = None) -> None:
+    """Mark a claimed task as done or, if there was an error, as failed."""
+    status = DONE if error is None else FAILED
+    task = task.model_copy(update={"error": error})
+    write_atomically(
+        queue_dir / status / f"{task.id}.json",
+        task.model_dump_json(),
+    )
+    (queue_dir / CLAIMED / f"{task.id}.json").unlink(missing_ok=True)
+
+
+def requeue_stale_tasks(queue_dir: Path, max_age: float) -> list[str]:
+    """Put claimed tasks whose workers seem to have died back in the queue.
+
+    Returns the ids of the requeued tasks.
+
+    :param queue_dir: A queue folder
+
+    :param max_age: Number of seconds after which a claimed task whose file
+    has not been touched is treated as abandoned. This should be much longer
+    than `HEARTBEAT_INTERVAL`.
+
+    """
+    requeued = []
+    now = time.time()
+    for path in (queue_dir / CLAIMED).glob("*.json"):
+        try:
+            if now - path.stat().st_mtime > max_age:
+                path.rename(queue_dir / PENDING / path.name)
+                requeued.append(path.stem)
+        except FileNotFoundError:
+            continue
+    for task_id in requeued:
+        logging.warning("Requeued abandoned task %s", task_id)
+    return requeued
+
+
+def keep_alive(path: Path, stop: threading.Event) -> None:
+    """Touch a claimed task's file regularly until told to stop."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            path.touch()
+        except FileNotFoundError:
+            return
+
+
+def run_claimed_task(
+    queue_dir: Path,
+    task: Task,
+    runner: Callable[[Task, dict[str, Any]], None],
+    runs: dict[str, dict[str, Any]],
+) -> bool:
+    """Run a claimed task, record the outcome and return whether it worked.
+
+    :param runs: Map from run ids to loaded run objects, which is updated if
+    the task's run is not in it.
+
+    """
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=keep_alive,
+        args=(queue_dir / CLAIMED / f"{task.id}.json", stop),
+        daemon=True,
+    )
+    heartbeat.start()
+    logging.info("Running task %s", task.id)
+    try:
+        if task.run not in runs:
+            runs[task.run] = load_run(queue_dir, task.run)
+        runner(task, runs[task.run])
+    except Exception as e:
+        logging.exception("Task %s failed", task.id)
+        finish_task(queue_dir, task, repr(e))
+        return False
+    else:
+        finish_task(queue_dir, task)
+        return True
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def is_finished(queue_dir: Path, run_id: str | None = None) -> bool:
+    """Check if no tasks are pending or claimed, optionally for one run."""
+    return not any(
+        run_id is None or task_id.startswith(run_id)
+        for status in [PENDING, CLAIMED]
+        for task_id in get_task_ids(queue_dir, status)
+    )
+
+
+def run_worker(  # noqa: PLR0913
+    queue_dir: Path,
+    runner: Callable[[Task, dict[str, Any]], None],
+    *,
+    run_id: str | None = None,
+    wait: bool = True,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    stale_after: float | None = None,
+) -> int:
+    """Claim and run tasks until the queue is finished.
+
+    Returns the number of tasks that this worker ran.
+
+    :param queue_dir: A queue folder
+
+    :param runner: A function that runs a task, given the task and the objects
+    saved for its run.
+
+    :param run_id: If given, stop once this run's tasks are finished, rather
+    than once the whole queue is.
+
+    :param wait: If True, keep waiting while there are tasks that cannot be
+    claimed yet, e.g. because other workers are running their dependencies.
+    Otherwise stop as soon as there is nothing to claim.
+
+    :param poll_interval: Number of seconds to wait between checks.
+
+    :param stale_after: If given, claimed tasks that have not been touched for
+    this many seconds are put back in the queue: see `requeue_stale_tasks`.
+
+    """
+    make_queue_dirs(queue_dir)
+    runs: dict[str, dict[str, Any]] = {}
+    n_run = 0
+    while True:
+        if stale_after is not None:
+            requeue_stale_tasks(queue_dir, stale_after)
+        task = claim_task(queue_dir)
+        if task is not None:
+            run_claimed_task(queue_dir, task, runner, runs)
+            n_run += 1
+        elif not wait or is_finished(queue_dir, run_id):
+            return n_run
+        else:
+            time.sleep(poll_interval)
+
+
+def get_tasks(queue_dir: Path, status: str, run_id: str) -> list[Task]:
+    """Get the tasks of a run that have a status, e.g. "failed"."""
+    return [
+        Task.model_validate_json(path.read_text())
+        for path in sorted((queue_dir / status).glob(f"{run_id}*.json"))
+    ]
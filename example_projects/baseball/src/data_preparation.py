@@ -7,8 +7,7 @@ each take in a dataframe of measurements and return a PreparedData object.
 
 from __future__ import annotations
 
-import json
-import logging
+from functools import partial
 from pathlib import Path
 from typing import TYPE_CHECKING
 
@@ -17,8 +16,15 @@ import pandera as pa
 from pandera.typing import DataFrame, Series
 from pydantic import field_validator
 
+from bibat.data_preparation import (
+    DataPreparation,
+    read_raw_csv,
+    run_data_preparations,
+)
 from bibat.prepared_data import PreparedData
+from bibat.prepared_data import load_prepared_data as load_bibat_prepared_data
 from bibat.util import CoordDict, DfInPydanticModel
+from bibat.validation import validate_table
 
 if TYPE_CHECKING:
     from pandera.typing.common import DataFrameBase
@@ -34,6 +40,32 @@ RAW_DATA_FILES = {
         RAW_DIR / "bdb-apps.csv",
     ],
 }
+MAX_WORKERS = 2
+BATTING_COLS = ["yearID", "playerID", "AB", "BB", "HBP", "SF", "H"]
+BATTING_DTYPES = {
+    "yearID": "int16",
+    "playerID": "string",
+    **dict.fromkeys(BATTING_COLS[2:], "Int32"),
+}
+# Only the needed rows and columns of the baseballdatabank tables are read.
+# The appearances table is not filtered by season, as a player is treated as a
+# pitcher based on all of their appearances.
+read_batting = partial(
+    read_raw_csv,
+    usecols=BATTING_COLS,
+    dtype=BATTING_DTYPES,
+    predicate="yearID >= 2017 and AB >= 20",
+    chunksize=100_000,
+)
+read_appearances = partial(
+    read_raw_csv,
+    usecols=["playerID", "G_p", "G_all"],
+    dtype={"playerID": "string", "G_p": "Int32", "G_all": "Int32"},
+)
+RAW_DATA_READERS = {
+    "2006": [read_raw_csv],
+    "bdb": [read_batting, read_batting, read_appearances],
+}
 
 
 class BaseballMeasurementsDF(pa.SchemaModel):
@@ -58,7 +90,7 @@ class BaseballPreparedData(PreparedData):
         v: DfInPydanticModel,
     ) -> DataFrameBase[BaseballMeasurementsDF]:
         """Validate the measurements table."""
-        return BaseballMeasurementsDF.validate(v)
+        return validate_table(BaseballMeasurementsDF, v)
 
 
 def prepare_data_2006(measurements_raw: pd.DataFrame) -> BaseballPreparedData:
@@ -158,31 +190,30 @@ def prepare_data_bdb(
 
 def prepare_data() -> None:
     """Run main function."""
-    raw_data = {
-        k: [pd.read_csv(file, index_col=None) for file in v]
-        for k, v in RAW_DATA_FILES.items()
-    }
     data_preparation_functions_to_run = {
         "2006": prepare_data_2006,
         "bdb": prepare_data_bdb,
     }
-    for name, prepare_data_func in data_preparation_functions_to_run.items():
-        logging.info("Preparing %s data", name)
-        prepared_data = prepare_data_func(*raw_data[name])
-        output_file = prepared_data.name + ".json"
-        output_path = PREPARED_DIR / output_file
-        if not PREPARED_DIR.exists():
-            PREPARED_DIR.mkdir()
-        with output_path.open("w") as f:
-            f.write(prepared_data.model_dump_json())
+    preparations = [
+        DataPreparation(
+            name=name,
+            func=prepare_data_func,
+            raw_files=RAW_DATA_FILES[name],
+            reader=RAW_DATA_READERS[name],
+        )
+        for name, prepare_data_func in data_preparation_functions_to_run.items()
+    ]
+    run_data_preparations(preparations, PREPARED_DIR, max_workers=MAX_WORKERS)
 
 
 def load_prepared_data(path: Path | str) -> BaseballPreparedData:
-    """Load a prepared data object from a path."""
-    if isinstance(path, str):
-        path = Path(path)
-    with path.open("r") as f:
-        return BaseballPreparedData(**json.load(f))
+    """Load a prepared data object from a path.
+
+    Tables that have already been validated are not validated again: see
+    `bibat.validation`.
+
+    """
+    return load_bibat_prepared_data(Path(path), BaseballPreparedData)
 
 
 if __name__ == "__main__":
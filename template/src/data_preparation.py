@@ -7,26 +7,29 @@ each take in a dataframe of measurements and return a PreparedData object.
 
 from __future__ import annotations
 
-import json
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import numpy as np
-import pandas as pd
 import pandera as pa
 from pandera.typing import DataFrame, Series
 from pydantic import field_validator
 
+from bibat.data_preparation import DataPreparation, run_data_preparations
 from bibat.prepared_data import PreparedData
+from bibat.prepared_data import load_prepared_data as load_bibat_prepared_data
 from bibat.util import CoordDict, DfInPydanticModel, make_columns_lower_case
+from bibat.validation import validate_table
 
 if TYPE_CHECKING:
+    import pandas as pd
     from pandera.typing.common import DataFrameBase
 
 HERE = Path(__file__).parent
 RAW_DIR = HERE / ".." / "data" / "raw"
 PREPARED_DIR = HERE / ".." / "data" / "prepared"
 RAW_DATA_FILES = {"measurements": RAW_DIR / "raw_measurements.csv"}
+MAX_WORKERS = None  # set this to a number to prepare data in parallel
 
 
 class ExampleMeasurementsDF(pa.DataFrameModel):
@@ -54,7 +57,7 @@ class ExamplePreparedData(PreparedData):
         v: DfInPydanticModel,
     ) -> DataFrameBase[ExampleMeasurementsDF]:
         """Validate the measurements table."""
-        return ExampleMeasurementsDF.validate(v)
+        return validate_table(ExampleMeasurementsDF, v)
 
 
 def prepare_data_interaction(
@@ -139,30 +142,38 @@ def process_measurements(measurements: pd.DataFrame) -> pd.DataFrame:
 
 
 def prepare_data() -> None:
-    """Run main function."""
-    raw_data = {
-        k: pd.read_csv(v, index_col=None) for k, v in RAW_DATA_FILES.items()
-    }
-    for prepare_data_func in [
-        prepare_data_interaction,
-        prepare_data_no_interaction,
-        prepare_data_fake_interaction,
-    ]:
-        prepared_data = prepare_data_func(raw_data["measurements"])
-        output_file = prepared_data.name + ".json"
-        output_path = PREPARED_DIR / output_file
-        if not PREPARED_DIR.exists():
-            PREPARED_DIR.mkdir()
-        with output_path.open("w") as f:
-            f.write(prepared_data.model_dump_json())
+    """Run main function.
+
+    Raw tables are cached in `data/prepared/.cache`, and preparations whose
+    raw data and code have not changed since they last ran are skipped. Only
+    changes to this module are noticed automatically: if a preparation uses
+    code from another module, list that module's file in the preparation's
+    `dependencies`.
+
+    """
+    preparations = [
+        DataPreparation(
+            name=prepare_data_func.__name__,
+            func=prepare_data_func,
+            raw_files=[RAW_DATA_FILES["measurements"]],
+        )
+        for prepare_data_func in [
+            prepare_data_interaction,
+            prepare_data_no_interaction,
+            prepare_data_fake_interaction,
+        ]
+    ]
+    run_data_preparations(preparations, PREPARED_DIR, max_workers=MAX_WORKERS)
 
 
 def load_prepared_data(path: Path | str) -> ExamplePreparedData:
-    """Load a prepared data object from a path."""
-    if isinstance(path, str):
-        path = Path(path)
-    with path.open("r") as f:
-        return ExamplePreparedData(**json.load(f))
+    """Load a prepared data object from a path.
+
+    Tables that have already been validated are not validated again: see
+    `bibat.validation`.
+
+    """
+    return load_bibat_prepared_data(Path(path), ExamplePreparedData)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,16 @@
 from pathlib import Path
 
 from bibat.fitting import run_all_inferences
-from bibat.fitting_mode import kfold_mode, posterior_mode, prior_mode
+from bibat.fitting_mode import (
+    kfold_mode,
+    laplace_mode,
+    loo_mode,
+    optimize_mode,
+    pathfinder_mode,
+    pathfinder_prior_mode,
+    posterior_mode,
+    prior_mode,
+)
 from src.data_preparation import load_prepared_data
 from src.stan_input_functions import (
     get_stan_input_interaction,
@@ -17,6 +26,11 @@ FITTING_MODE_OPTIONS = {
     "prior": prior_mode,
     "posterior": posterior_mode,
     "kfold": kfold_mode,
+    "loo": loo_mode,
+    "pathfinder": pathfinder_mode,
+    "pathfinder_prior": pathfinder_prior_mode,
+    "laplace": laplace_mode,
+    "optimize": optimize_mode,
 }
 LOCAL_FUNCTIONS = {
     "get_stan_input_interaction": get_stan_input_interaction,
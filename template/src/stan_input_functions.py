@@ -1,30 +1,32 @@
 """Functions for generating input to Stan from prepared data."""
 
+import numpy as np
 import pandas as pd
 
 from bibat.util import StanInputDict, returns_stan_input
 from src.data_preparation import ExamplePreparedData
 
 
-@returns_stan_input
+@returns_stan_input(numpy=True)
 def get_stan_input(
     measurements: pd.DataFrame,
     x_cols: list[str],
 ) -> StanInputDict:
     """General function for creating a Stan input."""
+    ix = np.arange(1, len(measurements) + 1)
     return {
         "N": len(measurements),
         "N_train": len(measurements),
         "N_test": len(measurements),
         "K": len(x_cols),
-        "x": measurements[x_cols].to_numpy().tolist(),
-        "y": measurements["y"].tolist(),
-        "ix_train": [i + 1 for i in range(len(measurements))],
-        "ix_test": [i + 1 for i in range(len(measurements))],
+        "x": measurements[x_cols].to_numpy(),
+        "y": measurements["y"].to_numpy(),
+        "ix_train": ix,
+        "ix_test": ix,
     }
 
 
-@returns_stan_input
+@returns_stan_input(numpy=True)
 def get_stan_input_interaction(
     prepared_data: ExamplePreparedData,
 ) -> StanInputDict:
@@ -32,7 +34,7 @@ def get_stan_input_interaction(
     return get_stan_input(prepared_data.measurements, ["x1", "x2", "x1:x2"])
 
 
-@returns_stan_input
+@returns_stan_input(numpy=True)
 def get_stan_input_no_interaction(
     prepared_data: ExamplePreparedData,
 ) -> StanInputDict:
@@ -0,0 +1,268 @@
+"""Unit tests for the checkpoint module."""
+
+from pathlib import Path
+
+import arviz as az
+import numpy as np
+import pytest
+import toml
+import xarray as xr
+
+from bibat.checkpoint import (
+    checkpoint_scope,
+    checkpointing,
+    get_checkpoint_dir,
+    load_checkpoint,
+    load_fit_checkpoint,
+    save_checkpoint,
+    save_fit_checkpoint,
+    start_checkpoint,
+)
+from bibat.fitting import IdataWriter, load_idata, run_and_save_inference
+from bibat.fitting_mode import FittingMode, IdataTarget
+from bibat.inference_configuration import (
+    IdataSaveFormat,
+    InferenceConfiguration,
+)
+from bibat.prepared_data import PreparedData
+from bibat.util import CoordDict, StanInputDict, returns_stan_input
+
+fits: list[str] = []
+crash: list[str] = []
+
+
+def test_fit_checkpoints(tmp_path: Path) -> None:
+    """Check that fits are saved in the current scope, if there is one."""
+    draws = np.arange(6.0).reshape(1, 2, 3)
+    save_fit_checkpoint("fold_0", draws)
+    if load_fit_checkpoint("fold_0") is not None:
+        msg = "A fit was checkpointed without a checkpoint folder."
+        raise ValueError(msg)
+    with checkpointing(tmp_path), checkpoint_scope("kfold"):
+        save_fit_checkpoint("fold_0", draws)
+        loaded = load_fit_checkpoint("fold_0")
+    if not (tmp_path / "kfold" / "fold_0.npy").exists():
+        msg = "The fit was not saved in the mode's folder."
+        raise ValueError(msg)
+    if loaded is None or not np.array_equal(loaded, draws):
+        msg = f"Expected the saved draws, got {loaded}."
+        raise ValueError(msg)
+
+
+def test_start_checkpoint_drops_changed_modes(tmp_path: Path) -> None:
+    """Check that progress is only kept for modes that have not changed."""
+    checkpoint = start_checkpoint(tmp_path, {"posterior": "a", "kfold": "b"})
+    checkpoint.complete_mode("posterior", {"posterior": ["mu"]})
+    checkpoint.complete_mode("kfold", {"log_likelihood": ["llik_kfold"]})
+    save_checkpoint(tmp_path, checkpoint)
+    with checkpointing(get_checkpoint_dir(tmp_path)):
+        for mode in ["posterior", "kfold"]:
+            with checkpoint_scope(mode):
+                save_fit_checkpoint("fold_0", np.zeros(1))
+    checkpoint = start_checkpoint(tmp_path, {"posterior": "a", "kfold": "c"})
+    if checkpoint.completed_modes != ["posterior"]:
+        msg = f"Unexpected completed modes {checkpoint.completed_modes}."
+        raise ValueError(msg)
+    if (get_checkpoint_dir(tmp_path) / "kfold").exists():
+        msg = "Fits for a changed mode were not removed."
+        raise ValueError(msg)
+    if load_checkpoint(tmp_path) != checkpoint:
+        msg = "The new checkpoint was not saved."
+        raise ValueError(msg)
+    if checkpoint.get_kept_variables() != {"posterior": ["mu"]}:
+        msg = f"Unexpected kept variables {checkpoint.get_kept_variables()}."
+        raise ValueError(msg)
+    checkpoint = start_checkpoint(tmp_path, {"posterior": "a"}, "new data")
+    if checkpoint.completed_modes != []:
+        msg = "Progress was kept although the data changed."
+        raise ValueError(msg)
+
+
+def write_then_fail(inference_dir: Path, idata: az.InferenceData) -> None:
+    """Write some InferenceData with a resumable writer, then fail."""
+    with IdataWriter(inference_dir, resume=True, keep={}) as writer:
+        writer.write(idata)
+        msg = "preempted"
+        raise RuntimeError(msg)
+
+
+def test_idata_writer_resume(tmp_path: Path) -> None:
+    """Check that a resumed writer keeps groups written before a failure."""
+    prior = az.InferenceData(prior=xr.Dataset({"mu": ("draw", [1.0, 2.0])}))
+    posterior = az.InferenceData(
+        posterior=xr.Dataset({"mu": ("draw", [3.0, 4.0])}),
+    )
+    with pytest.raises(RuntimeError, match="preempted"):
+        write_then_fail(tmp_path, prior)
+    with IdataWriter(tmp_path, resume=True, keep={"prior": ["mu"]}) as writer:
+        writer.write(posterior)
+    idata = load_idata(tmp_path)
+    if idata is None or set(idata.groups()) != {"prior", "posterior"}:
+        msg = "The group written before the failure was lost."
+        raise ValueError(msg)
+
+
+def test_idata_writer_resume_prunes_unkept_variables(tmp_path: Path) -> None:
+    """Check that a resumed writer only keeps the variables it is told to."""
+    old = az.from_dict(
+        posterior={"mu": np.zeros((1, 2, 3)), "old_param": np.zeros((1, 2))},
+        log_likelihood={"llik": np.zeros((1, 2, 3))},
+    )
+    with pytest.raises(RuntimeError, match="preempted"):
+        write_then_fail(tmp_path, old)
+    new = az.from_dict(posterior={"mu": np.ones((1, 2, 4))})
+    with IdataWriter(
+        tmp_path,
+        resume=True,
+        keep={"log_likelihood": ["llik"]},
+    ) as writer:
+        writer.write(new)
+    idata = load_idata(tmp_path)
+    if idata is None or set(idata.posterior.data_vars) != {"mu"}:
+        msg = "A variable that was not kept is still in the posterior."
+        raise ValueError(msg)
+    if idata.posterior["mu"].shape != (1, 2, 4):
+        msg = f"The new posterior was cut: {idata.posterior['mu'].shape}."
+        raise ValueError(msg)
+    if "llik" not in idata.log_likelihood:
+        msg = "A kept variable was removed."
+        raise ValueError(msg)
+
+
+class NumbersPreparedData(PreparedData):
+    """Prepared data with a list of numbers."""
+
+    y: list[float]
+
+
+@returns_stan_input
+def get_stan_input_numbers(data: NumbersPreparedData) -> StanInputDict:
+    """Get a Stan input from a list of numbers."""
+    return {"N": len(data.y), "y": data.y}
+
+
+def load_numbers(path: Path) -> NumbersPreparedData:
+    """Load a list of numbers."""
+    return NumbersPreparedData.model_validate_json(path.read_text())
+
+
+def fit_llik(
+    ic: InferenceConfiguration,  # noqa: ARG001
+    data: NumbersPreparedData,
+    local_functions: dict,  # noqa: ARG001
+) -> xr.DataArray:
+    """Pretend to fit a log likelihood mode."""
+    fits.append("llik")
+    return xr.DataArray(
+        np.zeros((1, 2, len(data.y))),
+        dims=["chain", "draw", "observation"],
+    )
+
+
+def fit_posterior(
+    ic: InferenceConfiguration,
+    data: NumbersPreparedData,  # noqa: ARG001
+    local_functions: dict,  # noqa: ARG001
+) -> az.InferenceData:
+    """Pretend to fit a posterior whose size is set in the mode options."""
+    fits.append("posterior")
+    n = ic.mode_options["posterior"]["n"]
+    variables = {"mu": np.ones((1, 2, n))}
+    if n == 3:  # noqa: PLR2004
+        variables["old_param"] = np.zeros((1, 2))
+    return az.from_dict(posterior=variables)
+
+
+def fit_prior(
+    ic: InferenceConfiguration,  # noqa: ARG001
+    data: NumbersPreparedData,  # noqa: ARG001
+    local_functions: dict,  # noqa: ARG001
+) -> az.InferenceData:
+    """Pretend to fit a prior, failing if asked to."""
+    fits.append("prior")
+    if crash:
+        msg = "preempted"
+        raise RuntimeError(msg)
+    return az.from_dict(prior={"mu": np.zeros((1, 2))})
+
+
+FAKE_MODES = {
+    "llik": FittingMode(
+        name="llik",
+        idata_target=IdataTarget.log_likelihood,
+        fit=fit_llik,
+    ),
+    "posterior": FittingMode(
+        name="posterior",
+        idata_target=IdataTarget.posterior,
+        fit=fit_posterior,
+    ),
+    "prior": FittingMode(
+        name="prior",
+        idata_target=IdataTarget.prior,
+        fit=fit_prior,
+    ),
+}
+
+
+def write_inference(inference_dir: Path, n: int) -> None:
+    """Write an inference's config.toml file."""
+    ic = InferenceConfiguration(
+        name="numbers",
+        prepared_data="numbers",
+        stan_file="model.stan",
+        stan_input_function="get_stan_input_numbers",
+        modes=["llik", "posterior", "prior"],
+        mode_options={"posterior": {"n": n}},
+    )
+    inference_dir.mkdir(parents=True, exist_ok=True)
+    with (inference_dir / "config.toml").open("w") as f:
+        toml.dump(ic.model_dump(by_alias=True, exclude={"inference_dir"}), f)
+
+
+def run_numbers(inference_dir: Path) -> None:
+    """Run the numbers inference with checkpoints."""
+    run_and_save_inference(
+        inference_dir,
+        Path("data"),
+        FAKE_MODES,
+        load_numbers,
+        {"get_stan_input_numbers": get_stan_input_numbers},
+        IdataSaveFormat.zarr,
+        resume=True,
+    )
+
+
+def test_resume_after_fingerprint_change(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Check that a changed mode's old results are not merged into new ones."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src" / "stan").mkdir(parents=True)
+    (tmp_path / "src" / "stan" / "model.stan").write_text("data {int N;}")
+    (tmp_path / "data").mkdir()
+    numbers = NumbersPreparedData(name="numbers", coords=CoordDict({}), y=[1.0])
+    (tmp_path / "data" / "numbers.json").write_text(numbers.model_dump_json())
+    inference_dir = tmp_path / "inferences" / "numbers"
+    write_inference(inference_dir, n=3)
+    fits.clear()
+    crash.append("prior")
+    with pytest.raises(RuntimeError, match="preempted"):
+        run_numbers(inference_dir)
+    crash.clear()
+    write_inference(inference_dir, n=4)
+    run_numbers(inference_dir)
+    if fits != ["llik", "posterior", "prior", "posterior", "prior"]:
+        msg = f"Unexpected fits {fits}."
+        raise ValueError(msg)
+    idata = load_idata(inference_dir)
+    if idata is None or set(idata.posterior.data_vars) != {"mu"}:
+        msg = "The old posterior's variables were kept."
+        raise ValueError(msg)
+    if idata.posterior["mu"].shape != (1, 2, 4):
+        msg = f"The new posterior was cut: {idata.posterior['mu'].shape}."
+        raise ValueError(msg)
+    if "llik_llik" not in idata.log_likelihood:
+        msg = "The unchanged mode's results were lost."
+        raise ValueError(msg)
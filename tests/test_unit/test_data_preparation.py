@@ -0,0 +1,268 @@
+"""Unit tests for the data_preparation module."""
+
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from bibat.data_preparation import (
+    DataPreparation,
+    cache_raw_table,
+    read_raw_csv,
+    read_raw_table,
+    run_data_preparations,
+)
+from bibat.fingerprint import function_fingerprint
+from bibat.prepared_data import PreparedData
+from bibat.util import DfInPydanticModel
+
+calls: list[str] = []
+
+
+class TotalPreparedData(PreparedData):
+    """Prepared data with a table of totals."""
+
+    name: str
+    totals: DfInPydanticModel
+
+
+def counting_reader(path: Path) -> pd.DataFrame:
+    """Read a csv file, recording the call."""
+    calls.append(f"read {path.name}")
+    return read_raw_csv(path)
+
+
+def prepare_total(*tables: pd.DataFrame) -> TotalPreparedData:
+    """Add up the x columns of some tables."""
+    calls.append("prepare total")
+    totals = pd.DataFrame({"x": [sum(t["x"].sum() for t in tables)]})
+    return TotalPreparedData(name="total", coords={}, totals=totals)
+
+
+def prepare_first(first: pd.DataFrame) -> TotalPreparedData:
+    """Add up the x column of one table."""
+    calls.append("prepare first")
+    totals = pd.DataFrame({"x": [first["x"].sum()]})
+    return TotalPreparedData(name="first", coords={}, totals=totals)
+
+
+def prepare_broken(first: pd.DataFrame) -> TotalPreparedData:
+    """Fail to prepare data."""
+    msg = f"Cannot prepare {len(first)} rows."
+    raise ValueError(msg)
+
+
+@pytest.fixture
+def raw_files(tmp_path: Path) -> list[Path]:
+    """Write some raw csv files."""
+    out = []
+    for name, x in [("first", [1, 2]), ("second", [3])]:
+        path = tmp_path / "raw" / f"{name}.csv"
+        path.parent.mkdir(exist_ok=True)
+        pd.DataFrame({"x": x}).to_csv(path, index=False)
+        out.append(path)
+    return out
+
+
+def test_run_data_preparations(tmp_path: Path, raw_files: list[Path]) -> None:
+    """Check that raw tables are cached and unchanged preparations skipped."""
+    prepared_dir = tmp_path / "prepared"
+    preparations = [
+        DataPreparation(
+            name="total",
+            func=prepare_total,
+            raw_files=raw_files,
+            reader=counting_reader,
+        ),
+        DataPreparation(
+            name="first",
+            func=prepare_first,
+            raw_files=raw_files[:1],
+            reader=counting_reader,
+        ),
+    ]
+    calls.clear()
+    run_data_preparations(preparations, prepared_dir)
+    expected_calls = [
+        "read first.csv",
+        "read second.csv",
+        "prepare total",
+        "prepare first",
+    ]
+    if calls != expected_calls:
+        msg = f"Expected calls {expected_calls}, got {calls}."
+        raise ValueError(msg)
+    saved = TotalPreparedData.model_validate_json(
+        (prepared_dir / "total.json").read_text(),
+    )
+    if saved.totals["x"].tolist() != [6]:
+        msg = f"Unexpected totals {saved.totals}."
+        raise ValueError(msg)
+    calls.clear()
+    run_data_preparations(preparations, prepared_dir)
+    if calls != []:
+        msg = f"Up to date preparations were run again: {calls}."
+        raise ValueError(msg)
+    pd.DataFrame({"x": [4]}).to_csv(raw_files[1], index=False)
+    calls.clear()
+    run_data_preparations(preparations, prepared_dir)
+    if calls != ["read second.csv", "prepare total"]:
+        msg = f"Expected only the changed input to be rerun, got {calls}."
+        raise ValueError(msg)
+    cached = list((prepared_dir / ".cache" / "raw").glob("second-*.pkl"))
+    if len(cached) != 1:
+        msg = f"Expected stale cached tables to be removed, got {cached}."
+        raise ValueError(msg)
+
+
+def test_preparation_dependencies(
+    tmp_path: Path,
+    raw_files: list[Path],
+) -> None:
+    """Check that changing a declared dependency reruns a preparation."""
+    prepared_dir = tmp_path / "prepared"
+    helper = tmp_path / "helpers.py"
+    helper.write_text("SCALE = 1\n")
+    preparations = [
+        DataPreparation(
+            name="total",
+            func=prepare_total,
+            raw_files=raw_files,
+        ),
+        DataPreparation(
+            name="first",
+            func=prepare_first,
+            raw_files=raw_files[:1],
+            dependencies=[helper],
+        ),
+    ]
+    run_data_preparations(preparations, prepared_dir)
+    helper.write_text("SCALE = 2\n")
+    calls.clear()
+    run_data_preparations(preparations, prepared_dir)
+    if calls != ["prepare first"]:
+        msg = f"Expected only the dependent preparation to rerun, got {calls}."
+        raise ValueError(msg)
+
+
+def test_run_data_preparations_in_process_pool(
+    tmp_path: Path,
+    raw_files: list[Path],
+) -> None:
+    """Check that preparations run in a process pool and failures are listed."""
+    prepared_dir = tmp_path / "prepared"
+    preparations = [
+        DataPreparation(name="total", func=prepare_total, raw_files=raw_files),
+        DataPreparation(
+            name="broken",
+            func=prepare_broken,
+            raw_files=raw_files[:1],
+        ),
+    ]
+    with pytest.raises(RuntimeError, match="broken"):
+        run_data_preparations(preparations, prepared_dir, max_workers=2)
+    if not (prepared_dir / "total.json").exists():
+        msg = "A failed preparation stopped the others."
+        raise ValueError(msg)
+
+
+def test_partial_fingerprint() -> None:
+    """Check that a partial's fingerprint depends on its arguments."""
+    fingerprints = {
+        function_fingerprint(partial(pd.read_csv, sep=sep)) for sep in ",;"
+    }
+    if len(fingerprints) != 2:  # noqa: PLR2004
+        msg = "Partials with different arguments had the same fingerprint."
+        raise ValueError(msg)
+
+
+@pytest.mark.parametrize(
+    ("chunksize", "engine"),
+    [(None, None), (2, None), (None, "pyarrow")],
+)
+def test_read_raw_csv_subset(
+    tmp_path: Path,
+    chunksize: int | None,
+    engine: str | None,
+) -> None:
+    """Check that only the requested rows and columns are read."""
+    path = tmp_path / "raw.csv"
+    pd.DataFrame(
+        {"season": [2016, 2017, 2018, 2019, 2020], "x": range(5), "y": "a"},
+    ).to_csv(path, index=False)
+    df = read_raw_csv(
+        path,
+        usecols=["season", "x"],
+        dtype={"season": "int16", "x": "float64"},
+        predicate="season >= 2018",
+        chunksize=chunksize,
+        engine=engine,
+    )
+    if list(df.columns) != ["season", "x"] or df["x"].tolist() != [2, 3, 4]:
+        msg = f"Unexpected table {df}."
+        raise ValueError(msg)
+    if df["season"].dtype != "int16":
+        msg = f"Expected season to have dtype int16, not {df['season'].dtype}."
+        raise TypeError(msg)
+    even = read_raw_csv(path, predicate=lambda df: df["x"] % 2 == 0)
+    if even["x"].tolist() != [0, 2, 4]:
+        msg = f"Unexpected rows {even}."
+        raise ValueError(msg)
+
+
+def test_data_preparation_readers(raw_files: list[Path]) -> None:
+    """Check that there must be one reader per raw file if there are several."""
+    with pytest.raises(ValueError, match="readers"):
+        DataPreparation(
+            name="total",
+            func=prepare_total,
+            raw_files=raw_files,
+            reader=[read_raw_csv],
+        )
+    reader = partial(read_raw_csv, usecols=["x"])
+    preparation = DataPreparation(
+        name="total",
+        func=prepare_total,
+        raw_files=raw_files,
+        reader=[read_raw_csv, reader],
+    )
+    if preparation.get_readers() != [read_raw_csv, reader]:
+        msg = f"Unexpected readers {preparation.get_readers()}."
+        raise ValueError(msg)
+
+
+def test_raw_cache_keeps_other_readers(
+    tmp_path: Path,
+    raw_files: list[Path],
+) -> None:
+    """Check that caching a file with one reader keeps other readers' tables."""
+    path = raw_files[0]
+    readers = [
+        partial(read_raw_csv, usecols=["x"]),
+        partial(read_raw_csv, dtype={"x": "float64"}),
+    ]
+    cache_dir = tmp_path / "cache"
+    cache_paths = [cache_raw_table(path, r, cache_dir) for r in readers]
+    if len(set(cache_paths)) != 2 or not all(  # noqa: PLR2004
+        p.exists() for p in cache_paths
+    ):
+        msg = "Caching a table evicted another reader's table."
+        raise ValueError(msg)
+
+
+def test_read_raw_table_survives_eviction(
+    tmp_path: Path,
+    raw_files: list[Path],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Check that a table is parsed again if its cache disappears."""
+    monkeypatch.setattr(
+        "bibat.data_preparation.cache_raw_table",
+        lambda *_: tmp_path / "evicted.pkl",
+    )
+    calls.clear()
+    df = read_raw_table(raw_files[0], counting_reader, tmp_path / "cache")
+    if calls != ["read first.csv"] or df["x"].tolist() != [1, 2]:
+        msg = f"The table was not parsed again: {calls}."
+        raise ValueError(msg)
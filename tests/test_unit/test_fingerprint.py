@@ -0,0 +1,127 @@
+"""Unit tests for the fingerprint module."""
+
+from pathlib import Path
+
+import pytest
+
+from bibat.fingerprint import (
+    function_fingerprint,
+    get_fingerprints,
+    load_fingerprints,
+    save_fingerprints,
+)
+from bibat.fitting_mode import kfold_mode, posterior_mode, prior_mode
+from bibat.inference_configuration import InferenceConfiguration
+
+FITTING_MODE_OPTIONS = {
+    "prior": prior_mode,
+    "posterior": posterior_mode,
+    "kfold": kfold_mode,
+}
+
+
+def get_stan_input(prepared_data: dict) -> dict:
+    """Get a Stan input."""
+    return prepared_data
+
+
+@pytest.fixture
+def project_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Create a directory with a Stan file and some prepared data."""
+    stan_dir = tmp_path / "src" / "stan"
+    stan_dir.mkdir(parents=True)
+    (stan_dir / "model.stan").write_text("data {int N;}")
+    (tmp_path / "prepared.json").write_text('{"N": 1}')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def get_ic(**kwargs: dict) -> InferenceConfiguration:
+    """Get an inference configuration."""
+    defaults = {
+        "name": "example",
+        "stan_file": "model.stan",
+        "prepared_data": "prepared",
+        "stan_input_function": "get_stan_input",
+        "modes": ["prior", "posterior"],
+        "mode_options": {"kfold": {"n_folds": 2}},
+    }
+    return InferenceConfiguration(**(defaults | kwargs))
+
+
+def test_adding_a_mode_keeps_other_fingerprints(project_dir: Path) -> None:
+    """Check that adding a mode does not change the other fingerprints."""
+    local_functions = {"get_stan_input": get_stan_input}
+    before = get_fingerprints(
+        get_ic(),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    after = get_fingerprints(
+        get_ic(modes=["prior", "posterior", "kfold"]),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    if any(after[mode] != before[mode] for mode in before):
+        raise ValueError
+
+
+def test_changing_data_changes_fingerprints(project_dir: Path) -> None:
+    """Check that changing the prepared data changes all fingerprints."""
+    local_functions = {"get_stan_input": get_stan_input}
+    before = get_fingerprints(
+        get_ic(),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    (project_dir / "prepared.json").write_text('{"N": 2}')
+    after = get_fingerprints(
+        get_ic(),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    if any(after[mode] == before[mode] for mode in before):
+        raise ValueError
+
+
+def test_changing_mode_options_changes_one_fingerprint(
+    project_dir: Path,
+) -> None:
+    """Check that mode options only affect their own mode's fingerprint."""
+    local_functions = {"get_stan_input": get_stan_input}
+    before = get_fingerprints(
+        get_ic(),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    after = get_fingerprints(
+        get_ic(mode_options={"prior": {"iter_sampling": 10}}),
+        project_dir / "prepared.json",
+        FITTING_MODE_OPTIONS,
+        local_functions,
+    )
+    if after["prior"] == before["prior"]:
+        raise ValueError
+    if after["posterior"] != before["posterior"]:
+        raise ValueError
+
+
+def test_function_fingerprint() -> None:
+    """Check that different functions have different fingerprints."""
+    if function_fingerprint(get_stan_input) == function_fingerprint(get_ic):
+        raise ValueError
+
+
+def test_save_and_load_fingerprints(tmp_path: Path) -> None:
+    """Check that fingerprints survive a round trip to disk."""
+    if load_fingerprints(tmp_path) != {}:
+        raise ValueError
+    fingerprints = {"prior": "abc", "posterior": "def"}
+    save_fingerprints(tmp_path, fingerprints)
+    if load_fingerprints(tmp_path) != fingerprints:
+        raise ValueError
@@ -4,16 +4,32 @@ import json
 import os
 from pathlib import Path
 
+import arviz as az
+import numpy as np
 import pandas as pd
 import pytest
 import toml
+import xarray as xr
 
-from bibat.fitting import IdataSaveFormat, run_all_inferences, run_inference
+from bibat.fitting import (
+    IdataSaveFormat,
+    IdataWriter,
+    get_idata_save_options,
+    iter_named_inference,
+    load_idata,
+    run_all_inferences,
+    run_inference,
+)
 from bibat.fitting_mode import (
+    FittingMode,
+    IdataTarget,
+    get_posterior_llik,
     kfold_mode,
     posterior_mode,
 )
 from bibat.inference_configuration import (
+    IdataCompressor,
+    IdataSaveOptions,
     InferenceConfiguration,
     load_inference_configuration,
 )
@@ -174,3 +190,235 @@ def test_run_all_inferences_json(
         },
         idata_save_format=IdataSaveFormat.json,
     )
+
+
+def test_run_all_inferences_parallel(
+    stan_file: Path,  # noqa: ARG001
+    prepared_data_json: Path,
+    inference_config: Path,
+) -> None:
+    """Test running inferences in a process pool."""
+    _ = run_all_inferences(
+        inferences_dir=inference_config.parent.parent,
+        data_dir=prepared_data_json.parent,
+        fitting_mode_options={"posterior": posterior_mode, "kfold": kfold_mode},
+        loader=load_prepared_data,
+        local_functions={
+            "get_stan_input_interaction": get_stan_input_interaction,
+        },
+        max_workers=2,
+    )
+
+
+def load_prepared_data_bad(path: Path) -> ExamplePreparedData:
+    """Fail to load a prepared data object."""
+    msg = f"Could not load {path}."
+    raise ValueError(msg)
+
+
+def test_run_all_inferences_failure_is_reported(
+    stan_file: Path,  # noqa: ARG001
+    prepared_data_json: Path,
+    inference_config: Path,
+) -> None:
+    """Check that failed inferences are reported after the others run."""
+    with pytest.raises(RuntimeError, match="example"):
+        run_all_inferences(
+            inferences_dir=inference_config.parent.parent,
+            data_dir=prepared_data_json.parent,
+            fitting_mode_options={"posterior": posterior_mode},
+            loader=load_prepared_data_bad,
+            local_functions={
+                "get_stan_input_interaction": get_stan_input_interaction,
+            },
+        )
+
+
+def test_run_all_inferences_skip_up_to_date(
+    stan_file: Path,  # noqa: ARG001
+    prepared_data_json: Path,
+    inference_config: Path,
+) -> None:
+    """Test that up to date inferences are not re-fitted."""
+    kwargs = {
+        "inferences_dir": inference_config.parent.parent,
+        "data_dir": prepared_data_json.parent,
+        "fitting_mode_options": {
+            "posterior": posterior_mode,
+            "kfold": kfold_mode,
+        },
+        "local_functions": {
+            "get_stan_input_interaction": get_stan_input_interaction,
+        },
+        "idata_save_format": IdataSaveFormat.json,
+        "skip_up_to_date": True,
+    }
+    run_all_inferences(loader=load_prepared_data, **kwargs)
+    # the second time round, the data should not even be loaded
+    run_all_inferences(loader=load_prepared_data_bad, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "save_options",
+    [
+        IdataSaveOptions(save_format=IdataSaveFormat.json),
+        IdataSaveOptions(save_format=IdataSaveFormat.zarr),
+        IdataSaveOptions(
+            save_format=IdataSaveFormat.zarr,
+            compressor=IdataCompressor.zstd,
+            compression_level=3,
+            chunks={"draw": 2},
+            consolidated=False,
+        ),
+        IdataSaveOptions(
+            save_format=IdataSaveFormat.netcdf,
+            compressor=IdataCompressor.zlib,
+            chunks={"draw": 2, "observation": 1},
+        ),
+    ],
+)
+def test_idata_writer(tmp_path: Path, save_options: IdataSaveOptions) -> None:
+    """Check that IdataWriter merges pieces that share a group."""
+    idata_save_format = save_options.save_format
+    dims = ("chain", "draw", "observation")
+    posterior = az.InferenceData(
+        posterior=xr.Dataset({"mu": (dims[:2], np.zeros((1, 3)))}),
+        log_likelihood=xr.Dataset({"llik": (dims, np.zeros((1, 3, 2)))}),
+    )
+    kfold = az.InferenceData(
+        log_likelihood=xr.Dataset({"llik_kfold": (dims, np.ones((1, 3, 2)))}),
+    )
+    replacement = az.InferenceData(
+        posterior=xr.Dataset({"mu": (dims[:2], np.ones((1, 3)))}),
+    )
+    with IdataWriter(tmp_path, save_options) as writer:
+        writer.write(posterior)
+        writer.write(kfold)
+        writer.write(replacement)
+    idata = load_idata(tmp_path, idata_save_format)
+    if idata is None or set(idata.log_likelihood.data_vars) != {
+        "llik",
+        "llik_kfold",
+    }:
+        msg = f"Pieces were not merged correctly: {idata}"
+        raise ValueError(msg)
+    if not (idata.log_likelihood["llik_kfold"] == 1).all():
+        msg = f"An appended variable has the wrong values: {idata}"
+        raise ValueError(msg)
+    if not (idata.posterior["mu"] == 1).all():
+        msg = f"A replaced variable was not updated: {idata}"
+        raise ValueError(msg)
+
+    def write_and_fail() -> None:
+        with IdataWriter(tmp_path, save_options) as writer:
+            writer.write(kfold)
+            msg = "Fitting failed."
+            raise RuntimeError(msg)
+
+    with pytest.raises(RuntimeError):
+        write_and_fail()
+    idata = load_idata(tmp_path, idata_save_format)
+    if idata is None or "posterior" not in idata.groups():
+        msg = "A failed write should not replace the saved idata."
+        raise ValueError(msg)
+
+
+def test_get_idata_save_options() -> None:
+    """Check that inference configurations override default save options."""
+    default = IdataSaveOptions(
+        save_format=IdataSaveFormat.netcdf,
+        compressor=IdataCompressor.zlib,
+    )
+    ic = InferenceConfiguration.model_construct(
+        idata_save_options=IdataSaveOptions(chunks={"draw": 100}),
+    )
+    save_options = get_idata_save_options(ic, default)
+    expected = IdataSaveOptions(
+        save_format=IdataSaveFormat.netcdf,
+        compressor=IdataCompressor.zlib,
+        chunks={"draw": 100},
+    )
+    if save_options != expected:
+        msg = f"Expected {expected}, got {save_options}."
+        raise ValueError(msg)
+    with pytest.raises(ValueError, match="not available for netcdf"):
+        IdataSaveOptions(
+            save_format=IdataSaveFormat.netcdf,
+            compressor=IdataCompressor.zstd,
+        )
+
+
+@pytest.mark.parametrize(
+    ("modes", "expected"),
+    [
+        (["posterior", "user", "other"], [None, True, None]),
+        (["posterior", "other", "user"], [None, None, True]),
+        (["posterior", "user", "user", "other"], [None, True, True, None]),
+        (["posterior", "other"], [None, None]),
+        (["user", "posterior"], [None, None]),
+    ],
+)
+def test_iter_named_inference_shares_llik(
+    modes: list[str],
+    expected: list[bool | None],
+) -> None:
+    """Check that posterior llik draws are only kept for modes that use them."""
+    seen = []
+
+    def fit_posterior(*_: object) -> az.InferenceData:
+        seen.append(get_posterior_llik())
+        return az.InferenceData(
+            posterior=xr.Dataset({"mu": (("chain", "draw"), np.zeros((1, 3)))}),
+            log_likelihood=xr.Dataset(
+                {"llik": (("chain", "draw", "obs"), np.zeros((1, 3, 2)))},
+            ),
+        )
+
+    def fit_llik(*_: object) -> xr.DataArray:
+        seen.append(get_posterior_llik())
+        return xr.DataArray(np.zeros(2), dims=["obs"])
+
+    fitting_mode_options = {
+        "posterior": FittingMode(
+            name="posterior",
+            idata_target=IdataTarget.posterior,
+            fit=fit_posterior,
+        ),
+        "user": FittingMode(
+            name="user",
+            idata_target=IdataTarget.log_likelihood,
+            fit=fit_llik,
+            uses_posterior_llik=True,
+        ),
+        "other": FittingMode(
+            name="other",
+            idata_target=IdataTarget.log_likelihood,
+            fit=fit_llik,
+        ),
+    }
+    ic = InferenceConfiguration.model_construct(
+        name="test",
+        stan_input_function=None,
+        fitting_modes=modes,
+        dims={},
+    )
+    prepared_data = PreparedData.model_construct(
+        name="test",
+        coords=CoordDict({}),
+    )
+    names = [
+        name
+        for name, _ in iter_named_inference(
+            ic,
+            prepared_data,
+            fitting_mode_options,
+            {},
+        )
+    ]
+    if names != modes:
+        msg = f"Expected modes {modes}, got {names}."
+        raise ValueError(msg)
+    shared = [None if llik is None else True for llik in seen]
+    if shared != expected:
+        msg = f"Expected shared llik {expected}, got {shared}."
+        raise ValueError(msg)
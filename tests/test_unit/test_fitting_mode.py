@@ -4,6 +4,7 @@ import os
 from collections.abc import Callable
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 import toml
@@ -12,7 +13,12 @@ from cmdstanpy import CmdStanMCMC, CmdStanModel
 from bibat.fitting_mode import (
     FittingMode,
     IdataTarget,
+    make_approximate_idata,
+    make_kfold_llik,
+    posterior_llik,
+    psis_loo_pointwise,
     sample_hmc_kfold,
+    sample_hmc_loo,
     sample_hmc_posterior,
     sample_hmc_prior,
 )
@@ -183,3 +189,174 @@ def test_sample_hmc_kfold_bad(
         "get_stan_input_interaction": get_stan_input_interaction,
     }
     _ = sample_hmc_kfold(ic=ic, data=data, local_functions=local_functions)
+
+
+def test_sample_hmc_kfold_concurrent(
+    stan_file: Path,  # noqa: ARG001
+    prepared_data_json: Path,
+    inference_config: Path,
+) -> None:
+    """Test sampling folds concurrently with more than one chain per fold."""
+    ic = load_inference_configuration(inference_config.parent)
+    ic.sample_kwargs |= {"chains": 2}
+    ic.mode_options["kfold"] |= {"max_workers": 2}
+    data = load_prepared_data(prepared_data_json)
+    local_functions = {
+        "get_stan_input_interaction": get_stan_input_interaction,
+    }
+    llik = sample_hmc_kfold(ic=ic, data=data, local_functions=local_functions)
+    if list(llik.coords["chain"].values) != [0, 1]:
+        raise ValueError
+    if list(llik.coords["observation"].values) != ["a", "b"]:
+        raise ValueError
+    if sorted(llik.coords["fold"].values) != [0, 1]:
+        raise ValueError
+
+
+def test_make_kfold_llik() -> None:
+    """Check that k-fold log likelihoods get the right dims and coords."""
+    ic = InferenceConfiguration.model_construct(dims={"llik": ["observation"]})
+    data = ExamplePreparedData.model_construct(
+        coords=CoordDict({"observation": ["a", "b", "c"]}),
+    )
+    llik_values = np.zeros((2, 4, 3))
+    fold_ix = np.array([1, 0, 1], dtype=np.uint8)
+    llik = make_kfold_llik(ic, data, llik_values, fold_ix)
+    if llik.dims != ("chain", "draw", "observation"):
+        msg = f"Unexpected dims {llik.dims}."
+        raise ValueError(msg)
+    if list(llik.coords["observation"].values) != ["a", "b", "c"]:
+        msg = f"Unexpected coords {llik.coords}."
+        raise ValueError(msg)
+    if list(llik.coords["fold"].values) != [1, 0, 1]:
+        msg = f"Unexpected folds {llik.coords['fold']}."
+        raise ValueError(msg)
+    ic = InferenceConfiguration.model_construct(dims={})
+    llik = make_kfold_llik(ic, data, llik_values, fold_ix)
+    if llik.dims[2] != "llik_dim_0":
+        msg = f"Unexpected dims {llik.dims}."
+        raise ValueError(msg)
+
+
+def test_psis_loo_pointwise() -> None:
+    """Check PSIS-LOO against the plain importance sampling estimate."""
+    rng = np.random.default_rng(1234)
+    llik = rng.normal(-1.0, 0.1, size=(4, 1000, 3))
+    elpd, pareto_k = psis_loo_pointwise(llik)
+    draws = llik.reshape(-1, 3)
+    expected = -np.log(np.mean(np.exp(-draws), axis=0))
+    if not np.allclose(elpd, expected, atol=1e-3):
+        msg = f"Expected elpd {expected}, got {elpd}."
+        raise ValueError(msg)
+    if (pareto_k > 0.5).any():  # noqa: PLR2004
+        msg = f"Pareto k values {pareto_k} are unexpectedly high."
+        raise ValueError(msg)
+
+
+def fake_sample_held_out_llik(  # noqa: PLR0913
+    ic: InferenceConfiguration,  # noqa: ARG001
+    data: PreparedData,  # noqa: ARG001
+    local_functions: dict[str, Callable],  # noqa: ARG001
+    sample_kwargs: dict,  # noqa: ARG001
+    full_ix: np.ndarray,  # noqa: ARG001
+    ix_train: np.ndarray,  # noqa: ARG001
+    ix_test: np.ndarray,
+    name: str,
+) -> np.ndarray:
+    """Pretend to sample some held out log likelihoods, recording the fit."""
+    sampled.append(name)
+    rng = np.random.default_rng(1234)
+    return rng.normal(-1.0, 0.1, size=(2, 100, len(ix_test)))
+
+
+sampled: list[str] = []
+
+
+@pytest.mark.parametrize(
+    ("shared", "loo_options", "expected_fits"),
+    [
+        (True, {"k_threshold": 10.0}, []),
+        (True, {"k_threshold": 10.0, "reuse_posterior": False}, ["full"]),
+        (False, {"k_threshold": 10.0}, ["full"]),
+        (True, {"k_threshold": -1.0}, ["loo_0", "loo_1"]),
+    ],
+)
+def test_sample_hmc_loo(
+    monkeypatch: pytest.MonkeyPatch,
+    *,
+    shared: bool,
+    loo_options: dict,
+    expected_fits: list[str],
+) -> None:
+    """Check that loo mode only fits when it needs to."""
+    monkeypatch.setattr(
+        "bibat.fitting_mode.sample_held_out_llik",
+        fake_sample_held_out_llik,
+    )
+    ic = InferenceConfiguration.model_construct(
+        stan_input_function="get_stan_input_interaction",
+        sample_kwargs={},
+        mode_options={"loo": loo_options},
+        dims={"llik": ["observation"]},
+    )
+    data = ExamplePreparedData(
+        name="example_prepared_data",
+        coords=CoordDict({"observation": ["a", "b"]}),
+        measurements=pd.DataFrame(
+            {"x1": [1, 2], "x2": [3, 4], "x1:x2": [3, 8], "y": [0.0, 1.0]},
+        ),
+    )
+    local_functions = {"get_stan_input_interaction": get_stan_input_interaction}
+    llik = np.random.default_rng(5678).normal(-1.0, 0.1, size=(2, 100, 2))
+    sampled.clear()
+    with posterior_llik(llik if shared else None):
+        loo = sample_hmc_loo(ic, data, local_functions)
+    if sampled != expected_fits:
+        msg = f"Expected fits {expected_fits}, got {sampled}."
+        raise ValueError(msg)
+    if list(loo["observation"].values) != ["a", "b"]:
+        msg = f"Unexpected observation coordinates {loo['observation']}."
+        raise ValueError(msg)
+    if expected_fits == [] and not np.allclose(
+        loo["elpd_loo"],
+        psis_loo_pointwise(llik)[0],
+    ):
+        msg = f"The posterior's llik was not used: {loo['elpd_loo']}."
+        raise ValueError(msg)
+    if bool(loo["refit"].all()) != (loo_options["k_threshold"] < 0):
+        msg = f"Unexpected refits {loo['refit']}."
+        raise ValueError(msg)
+
+
+@pytest.mark.parametrize(
+    "idata_target",
+    [IdataTarget.prior, IdataTarget.posterior],
+)
+def test_make_approximate_idata(idata_target: IdataTarget) -> None:
+    """Check that approximate draws go in the same groups as HMC draws."""
+    ic = InferenceConfiguration.model_construct(
+        dims={"llik": ["observation"], "yrep": ["observation"]},
+    )
+    data = ExamplePreparedData.model_construct(
+        coords=CoordDict({"observation": ["a", "b"]}),
+    )
+    draws = {
+        "mu": np.zeros(5),
+        "llik": np.zeros((5, 2)),
+        "yrep": np.zeros((5, 2)),
+    }
+    idata = make_approximate_idata(draws, idata_target, ic, data)
+    target = idata_target.value
+    expected_groups = {target, f"{target}_predictive"}
+    if idata_target == IdataTarget.posterior:
+        expected_groups.add("log_likelihood")
+    if set(idata.groups()) != expected_groups:
+        msg = f"Unexpected groups {idata.groups()}."
+        raise ValueError(msg)
+    if idata[f"{target}_predictive"]["yrep"].dims != (
+        "chain",
+        "draw",
+        "observation",
+    ):
+        msg = f"Unexpected yrep {idata[f'{target}_predictive']['yrep']}."
+        raise ValueError(msg)
@@ -196,3 +196,41 @@ def test_model_configuration_no_stan_input_function(stan_file: Path) -> None:
 def test_load_inference_configuration(inference_config: Path) -> None:
     """Test the function load_inference_configuration."""
     _ = load_inference_configuration(inference_config.parent)
+
+
+def test_model_configuration_stan_threads(stan_file: Path) -> None:
+    """Check that asking for several threads per chain turns on STAN_THREADS."""
+    os.chdir(stan_file.parent.parent.parent)
+    kwargs = {
+        "name": "my_mc",
+        "stan_file": "multilevel-linear-regression.stan",
+        "prepared_data": "interaction",
+        "stan_input_function": "get_stan_input_interaction",
+        "modes": ["posterior", "kfold"],
+        "sample_kwargs": SAMPLE_KWARGS,
+    }
+    ic = InferenceConfiguration(
+        **kwargs,
+        mode_options={"kfold": {"n_folds": 10, "threads_per_chain": 4}},
+        cpp_options={"O1": True},
+    )
+    if ic.cpp_options != {"O1": True, "STAN_THREADS": True}:
+        msg = f"Unexpected cpp_options {ic.cpp_options}."
+        raise ValueError(msg)
+    ic = InferenceConfiguration(
+        **kwargs,
+        mode_options={"kfold": {"n_folds": 10, "threads_per_chain": 1}},
+    )
+    if ic.cpp_options is not None:
+        msg = f"Unexpected cpp_options {ic.cpp_options}."
+        raise ValueError(msg)
+
+    def switched_off() -> None:
+        InferenceConfiguration(
+            **(kwargs | {"sample_kwargs": {"threads_per_chain": 2}}),
+            mode_options={"kfold": {"n_folds": 10}},
+            cpp_options={"STAN_THREADS": "false"},
+        )
+
+    with pytest.raises(ValueError, match="STAN_THREADS"):
+        switched_off()
@@ -0,0 +1,112 @@
+"""Unit tests for the prepared_data module."""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from bibat.prepared_data import (
+    PreparedData,
+    PreparedDataFormat,
+    get_prepared_data_path,
+    load_prepared_data,
+    save_prepared_data,
+)
+from bibat.util import CoordDict, DfInPydanticModel
+
+
+class ExamplePreparedData(PreparedData):
+    """An example prepared data dataclass."""
+
+    name: str
+    coords: CoordDict
+    measurements: DfInPydanticModel
+    n_folds: int = 5
+
+
+EXAMPLE_PREPARED_DATA = ExamplePreparedData(
+    name="example",
+    coords=CoordDict({"observation": ["a", "b", "c"]}),
+    measurements=pd.DataFrame(
+        {
+            "x": [1, 2, 3],
+            "y": [0.5, 1.5, -1.0],
+            "group": pd.Categorical(["g1", "g2", "g1"]),
+        },
+        index=pd.Index(["a", "b", "c"], name="observation"),
+    ),
+    n_folds=3,
+)
+
+
+@pytest.mark.parametrize("prepared_data_format", list(PreparedDataFormat))
+def test_save_and_load_prepared_data(
+    tmp_path: Path,
+    prepared_data_format: PreparedDataFormat,
+) -> None:
+    """Check that prepared data survive a round trip to disk."""
+    if prepared_data_format == PreparedDataFormat.parquet:
+        pytest.importorskip("pyarrow")
+    saved_path = save_prepared_data(
+        EXAMPLE_PREPARED_DATA,
+        tmp_path,
+        prepared_data_format,
+    )
+    path = get_prepared_data_path(tmp_path, "example")
+    if path != saved_path:
+        raise ValueError
+    loaded = load_prepared_data(path, ExamplePreparedData)
+    if loaded.coords != EXAMPLE_PREPARED_DATA.coords:
+        raise ValueError
+    if loaded.n_folds != EXAMPLE_PREPARED_DATA.n_folds:
+        raise ValueError
+    if prepared_data_format == PreparedDataFormat.parquet:
+        # json doesn't preserve dtypes or index names but parquet should
+        assert_frame_equal(
+            loaded.measurements,
+            EXAMPLE_PREPARED_DATA.measurements,
+        )
+
+
+@pytest.mark.parametrize("prepared_data_format", list(PreparedDataFormat))
+def test_load_prepared_data_lazy(
+    tmp_path: Path,
+    prepared_data_format: PreparedDataFormat,
+) -> None:
+    """Check that lazily loaded dataframes are read on first access."""
+    if prepared_data_format == PreparedDataFormat.parquet:
+        pytest.importorskip("pyarrow")
+    path = save_prepared_data(
+        EXAMPLE_PREPARED_DATA,
+        tmp_path,
+        prepared_data_format,
+    )
+    loaded = load_prepared_data(path, ExamplePreparedData, lazy=True)
+    if loaded.coords != EXAMPLE_PREPARED_DATA.coords:
+        raise ValueError
+    if "measurements" in loaded.__dict__:
+        raise ValueError
+    if list(loaded.measurements.columns) != ["x", "y", "group"]:
+        raise ValueError
+    if "measurements" not in loaded.__dict__:
+        raise ValueError
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_load_prepared_data_columns(tmp_path: Path, *, lazy: bool) -> None:
+    """Check that only the requested columns are read."""
+    pytest.importorskip("pyarrow")
+    path = save_prepared_data(
+        EXAMPLE_PREPARED_DATA,
+        tmp_path,
+        PreparedDataFormat.parquet,
+    )
+    loaded = load_prepared_data(
+        path,
+        ExamplePreparedData,
+        lazy=lazy,
+        columns={"measurements": ["y"]},
+    )
+    if list(loaded.measurements.columns) != ["y"]:
+        raise ValueError
@@ -0,0 +1,146 @@
+"""Tests for the profiling module."""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import arviz as az
+import numpy as np
+import pytest
+import toml
+
+from bibat.fitting import run_and_save_inference
+from bibat.fitting_mode import FittingMode, IdataTarget
+from bibat.inference_configuration import (
+    IdataSaveFormat,
+    InferenceConfiguration,
+)
+from bibat.profiling import (
+    FitProfile,
+    InferenceProfile,
+    get_resource_usage,
+    in_current_context,
+    make_run_profile,
+    profile_stage,
+    profiling,
+    record_fit,
+)
+from bibat.util import CoordDict
+from tests.test_unit.test_checkpoint import (
+    NumbersPreparedData,
+    get_stan_input_numbers,
+    load_numbers,
+)
+
+recorded: list[str] = []
+
+
+def test_profiling() -> None:
+    """Check that stages are recorded, including from other threads."""
+
+    def work(name: str) -> int:
+        with profile_stage(name):
+            return sum(range(10000))
+
+    with profile_stage("not_profiled"):
+        pass
+    with profiling("test") as profiler:
+        work("main")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(in_current_context(work), ["a", "b"]))
+    profile = profiler.finish()
+    names = sorted(stage.name for stage in profile.stages)
+    if names != ["a", "b", "main"]:
+        msg = f"Unexpected stages {names}."
+        raise ValueError(msg)
+    if any(stage.wall_time < 0 for stage in profile.stages):
+        msg = "Stage has negative wall time."
+        raise ValueError(msg)
+    if profile.wall_time < max(stage.wall_time for stage in profile.stages):
+        msg = "Inference is quicker than one of its stages."
+        raise ValueError(msg)
+
+
+def test_make_run_profile() -> None:
+    """Check that a run profile lists inferences from slowest to fastest."""
+    start = get_resource_usage()
+    profiles = [
+        InferenceProfile(name="fast", wall_time=1.0),
+        None,
+        InferenceProfile(name="slow", wall_time=2.0),
+    ]
+    run_profile = make_run_profile(start, profiles)
+    names = [p.name for p in run_profile.inferences]
+    if names != ["slow", "fast"]:
+        msg = f"Unexpected order {names}."
+        raise ValueError(msg)
+
+
+def fit_and_record(
+    ic: InferenceConfiguration,  # noqa: ARG001
+    data: NumbersPreparedData,  # noqa: ARG001
+    local_functions: dict,  # noqa: ARG001
+) -> az.InferenceData:
+    """Pretend to fit a posterior and record the fit."""
+    record_fit("posterior", None)
+    return az.from_dict(posterior={"mu": np.zeros((1, 2))})
+
+
+def get_fake_fit_profile(
+    name: str,
+    fit: Any,  # noqa: ANN401, ARG001
+) -> FitProfile:
+    """Pretend to read what CmdStan reported about a fit."""
+    recorded.append(name)
+    return FitProfile(name=name, method="sample")
+
+
+@pytest.mark.parametrize("profile", [False, True])
+def test_run_without_profile_records_nothing(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    *,
+    profile: bool,
+) -> None:
+    """Check that fits are only recorded when profiling is on."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        "bibat.profiling.get_fit_profile",
+        get_fake_fit_profile,
+    )
+    (tmp_path / "src" / "stan").mkdir(parents=True)
+    (tmp_path / "src" / "stan" / "model.stan").write_text("data {int N;}")
+    (tmp_path / "data").mkdir()
+    numbers = NumbersPreparedData(name="numbers", coords=CoordDict({}), y=[1.0])
+    (tmp_path / "data" / "numbers.json").write_text(numbers.model_dump_json())
+    inference_dir = tmp_path / "inferences" / "numbers"
+    inference_dir.mkdir(parents=True)
+    ic = InferenceConfiguration(
+        name="numbers",
+        prepared_data="numbers",
+        stan_file="model.stan",
+        stan_input_function="get_stan_input_numbers",
+        modes=["posterior"],
+    )
+    with (inference_dir / "config.toml").open("w") as f:
+        toml.dump(ic.model_dump(by_alias=True, exclude={"inference_dir"}), f)
+    recorded.clear()
+    inference_profile = run_and_save_inference(
+        inference_dir,
+        Path("data"),
+        {
+            "posterior": FittingMode(
+                name="posterior",
+                idata_target=IdataTarget.posterior,
+                fit=fit_and_record,
+            ),
+        },
+        load_numbers,
+        {"get_stan_input_numbers": get_stan_input_numbers},
+        IdataSaveFormat.zarr,
+        profile=profile,
+    )
+    expected = ["posterior"] if profile else []
+    if recorded != expected or (inference_profile is None) == profile:
+        msg = f"Unexpected fits recorded {recorded} with profile={profile}."
+        raise ValueError(msg)
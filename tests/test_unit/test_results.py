@@ -0,0 +1,55 @@
+"""Tests for the results module."""
+
+from pathlib import Path
+
+import arviz as az
+import numpy as np
+import pytest
+import xarray as xr
+
+from bibat.fitting import save_idata
+from bibat.inference_configuration import IdataSaveFormat
+from bibat.results import ResultsCatalog
+
+
+@pytest.fixture
+def inferences_dir(tmp_path: Path) -> Path:
+    """Create an inferences directory with results in different formats."""
+    idata = az.InferenceData(
+        posterior=xr.Dataset(
+            {"mu": (("chain", "draw"), np.arange(6.0).reshape(2, 3))},
+        ),
+        log_likelihood=xr.Dataset(
+            {"llik": (("chain", "draw", "observation"), np.zeros((2, 3, 4)))},
+        ),
+    )
+    for idata_save_format in IdataSaveFormat:
+        inference_dir = tmp_path / idata_save_format.value
+        inference_dir.mkdir()
+        save_idata(idata, inference_dir, idata_save_format)
+    (tmp_path / "not_run_yet").mkdir()
+    return tmp_path
+
+
+def test_results_catalog(inferences_dir: Path) -> None:
+    """Check that a ResultsCatalog finds and opens results lazily."""
+    catalog = ResultsCatalog(inferences_dir)
+    if catalog.names != ["json", "netcdf", "zarr"]:
+        msg = f"Unexpected inferences {catalog.names}."
+        raise ValueError(msg)
+    index = catalog.index()
+    llik = index.loc[index["variable"] == "llik"]
+    if len(index) != 6 or set(llik["shape"]) != {(2, 3, 4)}:  # noqa: PLR2004
+        msg = f"Unexpected index:\n{index}"
+        raise ValueError(msg)
+    for name in ["netcdf", "zarr"]:
+        mu = catalog.open_group(name, "posterior")["mu"]
+        if mu.variable._in_memory:  # noqa: SLF001
+            msg = f"Variable mu of inference {name} was read eagerly."
+            raise ValueError(msg)
+        if float(mu.sum()) != 15.0:  # noqa: PLR2004
+            msg = f"Variable mu of inference {name} has wrong values."
+            raise ValueError(msg)
+    with pytest.raises(KeyError):
+        catalog.open("not_run_yet")
+    catalog.close()
@@ -0,0 +1,137 @@
+"""Tests for the scheduling module."""
+
+import multiprocessing
+import os
+import time
+from contextvars import copy_context
+from pathlib import Path
+
+import pytest
+
+from bibat.fitting import (
+    init_worker_slot,
+    make_worker_pool,
+    schedule_inferences,
+)
+from bibat.inference_configuration import InferenceConfiguration
+from bibat.profiling import PROFILE_FILE, InferenceProfile
+from bibat.scheduling import (
+    add_parallel_kwargs,
+    allocate_cores,
+    core_budget,
+    get_core_budget,
+    get_max_workers,
+    share_core_budget,
+)
+
+
+def test_allocate_cores() -> None:
+    """Check that cores are split equally, with leftovers going first."""
+    for cores, n_jobs, expected in [
+        (8, 3, [3, 3, 2]),
+        (4, 4, [1, 1, 1, 1]),
+        (2, 3, [1, 1, 1]),
+    ]:
+        allocation = allocate_cores(cores, n_jobs)
+        if allocation != expected:
+            msg = f"Expected {expected} for {cores} cores, got {allocation}."
+            raise ValueError(msg)
+
+
+def test_add_parallel_kwargs() -> None:
+    """Check that fits get parallelism arguments that fit the budget."""
+    ic = InferenceConfiguration.model_construct(cpp_options=None)
+    threaded_ic = InferenceConfiguration.model_construct(
+        cpp_options={"STAN_THREADS": True},
+    )
+    sample_kwargs = {"chains": 4}
+    if add_parallel_kwargs(ic, sample_kwargs) != sample_kwargs:
+        msg = "Arguments were changed without a core budget."
+        raise ValueError(msg)
+    with core_budget(16):
+        workers = get_max_workers(None, 10, 4)
+        if workers != 4:  # noqa: PLR2004
+            msg = f"Expected 4 folds at once, got {workers}."
+            raise ValueError(msg)
+        kwargs = add_parallel_kwargs(ic, sample_kwargs)
+        if kwargs["parallel_chains"] != 4:  # noqa: PLR2004
+            msg = "Expected parallel_chains to be the number of chains."
+            raise ValueError(msg)
+        kwargs = add_parallel_kwargs(threaded_ic, sample_kwargs)
+        if kwargs["threads_per_chain"] != 4:  # noqa: PLR2004
+            msg = f"Expected 4 threads per chain, got {kwargs}."
+            raise ValueError(msg)
+        explicit = sample_kwargs | {"threads_per_chain": 1}
+        if add_parallel_kwargs(threaded_ic, explicit)["threads_per_chain"] != 1:
+            msg = "An explicit threads_per_chain was overridden."
+            raise ValueError(msg)
+        with share_core_budget(workers):
+            kwargs = add_parallel_kwargs(threaded_ic, sample_kwargs)
+            if kwargs["threads_per_chain"] != 1:
+                msg = f"Expected 1 thread per chain per fold, got {kwargs}."
+                raise ValueError(msg)
+
+
+def test_schedule_inferences(tmp_path: Path) -> None:
+    """Check that longer and unprofiled inferences are scheduled first."""
+    inference_dirs = []
+    for name, wall_time in [("short", 1.0), ("new", None), ("long", 10.0)]:
+        inference_dir = tmp_path / name
+        inference_dir.mkdir()
+        if wall_time is not None:
+            profile = InferenceProfile(name=name, wall_time=wall_time)
+            (inference_dir / PROFILE_FILE).write_text(profile.model_dump_json())
+        inference_dirs.append(inference_dir)
+    ordered, shares = schedule_inferences(
+        inference_dirs,
+        cores=5,
+        max_workers=2,
+    )
+    if [d.name for d in ordered] != ["new", "long", "short"] or shares != [
+        3,
+        2,
+    ]:
+        msg = f"Unexpected schedule {ordered}, {shares}."
+        raise ValueError(msg)
+    ordered, shares = schedule_inferences(inference_dirs, cores=None)
+    if ordered != inference_dirs or shares != [None]:
+        msg = "Cores were limited without a budget."
+        raise ValueError(msg)
+
+
+def get_worker_budget(_: int) -> tuple[int, int | None]:
+    """Get the current process's id and core budget after a short wait."""
+    time.sleep(0.05)
+    return os.getpid(), get_core_budget()
+
+
+def test_worker_slots_keep_their_share() -> None:
+    """Check that each worker process keeps one slot's share of the cores."""
+    shares = allocate_cores(10, 3)
+    with make_worker_pool(shares) as executor:
+        results = list(executor.map(get_worker_budget, range(12)))
+    budgets = dict(results)
+    if len(set(results)) != len(budgets):
+        msg = f"A worker's budget changed: {results}."
+        raise ValueError(msg)
+    remaining = list(shares)
+    for budget in budgets.values():
+        if budget not in remaining:
+            msg = f"Worker budgets {budgets} are not the shares {shares}."
+            raise ValueError(msg)
+        remaining.remove(budget)
+
+
+def test_init_worker_slot_waits_for_share() -> None:
+    """Check that a share put just before a worker starts is always found."""
+    for share in range(1, 21):
+        share_queue = multiprocessing.Queue()
+        share_queue.put(share)
+        budget = copy_context().run(
+            lambda q=share_queue: (init_worker_slot(q), get_core_budget())[1],
+        )
+        if budget != share:
+            msg = f"Expected a budget of {share}, got {budget}."
+            raise ValueError(msg)
+    with pytest.raises(RuntimeError, match="No share of the cores"):
+        copy_context().run(init_worker_slot, multiprocessing.Queue(), 0.1)
@@ -0,0 +1,112 @@
+"""Unit tests for the stan_input module."""
+
+import json
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from bibat.inference_configuration import InferenceConfiguration
+from bibat.prepared_data import PreparedData
+from bibat.stan_input import StanInput, get_stan_input, get_stan_input_data
+from bibat.util import CoordDict, StanInputDict
+
+CALLS = []
+
+
+def get_stan_input_counted(prepared_data: PreparedData) -> StanInputDict:
+    """Get a Stan input and remember that this function was called."""
+    CALLS.append(prepared_data.name)
+    return {"N": 3, "y": np.array([1.0, 2.0, 3.0]), "likelihood": 1}
+
+
+@pytest.fixture
+def ic(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> InferenceConfiguration:
+    """Get an inference configuration with a directory."""
+    stan_dir = tmp_path / "src" / "stan"
+    stan_dir.mkdir(parents=True)
+    (stan_dir / "model.stan").write_text("data {int N;}")
+    monkeypatch.chdir(tmp_path)
+    return InferenceConfiguration(
+        name="example",
+        stan_file="model.stan",
+        prepared_data="example",
+        stan_input_function="get_stan_input_counted",
+        modes=["prior", "posterior"],
+        inference_dir=tmp_path / "inferences" / "example",
+    )
+
+
+def test_stan_input_to_json() -> None:
+    """Check that overrides replace and add variables."""
+    stan_input = StanInput({"N": 2, "y": np.array([1.5, 2.5])})
+    got = json.loads(stan_input.to_json({"N": 1, "likelihood": 0}))
+    if got != {"N": 1, "y": [1.5, 2.5], "likelihood": 0}:
+        raise ValueError
+
+
+def test_get_stan_input_data(ic: InferenceConfiguration) -> None:
+    """Check that the Stan input function is only called once."""
+    data = PreparedData(name="example", coords=CoordDict({}))
+    local_functions = {"get_stan_input_counted": get_stan_input_counted}
+    n_calls_before = len(CALLS)
+    prior_file = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": 0},
+    )
+    posterior_file = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": 1},
+    )
+    prior_file_again = get_stan_input_data(
+        ic,
+        data,
+        local_functions,
+        overrides={"likelihood": 0},
+    )
+    _ = get_stan_input(ic, data, local_functions)
+    if len(CALLS) != n_calls_before + 1:
+        raise ValueError
+    if prior_file != prior_file_again or prior_file == posterior_file:
+        raise ValueError
+    with Path(prior_file).open() as f:
+        if json.load(f)["likelihood"] != 0:
+            raise ValueError
+
+
+def get_stan_input_scaled(
+    prepared_data: PreparedData,  # noqa: ARG001
+    scale: float,
+) -> StanInputDict:
+    """Get a Stan input whose data depend on an argument."""
+    return {"N": 1, "y": np.array([scale])}
+
+
+def test_get_stan_input_keys(ic: InferenceConfiguration) -> None:
+    """Check that different partials and lambdas get their own Stan inputs."""
+    data = PreparedData(name="example", coords=CoordDict({}))
+    local_functions = {
+        "small": partial(get_stan_input_scaled, scale=1.0),
+        "big": partial(get_stan_input_scaled, scale=2.0),
+        "lambda_small": lambda _: {"N": 1, "y": np.array([1.0])},
+        "lambda_big": lambda _: {"N": 1, "y": np.array([2.0])},
+    }
+    for name, expected in [
+        ("small", 1.0),
+        ("big", 2.0),
+        ("lambda_small", 1.0),
+        ("lambda_big", 2.0),
+    ]:
+        sif_ic = ic.model_copy(update={"stan_input_function": name})
+        stan_input = get_stan_input(sif_ic, data, local_functions)
+        if stan_input.input_dict["y"].tolist() != [expected]:
+            msg = f"Stan input function {name} got the wrong input."
+            raise ValueError(msg)
@@ -0,0 +1,133 @@
+"""Unit tests for the stan_model module."""
+
+from pathlib import Path
+
+import pytest
+
+from bibat.stan_model import (
+    STAN_DIR,
+    find_compile_jobs,
+    find_included_files,
+    get_build_stan_file,
+    stan_model_hash,
+)
+
+MAIN_MODEL = """
+functions {
+#include custom_functions.stan
+}
+data {int N;}
+"""
+CUSTOM_FUNCTIONS = """
+#include "more_functions.stan"
+real f(real x){ return g(x); }
+"""
+MORE_FUNCTIONS = "real g(real x){ return x; }"
+
+
+@pytest.fixture
+def stan_dir(tmp_path: Path) -> Path:
+    """Create a directory with a Stan program that includes other files."""
+    (tmp_path / "model.stan").write_text(MAIN_MODEL)
+    (tmp_path / "custom_functions.stan").write_text(CUSTOM_FUNCTIONS)
+    (tmp_path / "more_functions.stan").write_text(MORE_FUNCTIONS)
+    return tmp_path
+
+
+def test_find_included_files(stan_dir: Path) -> None:
+    """Check that included files are found recursively."""
+    found = find_included_files(stan_dir / "model.stan")
+    expected = [
+        stan_dir / "custom_functions.stan",
+        stan_dir / "more_functions.stan",
+    ]
+    if found != expected:
+        raise ValueError
+
+
+def test_stan_model_hash_depends_on_includes(stan_dir: Path) -> None:
+    """Check that changing an included file changes the hash."""
+    before = stan_model_hash(stan_dir / "model.stan")
+    (stan_dir / "more_functions.stan").write_text("real g(real x){return 1;}")
+    after = stan_model_hash(stan_dir / "model.stan")
+    if before == after:
+        raise ValueError
+
+
+def test_stan_model_hash_depends_on_options(stan_dir: Path) -> None:
+    """Check that compiler options change the hash."""
+    stan_file = stan_dir / "model.stan"
+    hashes = {
+        stan_model_hash(stan_file),
+        stan_model_hash(stan_file, cpp_options={"STAN_THREADS": True}),
+        stan_model_hash(stan_file, stanc_options={"warn-pedantic": True}),
+    }
+    if len(hashes) != 3:  # noqa: PLR2004
+        raise ValueError
+
+
+def test_find_included_files_missing(stan_dir: Path) -> None:
+    """Check that a missing included file causes an error."""
+    (stan_dir / "more_functions.stan").unlink()
+    with pytest.raises(ValueError, match=r"more_functions\.stan"):
+        find_included_files(stan_dir / "model.stan")
+
+
+def write_config(inference_dir: Path, stan_file: str, cpp: str = "") -> None:
+    """Write a config.toml file for an inference."""
+    inference_dir.mkdir(parents=True)
+    (inference_dir / "config.toml").write_text(
+        f'name = "{inference_dir.name}"\n'
+        f'stan_file = "{stan_file}"\n'
+        'prepared_data = "d"\n'
+        'stan_input_function = "f"\n'
+        'modes = ["posterior"]\n'
+        f"{cpp}",
+    )
+
+
+def test_find_compile_jobs(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Check that each distinct model is compiled once."""
+    stan_dir = tmp_path / STAN_DIR
+    stan_dir.mkdir(parents=True)
+    for name in ["model.stan", "other.stan"]:
+        (stan_dir / name).write_text(MORE_FUNCTIONS)
+    monkeypatch.chdir(tmp_path)
+    write_config(Path("inferences/a"), "model.stan")
+    write_config(Path("inferences/b"), "model.stan")
+    write_config(Path("inferences/c"), "other.stan")
+    write_config(
+        Path("inferences/d"),
+        "model.stan",
+        "[cpp_options]\nSTAN_THREADS = true\n",
+    )
+    jobs = find_compile_jobs(sorted(Path("inferences").iterdir()))
+    found = [(job.stan_file.name, job.inferences) for job in jobs]
+    expected = [
+        ("model.stan", ["a", "b"]),
+        ("other.stan", ["c"]),
+        ("model.stan", ["d"]),
+    ]
+    if found != expected:
+        msg = f"Unexpected compile jobs {found}."
+        raise ValueError(msg)
+
+
+def test_get_build_stan_file(stan_dir: Path) -> None:
+    """Check that different options are compiled from different copies."""
+    stan_file = stan_dir / "model.stan"
+    build_files = {
+        get_build_stan_file(stan_file, stan_model_hash(stan_file)),
+        get_build_stan_file(
+            stan_file,
+            stan_model_hash(stan_file, cpp_options={"STAN_THREADS": True}),
+        ),
+    }
+    if len(build_files) != 2 or any(  # noqa: PLR2004
+        f.parent != stan_dir / "build" for f in build_files
+    ):
+        msg = f"Unexpected build files {build_files}."
+        raise ValueError(msg)
@@ -1,16 +1,23 @@
 """Unit tests for functions in src/util.py."""
 
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 from pandas.testing import assert_frame_equal, assert_series_equal
 
 from bibat.util import (
+    encode_stan_json_value,
+    file_lock,
     make_columns_lower_case,
     one_encode,
     returns_stan_input,
     validate_df_or_string,
+    write_stan_json,
 )
 
 
@@ -75,3 +82,54 @@ def test_returns_stan_input() -> None:
 
     stan_input = does_return_stan_input()
     _ = json.dumps(stan_input)
+
+
+def test_returns_stan_input_numpy(tmp_path: Path) -> None:
+    """Check that the numpy fast path gives the same json as the default."""
+    raw = {
+        "N": 3,
+        "x": pd.DataFrame({"a": [1.5, 2.0, 3.0], "b": [4.0, 5.0, 6.0]}),
+        "y": pd.Series([True, False, True]),
+        "ix": [1, 2, 3],
+        "z": np.array([1.0, -np.inf, np.inf]),
+    }
+    expected = returns_stan_input(lambda: raw)()
+    stan_input = returns_stan_input(numpy=True)(lambda: raw)()
+    if not isinstance(stan_input["x"], np.ndarray):
+        msg = "Expected a numpy array."
+        raise TypeError(msg)
+    for k, v in expected.items():
+        encoded = encode_stan_json_value(stan_input[k])
+        if json.loads(encoded) != v:
+            msg = f"Bad encoding for {k}: {encoded}"
+            raise ValueError(msg)
+    path = tmp_path / "input.json"
+    write_stan_json(path, stan_input)
+    if json.loads(path.read_text()) != expected:
+        msg = f"Bad json file: {path.read_text()}"
+        raise ValueError(msg)
+
+
+def append_while_locked(path: Path, text: str) -> None:
+    """Append some text to a file in two steps while holding its lock."""
+    with file_lock(path.with_suffix(".lock")):
+        with path.open("a") as f:
+            f.write(text)
+        time.sleep(0.2)
+        with path.open("a") as f:
+            f.write(text)
+
+
+def test_file_lock(tmp_path: Path) -> None:
+    """Check that processes holding a file lock do not overlap."""
+    path = tmp_path / "log.txt"
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(append_while_locked, path, text)
+            for text in ["a", "b"]
+        ]
+        for future in futures:
+            future.result()
+    if path.read_text() not in ["aabb", "bbaa"]:
+        msg = f"Locked blocks overlapped: {path.read_text()}."
+        raise ValueError(msg)
@@ -0,0 +1,120 @@
+"""Unit tests for the validation module."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pandas as pd
+import pandera as pa
+import pytest
+from pandera.typing import Series  # noqa: TCH002
+from pydantic import field_validator
+
+from bibat.prepared_data import (
+    PreparedData,
+    PreparedDataFormat,
+    load_prepared_data,
+    save_prepared_data,
+)
+from bibat.util import CoordDict, DfInPydanticModel
+from bibat.validation import sampled_validation, table_hash, validate_table
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+validations: list[int] = []
+
+
+class CountsDF(pa.DataFrameModel):
+    """A table of counts."""
+
+    season: Series[str] = pa.Field(coerce=True)
+    n: Series[int] = pa.Field(ge=0)
+
+
+class CountsPreparedData(PreparedData):
+    """Prepared data with a table of counts."""
+
+    counts: DfInPydanticModel
+
+    @field_validator("counts")
+    @classmethod
+    def validate_counts(
+        cls: type[CountsPreparedData],
+        v: DfInPydanticModel,
+    ) -> pd.DataFrame:
+        """Validate the counts table, recording the call."""
+        validations.append(len(v))
+        return validate_table(CountsDF, v)
+
+
+def make_counts(n: list[int]) -> pd.DataFrame:
+    """Make a table of counts."""
+    return pd.DataFrame({"season": [2017 + i for i in range(len(n))], "n": n})
+
+
+@pytest.mark.parametrize("prepared_data_format", list(PreparedDataFormat))
+def test_validated_tables_are_not_validated_again(
+    tmp_path: Path,
+    prepared_data_format: PreparedDataFormat,
+) -> None:
+    """Check that only new or changed tables are validated on load."""
+    if prepared_data_format == PreparedDataFormat.parquet:
+        pytest.importorskip("pyarrow")
+    prepared_data = CountsPreparedData(
+        name="counts",
+        coords=CoordDict({}),
+        counts=make_counts([1, 2, 3]),
+    )
+    path = save_prepared_data(prepared_data, tmp_path, prepared_data_format)
+    validations.clear()
+    loaded = load_prepared_data(path, CountsPreparedData)
+    if validations:
+        msg = "An unchanged table was validated again."
+        raise ValueError(msg)
+    if loaded.counts.dtypes.to_dict() != prepared_data.counts.dtypes.to_dict():
+        msg = f"Unexpected dtypes {loaded.counts.dtypes}."
+        raise ValueError(msg)
+    if loaded.counts["season"].tolist() != ["2017", "2018", "2019"]:
+        msg = f"Unexpected seasons {loaded.counts['season']}."
+        raise ValueError(msg)
+    validations.clear()
+    load_prepared_data(path, CountsPreparedData, revalidate=True)
+    if validations != [3]:
+        msg = "The table was not validated when revalidate was True."
+        raise ValueError(msg)
+    if prepared_data_format == PreparedDataFormat.parquet:
+        make_counts([1, 2, -3]).to_parquet(path / "counts.parquet")
+    else:
+        changed = prepared_data.model_copy(
+            update={"counts": make_counts([1, 2, -3])},
+        )
+        path.write_text(changed.model_dump_json())
+    with pytest.raises(pa.errors.SchemaError):
+        load_prepared_data(path, CountsPreparedData)
+
+
+def test_table_hash() -> None:
+    """Check that table hashes depend on values and dtypes."""
+    df = make_counts([1, 2, 3])
+    hashes = {
+        table_hash(df),
+        table_hash(df.astype({"n": "int32"})),
+        table_hash(make_counts([1, 2, 4])),
+    }
+    if len(hashes) != 3:  # noqa: PLR2004
+        msg = "Different tables had the same hash."
+        raise ValueError(msg)
+    if table_hash(df) != table_hash(df.copy()):
+        msg = "Table hashes did not match table contents."
+        raise ValueError(msg)
+
+
+def test_sampled_validation() -> None:
+    """Check that sampled validation still coerces every row."""
+    df = make_counts(list(range(100)))
+    with sampled_validation(10):
+        validated = validate_table(CountsDF, df)
+    if len(validated) != len(df) or validated["season"].dtype == "int64":
+        msg = f"Expected all seasons to be coerced, got {validated.dtypes}."
+        raise ValueError(msg)
@@ -0,0 +1,112 @@
+"""Tests for the warm_start module."""
+
+from pathlib import Path
+
+import pytest
+
+from bibat.inference_configuration import InferenceConfiguration
+from bibat.prepared_data import PreparedData
+from bibat.util import CoordDict, StanInputDict, returns_stan_input
+from bibat.warm_start import (
+    DEFAULT_CHAINS,
+    WARM_START_FILE,
+    WarmStart,
+    add_warm_start,
+    get_input_hash,
+    get_model_hash,
+    get_warm_start_kwargs,
+)
+
+WARM_START = WarmStart(
+    model_hash="",
+    metric_type="diag_e",
+    step_size=[0.1, 0.2],
+    inv_metric=[[1.0, 2.0], [3.0, 4.0]],
+    inits=[{"mu": 1.0}, {"mu": 2.0}],
+)
+
+
+class NumbersPreparedData(PreparedData):
+    """Prepared data with a list of numbers."""
+
+    y: list[float]
+
+
+@returns_stan_input
+def get_stan_input(data: NumbersPreparedData) -> StanInputDict:
+    """Get a Stan input from a list of numbers."""
+    return {"N": len(data.y), "y": data.y}
+
+
+LOCAL_FUNCTIONS = {"get_stan_input": get_stan_input}
+
+
+def test_get_warm_start_kwargs() -> None:
+    """Check that warm start chains are reused and adaptation turned off."""
+    kwargs = get_warm_start_kwargs(WARM_START, {"chains": 3, "iter_warmup": 0})
+    if kwargs["step_size"] != [0.1, 0.2, 0.1]:
+        msg = f"Unexpected step sizes {kwargs['step_size']}."
+        raise ValueError(msg)
+    if [i["mu"] for i in kwargs["inits"]] != [1.0, 2.0, 1.0]:
+        msg = f"Unexpected inits {kwargs['inits']}."
+        raise ValueError(msg)
+    if kwargs["inv_metric"][2].tolist() != [1.0, 2.0]:
+        msg = f"Unexpected inverse metric {kwargs['inv_metric']}."
+        raise ValueError(msg)
+    if kwargs["adapt_engaged"]:
+        msg = "Adaptation should be turned off when there is no warmup."
+        raise ValueError(msg)
+    kwargs = get_warm_start_kwargs(WARM_START, {"iter_warmup": 10})
+    n_chains = len(kwargs["step_size"])
+    if n_chains != DEFAULT_CHAINS or "adapt_engaged" in kwargs:
+        msg = f"Unexpected keyword arguments {kwargs}."
+        raise ValueError(msg)
+
+
+def test_add_warm_start(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Check that only up to date warm starts are used."""
+    monkeypatch.chdir(tmp_path)
+    stan_file = tmp_path / "src" / "stan" / "model.stan"
+    stan_file.parent.mkdir(parents=True)
+    stan_file.write_text("parameters { real mu; }")
+    ic = InferenceConfiguration(
+        name="example",
+        prepared_data="example",
+        stan_file="model.stan",
+        stan_input_function="get_stan_input",
+        modes=["posterior"],
+        inference_dir=tmp_path,
+    )
+    data = NumbersPreparedData(name="example", coords=CoordDict({}), y=[1.0])
+    warm_start = WARM_START.model_copy(
+        update={
+            "model_hash": get_model_hash(ic),
+            "input_hash": get_input_hash(ic, data, LOCAL_FUNCTIONS),
+        },
+    )
+    (tmp_path / WARM_START_FILE).write_text(warm_start.model_dump_json())
+    sample_kwargs = {"chains": 2}
+    args = (ic, data, LOCAL_FUNCTIONS, sample_kwargs)
+    if add_warm_start(*args, {}) != sample_kwargs:
+        msg = "Warm start was used without being asked for."
+        raise ValueError(msg)
+    kwargs = add_warm_start(*args, {"warm_start": True})
+    if kwargs.get("step_size") != [0.1, 0.2]:
+        msg = f"Warm start was not used: {kwargs}"
+        raise ValueError(msg)
+    new_data = NumbersPreparedData(
+        name="example",
+        coords=CoordDict({}),
+        y=[2.0],
+    )
+    new_args = (ic, new_data, LOCAL_FUNCTIONS, sample_kwargs)
+    if add_warm_start(*new_args, {"warm_start": True}) != sample_kwargs:
+        msg = "A warm start for different data was used."
+        raise ValueError(msg)
+    stan_file.write_text("parameters { real mu; real sigma; }")
+    if add_warm_start(*args, {"warm_start": True}) != sample_kwargs:
+        msg = "An out of date warm start was used."
+        raise ValueError(msg)
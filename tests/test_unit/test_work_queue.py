@@ -0,0 +1,253 @@
+"""Unit tests for the work_queue module."""
+
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import toml
+import xarray as xr
+
+from bibat.checkpoint import (
+    Checkpoint,
+    checkpoint_scope,
+    checkpointing,
+    get_checkpoint_dir,
+    load_fit_checkpoint,
+    save_checkpoint,
+    save_fit_checkpoint,
+)
+from bibat.fitting import enqueue_inferences, load_idata, run_queued_task
+from bibat.fitting_mode import FittingMode, IdataTarget
+from bibat.inference_configuration import (
+    IdataSaveFormat,
+    InferenceConfiguration,
+)
+from bibat.util import CoordDict
+from bibat.work_queue import (
+    CLAIMED,
+    DONE,
+    FAILED,
+    PENDING,
+    Task,
+    TaskKind,
+    claim_task,
+    enqueue,
+    get_tasks,
+    requeue_stale_tasks,
+    run_worker,
+    save_run,
+)
+from tests.test_unit.test_checkpoint import (
+    NumbersPreparedData,
+    get_stan_input_numbers,
+    load_numbers,
+)
+
+if TYPE_CHECKING:
+    import pytest
+
+RUN_ID = "run"
+
+N_PIECES = 3
+
+ran: list[str] = []
+fitted: list[str] = []
+
+
+def make_task(i: int, depends_on: list[int] | None = None) -> Task:
+    """Make a task with a numbered id."""
+    return Task(
+        id=f"{RUN_ID}-{i:05d}",
+        run=RUN_ID,
+        kind=TaskKind.fit_piece,
+        inference_dir=Path("inference"),
+        mode="kfold",
+        piece=i,
+        depends_on=[f"{RUN_ID}-{j:05d}" for j in depends_on or []],
+    )
+
+
+def run_or_fail(task: Task, run_objects: dict[str, Any]) -> None:
+    """Record a task, failing if its piece is listed in the run objects."""
+    ran.append(task.id)
+    if task.piece in run_objects["fail"]:
+        msg = f"piece {task.piece} failed"
+        raise RuntimeError(msg)
+
+
+def test_claim_task_waits_for_dependencies(tmp_path: Path) -> None:
+    """Check that tasks are claimed in order once their dependencies are met."""
+    enqueue(tmp_path, [make_task(2, depends_on=[0, 1]), make_task(0)])
+    enqueue(tmp_path, [make_task(1)])
+    claimed = [claim_task(tmp_path), claim_task(tmp_path)]
+    if [t.id for t in claimed if t is not None] != ["run-00000", "run-00001"]:
+        msg = f"Unexpected claimed tasks {claimed}."
+        raise ValueError(msg)
+    if claim_task(tmp_path) is not None:
+        msg = "A task was claimed before its dependencies were done."
+        raise ValueError(msg)
+    if len(list((tmp_path / CLAIMED).iterdir())) != 2:  # noqa: PLR2004
+        msg = "Claimed tasks were not moved to the claimed folder."
+        raise ValueError(msg)
+
+
+def test_run_worker_records_failures(tmp_path: Path) -> None:
+    """Check that a failed task's dependents fail without being run."""
+    save_run(tmp_path, RUN_ID, {"fail": [1]})
+    enqueue(
+        tmp_path,
+        [make_task(0), make_task(1), make_task(2, depends_on=[0, 1])],
+    )
+    ran.clear()
+    n_run = run_worker(tmp_path, run_or_fail, run_id=RUN_ID)
+    if n_run != 2 or ran != ["run-00000", "run-00001"]:  # noqa: PLR2004
+        msg = f"Unexpected tasks run: {ran}."
+        raise ValueError(msg)
+    if [t.id for t in get_tasks(tmp_path, DONE, RUN_ID)] != ["run-00000"]:
+        msg = "The successful task was not marked as done."
+        raise ValueError(msg)
+    failed = get_tasks(tmp_path, FAILED, RUN_ID)
+    if [t.id for t in failed] != ["run-00001", "run-00002"]:
+        msg = f"Unexpected failed tasks {failed}."
+        raise ValueError(msg)
+    if "piece 1 failed" not in (failed[0].error or ""):
+        msg = f"The error was not recorded: {failed[0].error}."
+        raise ValueError(msg)
+
+
+def test_requeue_stale_tasks(tmp_path: Path) -> None:
+    """Check that only claimed tasks that have not been touched are requeued."""
+    enqueue(tmp_path, [make_task(0), make_task(1)])
+    claim_task(tmp_path)
+    claim_task(tmp_path)
+    stale_path = tmp_path / CLAIMED / "run-00000.json"
+    os.utime(stale_path, (0, 0))
+    if requeue_stale_tasks(tmp_path, max_age=60) != ["run-00000"]:
+        msg = "The stale task was not requeued."
+        raise ValueError(msg)
+    if not (tmp_path / PENDING / "run-00000.json").exists():
+        msg = "The stale task is not pending."
+        raise ValueError(msg)
+
+
+def get_n_pieces(ic: InferenceConfiguration) -> int:  # noqa: ARG001
+    """Get the number of pieces of the fake split mode."""
+    return N_PIECES
+
+
+def fit_piece(
+    ic: InferenceConfiguration,  # noqa: ARG001
+    data: NumbersPreparedData,
+    local_functions: dict,  # noqa: ARG001
+    piece: int,
+) -> np.ndarray:
+    """Pretend to fit one piece, saving its draws as a checkpoint."""
+    fitted.append(f"piece_{piece}")
+    draws = np.full((1, 2, len(data.y)), float(piece))
+    save_fit_checkpoint(f"piece_{piece}", draws)
+    return draws
+
+
+def fit_split(
+    ic: InferenceConfiguration,
+    data: NumbersPreparedData,
+    local_functions: dict,
+) -> xr.DataArray:
+    """Pretend to fit a mode from its pieces, fitting any that are missing."""
+    fitted.append("split")
+    draws = [
+        (
+            load_fit_checkpoint(f"piece_{i}")
+            if load_fit_checkpoint(f"piece_{i}") is not None
+            else fit_piece(ic, data, local_functions, i)
+        )
+        for i in range(N_PIECES)
+    ]
+    return xr.DataArray(
+        np.concatenate(draws, axis=1),
+        dims=["chain", "draw", "observation"],
+    )
+
+
+SPLIT_MODES = {
+    "split": FittingMode(
+        name="split",
+        idata_target=IdataTarget.log_likelihood,
+        fit=fit_split,
+        n_pieces=get_n_pieces,
+        fit_piece=fit_piece,
+    ),
+}
+
+
+def test_queued_inference_with_pieces(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Check that a queued inference fits its pieces, then uses them."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src" / "stan").mkdir(parents=True)
+    (tmp_path / "src" / "stan" / "model.stan").write_text("data {int N;}")
+    (tmp_path / "data").mkdir()
+    numbers = NumbersPreparedData(name="numbers", coords=CoordDict({}), y=[1.0])
+    (tmp_path / "data" / "numbers.json").write_text(numbers.model_dump_json())
+    inference_dir = tmp_path / "inferences" / "numbers"
+    inference_dir.mkdir(parents=True)
+    ic = InferenceConfiguration(
+        name="numbers",
+        prepared_data="numbers",
+        stan_file="model.stan",
+        stan_input_function="get_stan_input_numbers",
+        modes=["split"],
+    )
+    with (inference_dir / "config.toml").open("w") as f:
+        toml.dump(ic.model_dump(by_alias=True, exclude={"inference_dir"}), f)
+    save_checkpoint(inference_dir, Checkpoint(fingerprints={"split": "old"}))
+    stale_dir = get_checkpoint_dir(inference_dir)
+    with checkpointing(stale_dir), checkpoint_scope("split"):
+        save_fit_checkpoint("piece_0", np.full((1, 2, 1), -1.0))
+    queue_dir = tmp_path / "queue"
+    run_id = enqueue_inferences(
+        queue_dir,
+        [inference_dir],
+        {
+            "data_dir": Path("data"),
+            "fitting_mode_options": SPLIT_MODES,
+            "loader": load_numbers,
+            "local_functions": {
+                "get_stan_input_numbers": get_stan_input_numbers,
+            },
+            "idata_save_format": IdataSaveFormat.zarr,
+        },
+    )
+    if not (stale_dir / "split" / "piece_0.npy").exists():
+        msg = "Adding tasks to the queue changed the checkpoint."
+        raise ValueError(msg)
+    pending = get_tasks(queue_dir, PENDING, run_id)
+    kinds = [(t.kind, t.piece) for t in pending]
+    expected_kinds = [
+        *[(TaskKind.fit_piece, i) for i in range(N_PIECES)],
+        (TaskKind.inference, None),
+    ]
+    if kinds != expected_kinds:
+        msg = f"Unexpected tasks {kinds}."
+        raise ValueError(msg)
+    fitted.clear()
+    run_worker(queue_dir, run_queued_task, run_id=run_id)
+    if get_tasks(queue_dir, FAILED, run_id):
+        msg = f"Tasks failed: {get_tasks(queue_dir, FAILED, run_id)}."
+        raise ValueError(msg)
+    if fitted != ["piece_0", "piece_1", "piece_2", "split"]:
+        msg = f"Unexpected fits {fitted}."
+        raise ValueError(msg)
+    idata = load_idata(inference_dir)
+    llik = idata.log_likelihood["llik_split"] if idata is not None else None
+    if llik is None or llik.values.ravel().tolist() != [0, 0, 1, 1, 2, 2]:
+        msg = f"The pieces' draws were not used: {llik}."
+        raise ValueError(msg)
+    if stale_dir.exists():
+        msg = "The checkpoint was not removed after the inference finished."
+        raise ValueError(msg)